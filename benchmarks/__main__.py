@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from gitbrowse.git import GitFileHistory, git
+from gitbrowse.search import SearchIndex, HistorySearch
+from generate import generate_repo, EDIT_PATTERNS
+
+
+# A string that matches about one line in a hundred of a generated file.
+SEARCH_PATTERN = 'compute(42)'
+
+
+# Each benchmark sets up whatever it needs and returns a function doing
+# the work to be timed. They're set up again for every repetition, so
+# nothing is cached by GitFileHistory between runs.
+
+def bench_construction(path, options):
+    # Up to the point where the first revision can be shown.
+    return lambda: GitFileHistory(path, 'HEAD').current_commit.sha
+
+
+def bench_full_history(path, options):
+    return lambda: len(GitFileHistory(path, 'HEAD').commits)
+
+
+def bench_blame(path, options):
+    history = GitFileHistory(path, 'HEAD')
+    return history.blame
+
+
+def bench_line_mapping(path, options):
+    history = GitFileHistory(path, 'HEAD')
+    commits = history.commits
+    return lambda: history.line_mapping(commits[0].sha, commits[1].sha)
+
+
+def bench_line_mapping_distant(path, options):
+    history = GitFileHistory(path, 'HEAD')
+    commits = history.commits
+    return lambda: history.line_mapping(commits[0].sha,
+                                        commits[options.steps].sha)
+
+
+def bench_navigation(path, options):
+    # What the browser does for a counted move, e.g. "10[".
+    history = GitFileHistory(path, 'HEAD')
+
+    def navigate():
+        history.go_to(options.steps)
+        history.map_line(options.lines // 2, 0, options.steps)
+        history.blame()
+
+    return navigate
+
+
+def bench_search(path, options):
+    lines = GitFileHistory(path, 'HEAD').blame().lines()
+    return lambda: SearchIndex(lines, SEARCH_PATTERN)
+
+
+def bench_history_search(path, options):
+    search = HistorySearch(GitFileHistory(path, 'HEAD'), SEARCH_PATTERN)
+
+    def run():
+        search.start()
+        search.wait()
+
+    return run
+
+
+BENCHMARKS = [
+    ('construction', bench_construction),
+    ('full_history', bench_full_history),
+    ('blame', bench_blame),
+    ('line_mapping', bench_line_mapping),
+    ('line_mapping_distant', bench_line_mapping_distant),
+    ('navigation', bench_navigation),
+    ('search', bench_search),
+    ('history_search', bench_history_search),
+]
+
+
+def version():
+    # The commit of git browse being measured, so results from different
+    # versions can be told apart.
+    try:
+        return subprocess.check_output(
+            ('git', 'rev-parse', 'HEAD'),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    path = generate_repo(options.repo, lines=options.lines,
+                         commits=options.commits, renames=options.renames,
+                         pattern=options.pattern, seed=options.seed)
+    os.chdir(options.repo)
+
+    # Blames and mappings can't follow the file back past a rename yet, so
+    # moves are kept to the revisions since the last one.
+    unrenamed = len(git('log', '--format=%H', '--', path).splitlines())
+    options.steps = max(min(options.steps, unrenamed - 1), 1)
+
+    common = {
+        'version': version(),
+        'lines': options.lines,
+        'commits': options.commits,
+        'renames': options.renames,
+        'pattern': options.pattern,
+        'seed': options.seed,
+        'steps': options.steps,
+    }
+
+    for name, benchmark in BENCHMARKS:
+        if options.only and name not in options.only:
+            continue
+
+        times = []
+        for _ in range(options.repeat):
+            work = benchmark(path, options)
+            start = time.time()
+            work()
+            times.append(time.time() - start)
+
+        result = dict(common)
+        result.update({
+            'benchmark': name,
+            'times': times,
+            'min': min(times),
+            'median': sorted(times)[len(times) // 2],
+        })
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+
+
+parser = argparse.ArgumentParser(
+    prog='benchmarks',
+    description='Times git browse against a generated repository and '
+                'prints the results as JSON, one benchmark per line.',
+)
+parser.add_argument('--lines', type=int, default=2000,
+                    help='lines in the file at its first commit')
+parser.add_argument('--commits', type=int, default=200)
+parser.add_argument('--renames', type=int, default=0,
+                    help='times the file is renamed in its history')
+parser.add_argument('--pattern', choices=EDIT_PATTERNS, default='mixed',
+                    help='how each commit changes the file')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--steps', type=int, default=10,
+                    help='commits to move in the navigation benchmarks')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--only', action='append', metavar='BENCHMARK',
+                    choices=[name for name, _ in BENCHMARKS],
+                    help='only run the named benchmark (can be repeated)')
+parser.add_argument('--repo', metavar='DIR',
+                    help='create the repository here and keep it, rather '
+                         'than in a temporary directory')
+options = parser.parse_args()
+
+keep = options.repo is not None
+if not keep:
+    options.repo = tempfile.mkdtemp(prefix='git-browse-benchmark-')
+
+try:
+    run(options)
+finally:
+    if not keep:
+        shutil.rmtree(options.repo)
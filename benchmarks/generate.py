@@ -0,0 +1,108 @@
+import os
+import random
+import subprocess
+
+
+# The ways the file can be changed by each commit.
+EDIT_PATTERNS = ('append', 'scattered', 'block', 'mixed')
+
+
+def generate_repo(path, lines=1000, commits=100, renames=0,
+                  pattern='mixed', seed=0):
+    """
+    Creates a git repository at path containing a single file with the
+    given number of lines, changed by the given number of commits. Returns
+    the name of the file at HEAD.
+
+    Each commit changes the file according to pattern:
+
+        append      Adds a few lines to the end.
+        scattered   Rewrites a few lines spread through the file.
+        block       Inserts a block of lines in one place and removes a
+                    block from another.
+        mixed       One of the above, chosen at random.
+
+    If renames is given, the file is renamed that many times, at evenly
+    spaced commits, so that it has to be followed through the renames.
+
+    The repository is written with git fast-import, which is much quicker
+    than making each commit separately. The same arguments always produce
+    the same history.
+    """
+    if pattern not in EDIT_PATTERNS:
+        raise ValueError('Unknown edit pattern: %s' % (pattern, ))
+
+    rng = random.Random(seed)
+    subprocess.check_call(('git', 'init', '-q', path))
+
+    importer = subprocess.Popen(
+        ('git', 'fast-import', '--quiet'),
+        cwd=path,
+        stdin=subprocess.PIPE,
+    )
+
+    names = ['file%d.txt' % i for i in range(renames + 1)]
+    rename_every = commits // (renames + 1) or 1
+
+    content = [_new_line(rng) for _ in range(lines)]
+    name = names.pop(0)
+    for i in range(commits):
+        operations = []
+        if i and i % rename_every == 0 and names:
+            operations.append('R %s %s\n' % (name, names[0]))
+            name = names.pop(0)
+
+        if i:
+            _edit(content, rng.choice(EDIT_PATTERNS[:-1])
+                  if pattern == 'mixed' else pattern, rng)
+
+        data = ''.join(content)
+        operations.append('M 100644 inline %s\ndata %d\n%s\n' % (
+            name, len(data), data,
+        ))
+
+        message = 'Commit %d' % (i + 1)
+        importer.stdin.write(''.join([
+            'commit refs/heads/master\n',
+            'committer Benchmark <benchmark@example.com> %d +0000\n' % (
+                1000000000 + i * 60,
+            ),
+            'data %d\n%s\n' % (len(message), message),
+        ] + operations + ['\n']))
+
+    importer.stdin.close()
+    if importer.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(('git', 'checkout', '-q', '-f', 'master'),
+                              cwd=path, stdout=devnull)
+
+    return name
+
+
+def _new_line(rng):
+    # Mostly distinct lines, with some of the repetition real code has.
+    roll = rng.random()
+    if roll < 0.1:
+        return '\n'
+    if roll < 0.15:
+        return '}\n'
+    return '    value_%d = compute(%d)\n' % (rng.randrange(10 ** 6),
+                                              rng.randrange(100))
+
+
+def _edit(content, pattern, rng):
+    if pattern == 'append':
+        content.extend(_new_line(rng) for _ in range(rng.randint(1, 5)))
+    elif pattern == 'scattered':
+        for _ in range(rng.randint(1, 5)):
+            if content:
+                content[rng.randrange(len(content))] = _new_line(rng)
+    elif pattern == 'block':
+        size = rng.randint(1, 10)
+        position = rng.randint(0, len(content))
+        content[position:position] = [_new_line(rng) for _ in range(size)]
+
+        position = rng.randint(0, max(len(content) - size, 0))
+        del content[position:position + size]
@@ -1,8 +1,14 @@
 import curses
 import os
+import re
+import time
 
 from gitbrowse.ui import ModalTextbox, ModalScrollingInterface
-from gitbrowse.git import GitFileHistory
+from gitbrowse.git import GitBlame, LineHistory
+from gitbrowse.prefetch import Prefetcher
+from gitbrowse.profiling import profiler
+from gitbrowse.search import SearchIndex, HistorySearch
+from gitbrowse.session import Session
 
 
 class GitBrowser(ModalScrollingInterface):
@@ -14,16 +20,241 @@ class GitBrowser(ModalScrollingInterface):
     modes = {
         '/': 'search',
         '?': 'reverse_search',
+        '&': 'history_search',
+        'o': 'open_file',
     }
+    # Files bigger than this many bytes are blamed in chunks of
+    # blame_chunk_size lines, and only around the part being looked at.
+    chunked_blame_bytes = 1024 * 1024
+    blame_chunk_size = 1000
 
-    def __init__(self, path, commit):
+    coalesced_keys = {
+        ord(']'): ('_move_commit', -1),
+        ord('['): ('_move_commit', 1),
+    }
+
+    # The attributes that belong to the file being shown. They are put
+    # aside while another file is shown, and brought back when it is shown
+    # again.
+    file_attributes = ('file_history', 'chunked', '_stream_blame',
+                       '_blame_task', '_copies_task', 'history_list',
+                       'show_history', '_search_index', 'scroll_line',
+                       '_highlight_line')
+
+    def __init__(self, path, commit, prefetch=2, stream=True,
+                 disk_cache=None, regex=False, ignore_case=False,
+                 copies=False):
         super(GitBrowser, self).__init__()
-        self.file_history = GitFileHistory(path, commit)
+        # Every file opened in this browser is followed from the same
+        # commit, and shares git processes, caches and commits with the
+        # others.
+        self.session = Session(commit, disk_cache=disk_cache)
+        self._files_aside = {}
+
         self.search_term = None
         self.reverse_search = False
+        self.regex = regex
+        self.ignore_case = ignore_case
+        self.show_profile = False
+        self._profile_drawn = 0
+        self._picker_query = None
+        self._message = None
+
+        self.stream = stream
+        # Whether to follow moved and copied lines (see _find_copies).
+        self.copies = copies
+        self._copies_blame = None
+        self._move_task = None
+        self.prefetcher = None
+        # Called, if set, just before the process is replaced by git show.
+        self.before_exec = None
+        self._enter_file(self.session.open(path))
+
+        if prefetch > 0:
+            self.prefetcher = Prefetcher(self.file_history, radius=prefetch,
+                                         blames=not self.chunked)
+
+    def run(self):
+        if self.prefetcher:
+            self.prefetcher.start()
+            self.prefetcher.schedule()
+        super(GitBrowser, self).run()
 
     def content(self):
-        return self.file_history.blame()
+        if self.copies:
+            blame = self._cached_copies_blame()
+            if blame is not None:
+                return blame
+
+        if not self.stream:
+            return self._background_blame()
+
+        sha = self.file_history.current_commit.sha
+        if self._stream_blame is not None and self._stream_blame.sha == sha:
+            return self._stream_blame.lines
+
+        if self._blame_task is not None:
+            if self._blame_task[0] == sha:
+                return self._background_blame()
+            self._blame_task[2].cancel()
+            self._blame_task = None
+
+        blame = self.file_history.cached_blame(sha)
+        if blame is not None:
+            return blame
+
+        if self._stream_blame is not None:
+            self._stream_blame.cancel()
+            self._stream_blame = None
+
+        if self.prefetcher is not None and \
+           self.prefetcher.blaming(self.file_history, sha):
+            # The prefetcher is already blaming the revision in full, so
+            # rather than streaming a second blame, wait for that one in the
+            # background, as when not streaming.
+            return self._background_blame()
+
+        # The blame won't start until the screen is drawn, so that it
+        # knows which lines to fill in first.
+        self._stream_blame = self.file_history.stream_blame(
+            sha,
+            chunk_size=self.blame_chunk_size if self.chunked else None,
+        )
+        return self._stream_blame.lines
+
+    def _background_blame(self):
+        # Without streaming, the file is shown unblamed until a background
+        # task has blamed the whole thing. Once there's a task for the
+        # revision, the caches aren't asked again, since content is called a
+        # lot and each miss can mean a look on disk.
+        sha = self.file_history.current_commit.sha
+        if self._blame_task is not None and self._blame_task[0] == sha:
+            task = self._blame_task[2]
+            if task.finished and task.result is not None:
+                return task.result
+            return self._blame_task[1]
+
+        blame = self.file_history.cached_blame(sha)
+        if blame is not None:
+            return blame
+
+        if self._blame_task is not None:
+            self._blame_task[2].cancel()
+
+        file_history = self.file_history
+        lines = GitBlame(sha, ''.join(file_history.text(sha)))
+        task = self.run_task(
+            'blaming %s' % sha[:7],
+            lambda cancelled: file_history.blame(sha, cancelled),
+        )
+        self._blame_task = (sha, lines, task)
+        return lines
+
+    def _cached_copies_blame(self):
+        # Returns the blame of the current revision that follows moved and
+        # copied lines, if it's ready. The caches are only asked once for
+        # each revision (and again whenever a search for copies finishes),
+        # since content is called a lot.
+        key = (self.file_history, self.file_history.current_commit.sha)
+        if self._copies_blame is None or self._copies_blame[0] != key:
+            self._copies_blame = (
+                key,
+                self.file_history.cached_blame(key[1], copies=True),
+            )
+        return self._copies_blame[1]
+
+    def _find_copies(self):
+        # The plain blame is shown first, since following moved and copied
+        # lines can take much longer. Once it's complete, the blame is run
+        # again in the background with copies followed, and shown in its
+        # place when it's done. Only the commits of the lines that changed
+        # are redrawn.
+        sha = self.file_history.current_commit.sha
+        if self._copies_task is not None:
+            if self._copies_task[0] == sha:
+                return
+            self._copies_task[1].cancel()
+            self._copies_task = None
+
+        if self._cached_copies_blame() is not None:
+            return
+
+        if self._stream_blame is not None and self._stream_blame.sha == sha:
+            if not self._stream_blame.complete:
+                return
+        elif self.file_history.cached_blame(sha) is None:
+            return
+
+        def done(blame):
+            self._copies_blame = None
+
+        file_history = self.file_history
+        task = self.run_task(
+            'finding copies in %s' % sha[:7],
+            lambda cancelled: file_history.blame(sha, cancelled, copies=True),
+            done,
+        )
+        self._copies_task = (sha, task)
+
+    def _draw(self):
+        super(GitBrowser, self)._draw()
+
+        if self._stream_blame is not None:
+            if not self._stream_blame.started:
+                self._stream_blame.start(first=self.visible_range())
+            else:
+                self._stream_blame.request(*self.visible_range())
+
+        if self.copies:
+            self._find_copies()
+
+    def idle(self):
+        if self.show_profile and time.time() - self._profile_drawn > 1:
+            self._draw()
+
+        if self.command_input.mode == 'open_file' and \
+           self.command_input.gather().strip() != self._picker_query:
+            self._draw()
+
+        if self.history_list is not None and self.history_list.updated():
+            self._draw()
+
+        if self._stream_blame is not None:
+            updated = self._stream_blame.updates()
+            if updated:
+                self._draw_status()
+                self._draw_lines(updated)
+
+            if self.copies and self._stream_blame.complete and \
+               self._stream_blame.sha == self.file_history.current_commit.sha:
+                self._find_copies()
+
+    def interrupt(self):
+        interrupted = super(GitBrowser, self).interrupt()
+        self._move_task = None
+
+        if self._stream_blame is not None and self._stream_blame.running:
+            self._stream_blame.cancel()
+            interrupted = True
+
+        if self.history_list is not None and self.history_list.running:
+            self.history_list.cancel()
+            interrupted = True
+
+        return interrupted
+
+    def textbox_command(self, textbox, c, prefix):
+        self._message = None
+        super(GitBrowser, self).textbox_command(textbox, c, prefix)
+
+    def row_state(self, line, highlight):
+        if self.search_term:
+            spans = tuple(self.search_index().spans(line.final_line - 1))
+        else:
+            spans = ()
+
+        gutter = (line.sha, line.current, highlight)
+        return gutter, (line.line, line.current, highlight, spans)
 
     def draw_content_line(self, line, row, window, highlight):
         if highlight:
@@ -35,56 +266,307 @@ class GitBrowser(ModalScrollingInterface):
             code_color = self.GREEN if line.current else 0
             search_result_color = self.INV_WHITE
 
-        window.addstr(row, 0, line.sha[:7], commit_color)
-        window.addstr(row, 7, '+ ' if line.current else '  ', code_color)
+        # Skip the parts of the row that haven't changed since it was last
+        # drawn (e.g. the text, when only the commit has been filled in).
+        gutter, text = self.row_state(line, highlight)
+        previous = self.previous_row_state() or (None, None)
+
+        if previous[0] != gutter:
+            if line.sha is None:
+                # The line hasn't been blamed yet
+                window.addstr(row, 0, '.' * 7, commit_color)
+            else:
+                window.addstr(row, 0, line.sha[:7], commit_color)
+            window.addstr(row, 7, '+ ' if line.current else '  ',
+                          code_color)
+
+        if previous[1] == text:
+            return
 
         cols = curses.COLS - 9
         padded_line = line.line[:cols].rstrip().ljust(cols, ' ')
         window.addstr(row, 9, padded_line, code_color)
 
         if self.search_term:
-            search_start = 0
-            try:
-                while True:
-                    index = line.line.index(self.search_term, search_start)
-                    search_start = index + len(self.search_term)
-                    window.addstr(row, 9+index, self.search_term,
-                                  search_result_color)
-            except ValueError:
-                pass
+            spans = text[3]
+            for start, end in spans:
+                if start >= cols:
+                    break
+                end = min(end, cols)
+                window.addstr(row, 9+start, line.line[start:end],
+                              search_result_color)
+
+    def search_index(self):
+        """
+        Returns the SearchIndex for the current search term in the current
+        revision, building it if the term or revision has changed.
+        """
+        key = (self.file_history.current_commit.sha, self.search_term,
+               self.regex, self.ignore_case)
+        if self._search_index is None or self._search_index[0] != key:
+            index = SearchIndex(self.content().lines(), self.search_term,
+                                regex=self.regex,
+                                ignore_case=self.ignore_case)
+            self._search_index = (key, index)
+
+        return self._search_index[1]
 
     def finalise(self, exit_key):
         if exit_key == ord('s'):
             current_sha = self.file_history.current_commit.sha
+            if self.before_exec is not None:
+                self.before_exec()
             os.execvp('git', ('git', 'show', current_sha))
 
     def handle_input(self, mode, data):
         if mode == 'search' or mode == 'reverse_search':
+            if self.regex:
+                try:
+                    re.compile(data)
+                except re.error:
+                    curses.beep()
+                    return
+
             self.search_term = data
             self.reverse_search = (mode == 'reverse_search')
             self.next_search_match()
             self._draw()
+        elif mode == 'history_search':
+            self._search_history(data)
+            self._draw()
+        elif mode == 'open_file':
+            self._open_file(data)
+            self._draw()
 
     def get_status(self):
-        return '%(path)s @ %(sha)s by %(author)s: %(message)s' % {
+        if self._message is not None:
+            return self._message
+
+        status = '%(path)s @ %(sha)s by %(author)s: %(message)s' % {
             'path': self.file_history.path,
             'sha': self.file_history.current_commit.sha[:7],
             'author': self.file_history.current_commit.author,
             'message': self.file_history.current_commit.message,
         }
 
-    def _move_commit(self, method_name):
-        start = self.file_history.current_commit.sha
+        histories = self.session.histories
+        if len(histories) > 1:
+            status = '[%d/%d] %s' % (
+                histories.index(self.file_history) + 1,
+                len(histories),
+                status,
+            )
+
+        if self.history_list is not None:
+            if isinstance(self.history_list, LineHistory):
+                label = 'line %d: ' % (self.history_list.line + 1)
+            else:
+                label = ''
+            status = '[%s%d revisions%s] %s' % (
+                label,
+                len(self.history_list.entries()),
+                ', searching' if self.history_list.running else '',
+                status,
+            )
+
+        if self._stream_blame is not None and self._stream_blame.running:
+            status = '[blaming %d%%] %s' % (
+                100 * self._stream_blame.blamed /
+                max(len(self._stream_blame.lines), 1),
+                status,
+            )
+
+        return status
+
+    def get_overlay(self, max_lines):
+        if self.command_input.mode == 'open_file':
+            return self._file_picker(max_lines)
+
+        if self.show_profile:
+            self._profile_drawn = time.time()
+            return profiler.summary()[:max_lines]
+
+        if not self.show_history or self.history_list is None:
+            return None
+
+        entries = self.history_list.entries()
+        if not entries:
+            return None
+
+        # Show the part of the list around the current revision.
+        current = self.file_history.index
+        position = len([i for i, _ in entries if i < current])
+        start = max(0, min(position - max_lines // 2,
+                           len(entries) - max_lines))
+
+        overlay = []
+        for index, change in entries[start:start + max_lines]:
+            commit = self.file_history.commits[index]
+            overlay.append('%s %s %s %s: %s' % (
+                '>' if index == current else ' ',
+                change or ' ',
+                commit.sha[:7],
+                commit.author,
+                commit.message,
+            ))
+        return overlay
+
+    def _search_history(self, pattern):
+        if self.history_list is not None:
+            self.history_list.cancel()
+
+        if not pattern:
+            self.history_list = None
+            self.show_history = False
+            return
+
+        if self.regex:
+            try:
+                re.compile(pattern)
+            except re.error:
+                curses.beep()
+                return
+
+        self.search_term = pattern
+        self.reverse_search = False
+        self.history_list = HistorySearch(self.file_history, pattern,
+                                          regex=self.regex,
+                                          ignore_case=self.ignore_case)
+        self.history_list.start()
+        self.show_history = True
+
+    @ModalScrollingInterface.key_bindings('L')
+    def show_line_history(self, times=None):
+        if self.history_list is not None:
+            self.history_list.cancel()
+
+        self.history_list = LineHistory(self.file_history,
+                                        self.highlight_line)
+        self.history_list.start()
+        self.show_history = True
+
+    def _move_to_history_entry(self, direction, times):
+        # Moves to the times-th revision in the history list in the given
+        # direction (1 is towards older revisions), carrying the highlighted
+        # line over and then, for a search, moving it to the nearest match.
+        if self.history_list is None:
+            curses.beep()
+            return
+
+        current = self._move_target()
+        indices = [i for i, _ in self.history_list.entries()]
+        if direction > 0:
+            candidates = [i for i in indices if i > current]
+        else:
+            candidates = [i for i in reversed(indices) if i < current]
 
-        method = getattr(self.file_history, method_name)
-        if not method():
+        if not candidates:
             curses.beep()
             return
 
-        finish = self.file_history.current_commit.sha
+        target = candidates[min(times, len(candidates)) - 1]
+        if isinstance(self.history_list, LineHistory):
+            self._move_commit(target - current)
+        else:
+            self._move_commit(target - current,
+                              then=self._nearest_search_match)
+
+    def _nearest_search_match(self):
+        # Moves the highlight to the closest match, unless it's on one.
+        index = self.search_index()
+        line = self.highlight_line
+        if index.spans(line):
+            return
+
+        after = index.next_match(line)
+        before = index.prev_match(line)
+        if after is None or (before is not None and
+                             line - before < after - line):
+            after = before
+        if after is not None:
+            self.highlight_line = after
 
-        mapping = self.file_history.line_mapping(start, finish)
-        new_highlight_line = mapping.get(self.highlight_line)
+    @ModalScrollingInterface.key_bindings('{')
+    def prev_history_match(self, times=1):
+        self._move_to_history_entry(1, times)
+
+    @ModalScrollingInterface.key_bindings('}')
+    def next_history_match(self, times=1):
+        self._move_to_history_entry(-1, times)
+
+    @ModalScrollingInterface.key_bindings('H')
+    def toggle_history_list(self, times=None):
+        if self.history_list is None:
+            curses.beep()
+            return
+
+        self.show_history = not self.show_history
+
+    @ModalScrollingInterface.key_bindings('P')
+    def toggle_profile(self, times=None):
+        self.show_profile = not self.show_profile
+
+    def _move_target(self):
+        # The index of the commit we're on, or on our way to.
+        if self._move_task is not None:
+            return self._move_task[1]
+        return self.file_history.index
+
+    def _move_commit(self, steps, then=None):
+        # Moves through history by the given number of commits (negative
+        # numbers move towards newer commits) in a single jump, so that only
+        # the revision we land on needs to be blamed. Finding the commit and
+        # mapping the highlighted line happen in a background task; a move
+        # made before that finishes replaces it, going on from its target.
+        # Once we've arrived, then is called (if given).
+        start = self.file_history.index
+        target = self._move_target() + steps
+        if self._move_task is not None:
+            self._move_task[0].cancel()
+
+        if self.prefetcher:
+            # Stop working on the revisions that won't be near the one we're
+            # going to, so the workers are free for it and its neighbours,
+            # but keep anything that is (such as its blame).
+            self.prefetcher.schedule(max(target, 0))
+
+        file_history = self.file_history
+        commits = file_history.commits
+
+        def work(cancelled):
+            finish = max(target, 0)
+            while finish > start and not commits.exists(finish):
+                finish -= 1
+
+            if finish != start and not cancelled():
+                # Get the mapping (and the blame, if it isn't going to be
+                # streamed) ready, so arriving is quick.
+                file_history.map_line(0, start, finish)
+                if not self.stream:
+                    file_history.blame(commits[finish].sha, cancelled)
+
+            return finish
+
+        def done(finish):
+            self._move_task = None
+            if finish != target:
+                curses.beep()
+
+            if finish != start:
+                self._arrive(start, finish)
+                if then is not None:
+                    then()
+
+            self._prefetch()
+
+        task = self.run_task('loading', work, done)
+        self._move_task = (task, target)
+
+    def _arrive(self, start, finish):
+        self.file_history.go_to(finish)
+
+        new_highlight_line = self.file_history.map_line(self.highlight_line,
+                                                        start, finish)
         if new_highlight_line is not None:
             self.highlight_line = new_highlight_line
         else:
@@ -95,47 +577,167 @@ class GitBrowser(ModalScrollingInterface):
 
     @ModalScrollingInterface.key_bindings(']')
     def next_commit(self, times=1):
-        for i in range(0,times):
-            self._move_commit('next')
+        self._move_commit(-times)
 
     @ModalScrollingInterface.key_bindings('[')
     def prev_commit(self, times=1):
-        for i in range(0,times):
-            self._move_commit('prev')
+        self._move_commit(times)
+
+    def _prefetch(self):
+        if self.prefetcher:
+            self.prefetcher.schedule()
+
+    def _file_picker(self, max_lines):
+        # The tracked files matching what has been typed so far, with the
+        # one return would open first. Open files are marked with a *.
+        query = self.command_input.gather().strip()
+        self._picker_query = query
+
+        matches = self._matching_files(query)
+        if not matches:
+            return ['  No tracked files match "%s"' % (query, )]
+
+        open_paths = set(h.path for h in self.session.histories)
+        return ['%s%s %s' % ('>' if i == 0 else ' ',
+                             '*' if path in open_paths else ' ',
+                             path)
+                for i, path in enumerate(matches[:max_lines])]
+
+    def _matching_files(self, query):
+        # Tracked files whose paths contain every word of the query,
+        # ignoring case. A path typed out in full comes first.
+        words = query.lower().split()
+        matches = [path for path in self.session.tracked_files()
+                   if all(word in path.lower() for word in words)]
+        matches.sort(key=lambda path: path != query)
+        return matches
+
+    def _open_file(self, query):
+        if not query:
+            return
+
+        # Paths that git isn't tracking in the working tree can still be
+        # opened by typing them out, if they exist at the commit.
+        matches = self._matching_files(query)
+        try:
+            file_history = self.session.open(matches[0] if matches
+                                             else query)
+        except ValueError as err:
+            curses.beep()
+            self._message = str(err)
+            return
+
+        self._switch_file(file_history)
+
+    @ModalScrollingInterface.key_bindings(')')
+    def next_file(self, times=1):
+        self._step_file(times)
+
+    @ModalScrollingInterface.key_bindings('(')
+    def prev_file(self, times=1):
+        self._step_file(-times)
+
+    def _step_file(self, steps):
+        histories = self.session.histories
+        if len(histories) == 1:
+            curses.beep()
+            return
+
+        position = histories.index(self.file_history) + steps
+        self._switch_file(histories[position % len(histories)])
+
+    @ModalScrollingInterface.key_bindings('x')
+    def close_file(self, times=None):
+        histories = self.session.histories
+        if len(histories) == 1:
+            curses.beep()
+            return
+
+        closing = self.file_history
+        position = histories.index(closing)
+        self._leave_file()
+
+        for work in (self._stream_blame, self.history_list):
+            if work is not None:
+                work.cancel()
+        if self._blame_task is not None:
+            self._blame_task[2].cancel()
+        if self._copies_task is not None:
+            self._copies_task[1].cancel()
+
+        self.session.close(closing)
+        self._enter_file(histories[min(position, len(histories) - 1)])
+        self._prefetch()
+
+    def _switch_file(self, file_history):
+        # Shows another open file, putting aside where we were in this one.
+        if file_history is self.file_history:
+            return
+
+        self._leave_file()
+        self._files_aside[self.file_history] = dict(
+            (name, getattr(self, name)) for name in self.file_attributes
+        )
+        self._enter_file(file_history)
+        self._prefetch()
+
+    def _leave_file(self):
+        # Stops the work that is only useful while this file is shown. Any
+        # blame that is streaming in carries on, ready for when we're back.
+        if self._move_task is not None:
+            self._move_task[0].cancel()
+            self._move_task = None
+
+        if self.prefetcher:
+            self.prefetcher.cancel()
+
+    def _enter_file(self, file_history):
+        attributes = self._files_aside.pop(file_history, None)
+        if attributes is None:
+            attributes = {
+                'file_history': file_history,
+                'chunked': (self.stream and file_history.blob_size() >
+                            self.chunked_blame_bytes),
+                '_stream_blame': None,
+                '_blame_task': None,
+                '_copies_task': None,
+                # A HistorySearch or LineHistory: The revisions that { and
+                # } move between, which H shows.
+                'history_list': None,
+                'show_history': False,
+                '_search_index': None,
+                'scroll_line': 0,
+                '_highlight_line': 0,
+            }
+
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+        if self.prefetcher:
+            self.prefetcher.file_history = file_history
+            self.prefetcher.blames = not self.chunked
 
     def _next_search_match(self, times=1):
         if not self.search_term:
             curses.beep()
             return
 
-        moved = False
-        for n in range(0,times):
-            possible_matches = self.content()[self.highlight_line + 1:]
-            for i, line in enumerate(possible_matches):
-                if self.search_term in line.line:
-                    self.highlight_line += i + 1
-                    moved = True
-                    break
-
-        if not moved:
+        line = self.search_index().next_match(self.highlight_line, times)
+        if line is None:
             curses.beep()
+        else:
+            self.highlight_line = line
 
     def _prev_search_match(self, times=1):
         if not self.search_term:
             curses.beep()
             return
 
-        moved = False
-        for n in range(0,times):
-            possible_matches = self.content()[:self.highlight_line]
-            for i, line in enumerate(reversed(possible_matches)):
-                if self.search_term in line.line:
-                    self.highlight_line -= i + 1
-                    moved = True
-                    break
-
-        if not moved:
+        line = self.search_index().prev_match(self.highlight_line, times)
+        if line is None:
             curses.beep()
+        else:
+            self.highlight_line = line
 
     @ModalScrollingInterface.key_bindings('n')
     def next_search_match(self, times=1):
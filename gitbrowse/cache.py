@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that discards the least recently used entries once
+    it goes over budget.
+
+    The budget can be given as a maximum number of entries, a maximum
+    number of bytes, or both. The cache doesn't try to measure objects
+    itself, so callers that want a byte budget should pass an estimate
+    of each value's size to put.
+
+    Lookups through get are counted in the hits and misses attributes,
+    which is useful for checking that the cache is doing its job.
+
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, marking it as recently used, or
+        default if there is nothing stored for key.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Returns the value stored for key, or default, without counting the
+        lookup or changing how recently the entry was used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def put(self, key, value, size=1):
+        """
+        Stores value under key. The size is the (estimated) number of bytes
+        the value takes up, and only matters if the cache has a byte budget.
+        """
+        with self._lock:
+            self.discard(key)
+            self._entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def discard(self, key):
+        """
+        Removes key from the cache, if it is there.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        # Always keep the newest entry, even if it's over budget on its own,
+        # so that the value that was just computed can be used.
+        while len(self._entries) > 1 and self._over_budget():
+            key, (value, size) = self._entries.popitem(last=False)
+            self.size -= size
+
+    def _over_budget(self):
+        if self.max_entries is not None and \
+           len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            return True
+        return False
@@ -0,0 +1,474 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from hashlib import sha1
+
+from gitbrowse.cache import LRUCache
+from gitbrowse.diskcache import (blame_kind, encode_blame, decode_blame,
+                                 encode_mappings, decode_mappings,
+                                 repository_path)
+from gitbrowse.git import git, git_popen
+
+
+# The default memory budget for the blames and mappings a daemon keeps.
+DEFAULT_DAEMON_BYTES = 256 * 1024 * 1024
+
+# How long (in seconds) a daemon waits without any clients before exiting.
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+# How long (in seconds) a client waits for a daemon it has started.
+STARTUP_TIMEOUT = 2.0
+
+
+def repository_daemon(disk_cache=None):
+    """
+    Returns a DaemonClient connected to the daemon for the repository we're
+    in, starting the daemon if it isn't running, or None if that can't be
+    done. The disk cache, if one is given, is passed on to the client.
+    """
+    output = git('rev-parse', '--absolute-git-dir', '--show-toplevel')
+    try:
+        git_dir, work_tree = output.splitlines()
+        path = socket_path(git_dir)
+    except (ValueError, OSError):
+        return None
+
+    client = DaemonClient.connect(path, work_tree, disk_cache)
+    if client is not None:
+        return client
+
+    start_daemon(path, git_dir, work_tree)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while client is None and time.time() < deadline:
+        time.sleep(0.01)
+        client = DaemonClient.connect(path, work_tree, disk_cache)
+    return client
+
+
+def socket_path(git_dir):
+    """
+    Returns the path of the socket of the daemon for a git directory. The
+    sockets are kept in a directory of the user's own, under the temporary
+    directory, since a path inside the repository could be too long for a
+    unix socket. Raises OSError if that directory isn't safe to use.
+    """
+    directory = os.path.join(tempfile.gettempdir(),
+                             'git-browse-%d' % os.getuid())
+    try:
+        os.mkdir(directory, 0700)
+    except OSError:
+        pass
+
+    info = os.lstat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0077:
+        raise OSError('%s is not private' % (directory, ))
+
+    digest = sha1(os.path.realpath(git_dir)).hexdigest()[:16]
+    return os.path.join(directory, digest + '.sock')
+
+
+def start_daemon(path, git_dir, work_tree):
+    """
+    Starts a daemon listening on path in the background. It carries on
+    after the process that started it has exited.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package] + filter(None, [env.get('PYTHONPATH')])
+    )
+
+    with open(os.devnull, 'r+') as devnull:
+        process = subprocess.Popen(
+            (sys.executable, '-m', 'gitbrowse.daemon', path, git_dir),
+            cwd=work_tree,
+            env=env,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+        )
+    # The daemon forks straight away, so this doesn't wait for long.
+    process.wait()
+
+
+class Daemon(object):
+    """
+    Keeps the blames, line mappings and file histories of one repository in
+    memory and serves them to git browse processes (see DaemonClient) over
+    a unix socket, so that each run doesn't have to work them out again.
+
+    Requests and responses are each a line of JSON, followed by the number
+    of bytes of data given by its "size" (if any):
+
+        {"op": "get", "key": [...]}     Returns the data stored for key,
+                                        with "found" set to whether there
+                                        was any.
+        {"op": "put", "key": [...]}     Stores the data for key. There is
+                                        no response.
+        {"op": "history", "rev": ...,   Returns the shas of the commits
+         "path": ...}                   that changed path, newest first, as
+                                        lines of data, with "found" set.
+
+    Blames and mappings are packed by the client (see gitbrowse.diskcache)
+    and keyed by commit and blob shas, so they never go out of date. File
+    histories are keyed by the name of the revision they start from, so
+    they are all dropped whenever a ref moves. The daemon works them out
+    itself, with git log, the first time they are asked for.
+
+    The daemon exits once it has had no clients for idle_timeout seconds.
+    """
+
+    # How often (in seconds) the daemon checks whether it has been idle.
+    poll_interval = 1.0
+
+    def __init__(self, path, git_dir, max_bytes=DEFAULT_DAEMON_BYTES,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.path = path
+        self.git_dir = git_dir
+        self.common_dir = os.path.abspath(
+            git('rev-parse', '--git-common-dir').strip(),
+        )
+        self.idle_timeout = idle_timeout
+
+        self.entries = LRUCache(max_bytes=max_bytes)
+        self.histories = LRUCache(max_entries=256)
+
+        self._lock = threading.Lock()
+        self._refs = self._refs_state()
+        self._generation = 0
+        self._loading = set()
+        self._clients = 0
+        self._last_active = time.time()
+        self._socket = None
+
+    def listen(self):
+        """
+        Starts listening on the socket, returning False (and doing nothing)
+        if another daemon is already listening there.
+        """
+        existing = _connect(self.path)
+        if existing is not None:
+            existing.close()
+            return False
+
+        try:
+            # Left behind by a daemon that didn't exit cleanly.
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        os.chmod(self.path, 0600)
+        self._socket.listen(16)
+        self._socket.settimeout(self.poll_interval)
+        return True
+
+    def serve(self):
+        """
+        Serves clients, each in a thread of its own, until the daemon has
+        been idle for too long. The socket is removed on the way out.
+        """
+        try:
+            while not self._idle():
+                try:
+                    connection, _ = self._socket.accept()
+                except socket.timeout:
+                    continue
+
+                connection.settimeout(None)
+                with self._lock:
+                    self._clients += 1
+
+                thread = threading.Thread(target=self._serve_client,
+                                          args=(connection, ))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self._socket.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _idle(self):
+        with self._lock:
+            return (self._clients == 0 and
+                    time.time() - self._last_active > self.idle_timeout)
+
+    def _serve_client(self, connection):
+        reader = connection.makefile('rb')
+        try:
+            while True:
+                request = _receive(reader)
+                if request is None:
+                    break
+
+                response = self._respond(*request)
+                if response is not None:
+                    _send(connection, *response)
+        except (socket.error, IOError, ValueError):
+            # The client has gone, or sent something we don't understand.
+            pass
+        finally:
+            reader.close()
+            connection.close()
+            with self._lock:
+                self._clients -= 1
+                self._last_active = time.time()
+
+    def _respond(self, request, data):
+        op = request.get('op')
+        if op == 'get':
+            value = self.entries.get(tuple(request['key']))
+            return {'found': value is not None}, value or ''
+        elif op == 'put':
+            self.entries.put(tuple(request['key']), data, len(data))
+            return None
+        elif op == 'history':
+            shas = self._history(request['rev'], request['path'])
+            return {'found': shas is not None}, '\n'.join(shas or [])
+        else:
+            return {'error': 'Unknown request: %s' % (op, )}, ''
+
+    def _history(self, rev, path):
+        # Returns the history of path from rev if we have it, or starts
+        # working it out for next time.
+        key = (rev, path)
+        with self._lock:
+            refs = self._refs_state()
+            if refs != self._refs:
+                self._refs = refs
+                self._generation += 1
+                self.histories.clear()
+
+            shas = self.histories.get(key)
+            if shas is None and key not in self._loading:
+                self._loading.add(key)
+                thread = threading.Thread(target=self._load_history,
+                                          args=(key, self._generation))
+                thread.daemon = True
+                thread.start()
+
+        return shas
+
+    def _load_history(self, key, generation):
+        rev, path = [part.encode('utf-8') for part in key]
+        with open(os.devnull, 'w') as devnull:
+            p = git_popen('log', rev, '--follow', '--format=%H', '--', path,
+                          stderr=devnull)
+            shas = p.communicate()[0].split()
+
+        with self._lock:
+            self._loading.discard(key)
+            # If a ref moved while git log ran, the history may already be
+            # out of date.
+            if p.returncode == 0 and shas and \
+               generation == self._generation:
+                self.histories.put(key, shas)
+
+    def _refs_state(self):
+        # Something that changes whenever a ref moves: Refs are written to
+        # a lock file that is renamed into place, which changes the
+        # directory it's in, and packing them rewrites packed-refs.
+        state = [_stat(os.path.join(self.git_dir, 'HEAD')),
+                 _stat(os.path.join(self.common_dir, 'packed-refs'))]
+        for directory, _, _ in os.walk(os.path.join(self.common_dir,
+                                                    'refs')):
+            state.append((directory, _stat(directory)))
+        return state
+
+
+class DaemonClient(object):
+    """
+    A connection to a Daemon, which can be used in place of a DiskCache
+    (see GitFileHistory): Blames and line mappings are read from and written
+    to the daemon, and so are shared with every other git browse process
+    working in the same repository, and so are file histories.
+
+    If a disk cache is given, results the daemon doesn't have are looked
+    for there too (and passed on to the daemon), and new results are written
+    to both. If the daemon goes away, the client carries on as if it had
+    nothing cached.
+    """
+
+    def __init__(self, connection, work_tree, disk_cache=None):
+        self.work_tree = work_tree
+        self.disk_cache = disk_cache
+        self._connection = connection
+        self._reader = connection.makefile('rb')
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, path, work_tree, disk_cache=None):
+        """
+        Returns a client connected to the daemon listening on path, or None
+        if there isn't one.
+        """
+        connection = _connect(path)
+        if connection is None:
+            return None
+        return cls(connection, work_tree, disk_cache)
+
+    def get_blame(self, commit, path, copies=False):
+        key = (blame_kind(copies), commit, self._repository_path(path))
+        data = self._get(*key)
+        if data is not None:
+            return decode_blame(data)
+
+        if self.disk_cache is None:
+            return None
+
+        lines = self.disk_cache.get_blame(commit, path, copies)
+        if lines is not None:
+            self._put(encode_blame(lines), *key)
+        return lines
+
+    def put_blame(self, commit, path, lines, copies=False):
+        self._put(encode_blame(lines), blame_kind(copies), commit,
+                  self._repository_path(path))
+        if self.disk_cache is not None:
+            self.disk_cache.put_blame(commit, path, lines, copies)
+
+    def get_mappings(self, start_blob, finish_blob):
+        data = self._get('mapping', start_blob, finish_blob)
+        if data is not None:
+            return decode_mappings(data)
+
+        data = self._get('mapping', finish_blob, start_blob)
+        if data is not None:
+            forward, backward = decode_mappings(data)
+            return backward, forward
+
+        if self.disk_cache is None:
+            return None
+
+        mappings = self.disk_cache.get_mappings(start_blob, finish_blob)
+        if mappings is not None:
+            self._put(encode_mappings(*mappings), 'mapping', start_blob,
+                      finish_blob)
+        return mappings
+
+    def put_mappings(self, start_blob, finish_blob, forward, backward):
+        self._put(encode_mappings(forward, backward), 'mapping', start_blob,
+                  finish_blob)
+        if self.disk_cache is not None:
+            self.disk_cache.put_mappings(start_blob, finish_blob, forward,
+                                         backward)
+
+    def get_history(self, rev, path):
+        """
+        Returns the shas of the commits that changed path, starting from
+        rev, newest first, or None if the daemon doesn't know them yet (in
+        which case it starts working them out).
+        """
+        response = self._request({
+            'op': 'history',
+            'rev': rev,
+            'path': os.path.abspath(path),
+        })
+        if response is None or not response[0].get('found'):
+            return None
+        return response[1].split('\n')
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._disconnect()
+
+    def _repository_path(self, path):
+        # Paths are given relative to the working directory, which other
+        # clients may not share.
+        return repository_path(path, self.work_tree)
+
+    def _get(self, *key):
+        response = self._request({'op': 'get', 'key': key})
+        if response is None or not response[0].get('found'):
+            return None
+        return response[1]
+
+    def _put(self, data, *key):
+        self._request({'op': 'put', 'key': key}, data, reply=False)
+
+    def _request(self, request, data='', reply=True):
+        with self._lock:
+            if self._connection is None:
+                return None
+
+            try:
+                _send(self._connection, request, data)
+                if reply:
+                    return _receive(self._reader)
+            except (socket.error, IOError, ValueError):
+                # The daemon has gone away. The cache is only an
+                # optimisation, so we carry on without it.
+                self._disconnect()
+            return None
+
+    def _disconnect(self):
+        self._reader.close()
+        self._connection.close()
+        self._connection = None
+
+
+def _connect(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+
+def _send(connection, header, data=''):
+    header = dict(header, size=len(data))
+    connection.sendall(json.dumps(header) + '\n' + data)
+
+
+def _receive(reader):
+    # Returns the next (header, data) pair, or None at the end of the
+    # stream.
+    line = reader.readline()
+    if not line:
+        return None
+
+    header = json.loads(line)
+    size = header.get('size', 0)
+    data = reader.read(size) if size else ''
+    if len(data) < size:
+        return None
+    return header, data
+
+
+def _stat(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_ino, info.st_mtime, info.st_size
+
+
+def main():
+    path, git_dir = sys.argv[1:3]
+
+    # Carry on in the background, in a session of our own, so that the
+    # client that started us isn't kept waiting and doesn't take us with it
+    # when it exits.
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+
+    daemon = Daemon(path, git_dir)
+    if daemon.listen():
+        daemon.serve()
+
+
+if __name__ == '__main__':
+    main()
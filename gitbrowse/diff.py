@@ -0,0 +1,275 @@
+from bisect import bisect_left
+from math import sqrt
+
+
+# The least effort (in edits from each end) spent on diffing a range of
+# lines before it is treated as one replaced block.
+_MIN_COST = 256
+
+
+def matching_lines(a, b):
+    """
+    Compares two lists of lines and returns a list of (i, j) pairs, in
+    increasing order, meaning that a[i] and b[j] are the same line. Lines
+    that don't appear in any pair have been removed from a or added to b.
+
+    Lines that appear exactly once in both lists are used to split the
+    problem up (as in patience diff), and the gaps between them are diffed
+    with Myers' algorithm, which keeps the cost down for large files with
+    scattered changes.
+    """
+    # Comparing small integers is quicker than comparing strings.
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+
+    matches = []
+    _match(a, 0, len(a), b, 0, len(b), matches)
+    return matches
+
+
+def line_mappings(a, b):
+    """
+    Compares two lists of lines and returns a (forward, backward) pair of
+    dicts mapping line indices in a to line indices in b and vice versa.
+
+    Lines that were removed (from the forward point of view) or added (from
+    the backward point of view) map to None, except that where a block of
+    lines has been replaced by another block, the lines are paired up in
+    order, on the basis that they are probably edited versions of each
+    other. Both mappings include an extra entry mapping the line just past
+    the end of one file to the line just past the end of the other.
+    """
+    return mappings_from_matches(matching_lines(a, b), len(a), len(b))
+
+
+def refine_matches(a, b, anchors):
+    """
+    Takes a list of (i, j) pairs of lines already known to match between
+    a and b, in increasing order, and returns it with any further matches
+    found by diffing the gaps between them added.
+    """
+    matches = []
+    i = j = 0
+    for next_i, next_j in anchors + [(len(a), len(b))]:
+        if i < next_i and j < next_j:
+            matches.extend(
+                (i + gap_i, j + gap_j)
+                for gap_i, gap_j in matching_lines(a[i:next_i], b[j:next_j])
+            )
+        matches.append((next_i, next_j))
+        i, j = next_i + 1, next_j + 1
+
+    return matches[:-1]
+
+
+def mappings_from_matches(matches, a_len, b_len):
+    """
+    Builds the (forward, backward) mappings described in line_mappings from
+    a list of matching (i, j) pairs, as returned by matching_lines, and the
+    lengths of the two files.
+    """
+    forward = {}
+    backward = {}
+
+    def pair(i, j):
+        forward[i] = j
+        backward[j] = i
+
+    i = j = 0
+    for next_i, next_j in matches + [(a_len, b_len)]:
+        # Between matches there are some removed lines (i to next_i) and
+        # some added lines (j to next_j).
+        changed = min(next_i - i, next_j - j)
+        for offset in range(changed):
+            pair(i + offset, j + offset)
+        for removed in range(i + changed, next_i):
+            forward[removed] = None
+        for added in range(j + changed, next_j):
+            backward[added] = None
+
+        pair(next_i, next_j)
+        i, j = next_i + 1, next_j + 1
+
+    return forward, backward
+
+
+def _match(a, a_lo, a_hi, b, b_lo, b_hi, matches):
+    # Finds matching lines between a[a_lo:a_hi] and b[b_lo:b_hi], appending
+    # them to matches in order.
+
+    # Matching lines at the start and end are easy.
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        matches.append((a_lo, b_lo))
+        a_lo += 1
+        b_lo += 1
+
+    suffix = []
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+        suffix.append((a_hi, b_hi))
+
+    if a_lo < a_hi and b_lo < b_hi:
+        anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+        if anchors:
+            for i, j in anchors:
+                _match(a, a_lo, i, b, b_lo, j, matches)
+                matches.append((i, j))
+                a_lo, b_lo = i + 1, j + 1
+            _match(a, a_lo, a_hi, b, b_lo, b_hi, matches)
+        else:
+            matches.extend(_myers(a, a_lo, a_hi, b, b_lo, b_hi))
+
+    matches.extend(reversed(suffix))
+
+
+def _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi):
+    # Returns the longest increasing sequence of (i, j) pairs of lines that
+    # appear exactly once in each range.
+    counts = {}
+    for i in range(a_lo, a_hi):
+        count, _ = counts.get(a[i], (0, None))
+        counts[a[i]] = (count + 1, i)
+
+    b_counts = {}
+    for j in range(b_lo, b_hi):
+        if counts.get(b[j], (0, ))[0] == 1:
+            count, _ = b_counts.get(b[j], (0, None))
+            b_counts[b[j]] = (count + 1, j)
+
+    pairs = sorted(
+        (counts[line][1], j)
+        for line, (count, j) in b_counts.items()
+        if count == 1
+    )
+    if not pairs:
+        return []
+
+    # Patience sort to find the longest increasing run of j values.
+    tails = []
+    tail_indices = []
+    previous = [None] * len(pairs)
+    for index, (i, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos > 0:
+            previous[index] = tail_indices[pos - 1]
+        if pos == len(tails):
+            tails.append(j)
+            tail_indices.append(index)
+        else:
+            tails[pos] = j
+            tail_indices[pos] = index
+
+    anchors = []
+    index = tail_indices[-1]
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _myers(a, a_lo, a_hi, b, b_lo, b_hi, max_cost=None):
+    # Myers' O(ND) algorithm, in its linear space form: Finds the shortest
+    # edit script between the two ranges by splitting them at the middle
+    # snake of the edit graph and recursing on the halves, and returns the
+    # matching lines along it.
+    #
+    # Very different ranges (e.g. a file that has been rewritten) would
+    # still take time proportional to the square of their size, so like git
+    # we give up once the edit script is known to be longer than max_cost,
+    # and treat what's left of the range as one replaced block.
+    if max_cost is None:
+        max_cost = max(_MIN_COST, int(sqrt(a_hi - a_lo + b_hi - b_lo)))
+
+    matches = []
+    _myers_split(a, a_lo, a_hi, b, b_lo, b_hi, max_cost, matches)
+    return matches
+
+
+def _myers_split(a, a_lo, a_hi, b, b_lo, b_hi, max_cost, matches):
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        matches.append((a_lo, b_lo))
+        a_lo += 1
+        b_lo += 1
+
+    suffix = []
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+        suffix.append((a_hi, b_hi))
+
+    # With the ends trimmed, both ranges being non-empty means at least
+    # two edits, so both halves are smaller problems than the whole.
+    if a_lo < a_hi and b_lo < b_hi:
+        snake = _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi, max_cost)
+        if snake is not None:
+            x, y, u, v = snake
+            _myers_split(a, a_lo, a_lo + x, b, b_lo, b_lo + y, max_cost,
+                         matches)
+            matches.extend((a_lo + i, b_lo + y + i - x)
+                           for i in range(x, u))
+            _myers_split(a, a_lo + u, a_hi, b, b_lo + v, b_hi, max_cost,
+                         matches)
+
+    matches.extend(reversed(suffix))
+
+
+def _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi, max_cost):
+    # Searches the edit graph from both ends at once until the two searches
+    # overlap, and returns the (x, y, u, v) start and end (relative to the
+    # ranges) of the snake where they met, which is in the middle of a
+    # shortest edit script. Returns None if that takes more than max_cost
+    # steps from each end.
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 == 1
+
+    # The furthest x reached on each diagonal k (where k = x - y). The
+    # backward search works from the ends of the ranges, so its x and y
+    # count back from n and m.
+    forward = {1: 0}
+    backward = {1: 0}
+
+    for d in range((n + m + 1) // 2 + 1):
+        if d > max_cost:
+            return None
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+
+            if odd and -(d - 1) <= delta - k <= d - 1 and \
+               x + backward[delta - k] >= n:
+                return start_x, start_y, x, y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+
+            start_x, start_y = x, y
+            while x < n and y < m and \
+                  a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+
+            if not odd and -d <= delta - k <= d and \
+               x + forward[delta - k] >= n:
+                return n - x, m - y, n - start_x, m - start_y
+
+    return None
@@ -0,0 +1,305 @@
+import os
+import struct
+import tempfile
+import zlib
+from binascii import hexlify, unhexlify
+from hashlib import sha1
+
+from gitbrowse.git import git
+
+
+# The default size limit for the cache directory.
+DEFAULT_DISK_CACHE_BYTES = 256 * 1024 * 1024
+
+# Stands in for None in stored line mappings.
+_NO_LINE = 0xffffffff
+
+
+def repository_disk_cache(max_bytes=DEFAULT_DISK_CACHE_BYTES):
+    """
+    Returns a DiskCache stored in the git directory of the repository we're
+    in. Worktrees of the same repository share a cache.
+    """
+    output = git('rev-parse', '--git-common-dir', '--show-toplevel')
+    lines = output.splitlines()
+    git_dir = lines[0]
+    work_tree = lines[1] if len(lines) > 1 else None
+    return DiskCache(os.path.join(git_dir, 'git-browse-cache'), max_bytes,
+                     work_tree)
+
+
+def repository_path(path, work_tree):
+    """
+    Returns path, which is relative to the working directory, relative to
+    the top of work_tree instead, so that it names the same file wherever
+    it's used from.
+    """
+    return os.path.relpath(os.path.abspath(path), work_tree)
+
+
+class DiskCache(object):
+    """
+    Keeps blame results and line mappings on disk between runs, usually in
+    $GIT_DIR/git-browse-cache, so that revisions we've looked at before
+    don't need to be worked out again.
+
+    Blames are stored by commit and path, and mappings by the pair of blob
+    ids being compared (so they are shared by every commit pair that has
+    the same two versions of a file). Each entry is a small zlib-compressed
+    file. Paths are given relative to the working directory, and if a
+    work_tree is given they are stored relative to the top of it, so that
+    runs from different directories agree on which file is which.
+
+    Several processes can use the same cache at once: Entries are written
+    to a temporary file and renamed into place, so readers never see half
+    an entry. When the directory grows past max_bytes the least recently
+    used entries are deleted.
+    """
+
+    # How many entries are written between checks of the cache size.
+    eviction_interval = 64
+
+    def __init__(self, path, max_bytes=DEFAULT_DISK_CACHE_BYTES,
+                 work_tree=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.work_tree = work_tree
+        self._puts = 0
+
+    def get_blame(self, commit, path, copies=False):
+        """
+        Returns the stored blame of path at commit as a list of
+        (sha, original_line, text) tuples, or None if it isn't stored.
+        Blames that follow moved and copied lines (see GitFileHistory.blame)
+        are stored apart from plain ones.
+        """
+        data = self._read(blame_kind(copies), commit,
+                          self._repository_path(path))
+        return None if data is None else decode_blame(data)
+
+    def put_blame(self, commit, path, lines, copies=False):
+        """
+        Stores the blame of path at commit, given as a list of
+        (sha, original_line, text) tuples.
+        """
+        self._write(encode_blame(lines), blame_kind(copies), commit,
+                    self._repository_path(path))
+
+    def get_mappings(self, start_blob, finish_blob):
+        """
+        Returns the stored (forward, backward) line mappings between two
+        blobs, or None if they aren't stored.
+        """
+        data = self._read('mapping', start_blob, finish_blob)
+        if data is not None:
+            return decode_mappings(data)
+
+        data = self._read('mapping', finish_blob, start_blob)
+        if data is not None:
+            forward, backward = decode_mappings(data)
+            return backward, forward
+
+        return None
+
+    def put_mappings(self, start_blob, finish_blob, forward, backward):
+        """
+        Stores the line mappings between two blobs, as returned by
+        gitbrowse.diff.line_mappings.
+        """
+        self._write(encode_mappings(forward, backward), 'mapping',
+                    start_blob, finish_blob)
+
+    def get_history(self, rev, path):
+        """
+        Histories aren't kept on disk, since which commits they start from
+        depends on where the refs point (see gitbrowse.daemon), so this
+        always returns None.
+        """
+        return None
+
+    def _repository_path(self, path):
+        # Paths are given relative to the working directory, which changes
+        # from one run to the next.
+        if self.work_tree is None:
+            return path
+        return repository_path(path, self.work_tree)
+
+    def _entry_path(self, kind, *key):
+        digest = sha1('\0'.join((kind, ) + key)).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def _read(self, kind, *key):
+        path = self._entry_path(kind, *key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            # Mark the entry as recently used, for eviction. If it has just
+            # been evicted, or the cache is read-only, we still have it.
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            return None
+
+    def _write(self, data, kind, *key):
+        path = self._entry_path(kind, *key)
+        directory = os.path.dirname(path)
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+        except (IOError, OSError):
+            # Another process may have made the directory, or beaten us to
+            # writing the entry. Either way, the cache is only an
+            # optimisation and failing to write to it isn't worth reporting.
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            # Don't leave a partial entry behind, e.g. if the disk is full.
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+
+        self._puts += 1
+        if self._puts % self.eviction_interval == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache is back
+        under its size limit (with some room to spare, so that we don't
+        have to do this again straight away).
+        """
+        entries = []
+        total = 0
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        target = self.max_bytes * 0.8
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def blame_kind(copies):
+    """
+    Returns the kind of entry a blame is stored as, which depends on whether
+    it follows moved and copied lines.
+    """
+    return 'copies blame' if copies else 'blame'
+
+
+def encode_blame(lines):
+    """
+    Packs a blame, given as a list of (sha, original_line, text) tuples,
+    into a string.
+    """
+    shas = []
+    commit_indices = {}
+    indices = []
+    for sha, _, _ in lines:
+        if sha not in commit_indices:
+            commit_indices[sha] = len(shas)
+            shas.append(sha)
+        indices.append(commit_indices[sha])
+
+    count = len(lines)
+    return ''.join([
+        struct.pack('<II', len(shas), count),
+        ''.join(unhexlify(sha) for sha in shas),
+        struct.pack('<%dI' % count, *indices),
+        struct.pack('<%dI' % count, *[int(l[1]) for l in lines]),
+        struct.pack('<%dI' % count, *[len(l[2]) for l in lines]),
+        ''.join(l[2] for l in lines),
+    ])
+
+
+def decode_blame(data):
+    """
+    Unpacks a string made by encode_blame.
+    """
+    commit_count, line_count = struct.unpack_from('<II', data)
+    offset = 8
+
+    shas = []
+    for _ in range(commit_count):
+        shas.append(hexlify(data[offset:offset + 20]))
+        offset += 20
+
+    columns = []
+    for _ in range(3):
+        columns.append(struct.unpack_from('<%dI' % line_count, data, offset))
+        offset += 4 * line_count
+
+    lines = []
+    for commit_index, original_line, length in zip(*columns):
+        lines.append((
+            shas[commit_index],
+            original_line,
+            data[offset:offset + length],
+        ))
+        offset += length
+
+    return lines
+
+
+def encode_mappings(forward, backward):
+    """
+    Packs a pair of line mappings, as returned by
+    gitbrowse.diff.line_mappings, into a string.
+    """
+    data = []
+    for mapping in (forward, backward):
+        values = [_NO_LINE if mapping[i] is None else mapping[i]
+                  for i in range(len(mapping))]
+        data.append(struct.pack('<I', len(values)))
+        data.append(struct.pack('<%dI' % len(values), *values))
+    return ''.join(data)
+
+
+def decode_mappings(data):
+    """
+    Unpacks a string made by encode_mappings.
+    """
+    mappings = []
+    offset = 0
+    for _ in range(2):
+        count, = struct.unpack_from('<I', data, offset)
+        values = struct.unpack_from('<%dI' % count, data, offset + 4)
+        offset += 4 + 4 * count
+        mappings.append(dict(
+            (i, None if v == _NO_LINE else v)
+            for i, v in enumerate(values)
+        ))
+    return tuple(mappings)
@@ -1,20 +1,229 @@
+import atexit
+from array import array
 import os
+import subprocess
+import threading
+import time
+
+from gitbrowse import diff
+from gitbrowse.cache import LRUCache
+from gitbrowse.profiling import profiler
+
+
+# The default memory budget for cached blames and line mappings.
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# How often (in seconds) a running git command checks whether it has been
+# cancelled.
+CANCEL_POLL_INTERVAL = 0.02
 
 
 class GitCommit(object):
     """
     Stores simple information about a single Git commit.
+
+    The author and message can be left out if a store is given, in which
+    case they are read from the commit object the first time they're used.
+    This means we only pay for the metadata of commits that are shown.
     """
-    def __init__(self, sha, author, message):
+    __slots__ = ('sha', '_author', '_message', '_store')
+
+    def __init__(self, sha, author=None, message=None, store=None):
         self.sha = sha
-        self.author = author
-        self.message = message
+        self._author = author
+        self._message = message
+        self._store = store
+
+    @property
+    def author(self):
+        if self._author is None:
+            self._load()
+        return self._author
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._load()
+        return self._message
+
+    def _load(self):
+        data = self._store.read(self.sha) or ''
+        headers, _, body = data.partition('\n\n')
+
+        for header in headers.split('\n'):
+            if header.startswith('author '):
+                # Format: author Name <email> timestamp timezone
+                self._author = header[7:].rsplit(' <', 1)[0]
+                break
+        else:
+            self._author = ''
+
+        # Like git's %s placeholder, the subject is the first paragraph of
+        # the message joined into a single line.
+        subject = body.strip('\n').split('\n\n', 1)[0]
+        self._message = ' '.join(subject.split('\n')).strip()
+
+
+class GitCommitList(object):
+    """
+    The list of commits that touched a file, newest first, read lazily from
+    `git log --follow`.
+
+    Commits are read from git as they are needed, so there's no need to wait
+    for the whole history of a file before showing the latest revision.
+    Whenever a commit near the end of what has been read is used, the next
+    page of history is read in the background.
+
+    Indexing and iteration work like they do for a list. Taking the length
+    of the list means reading the whole history, so prefer exists where
+    possible.
+
+    If a dict of known commits (keyed by sha) is given, it is shared with
+    other lists: Commits already in it are reused rather than created
+    again, so the metadata of a commit is only read once however many
+    files it touched.
+
+    If the shas of the whole history are already known (e.g. from
+    gitbrowse.daemon) they can be given instead, and git log isn't run.
+    """
+
+    def __init__(self, start_commit, path, store, page_size=100,
+                 known_commits=None, shas=None):
+        self.store = store
+        self.page_size = page_size
+        self.complete = False
+        self.known_commits = {} if known_commits is None else known_commits
+
+        self._commits = []
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._loading = False
+
+        if shas is not None:
+            for sha in shas:
+                self._add(sha)
+            self.complete = True
+            self._process = None
+        else:
+            self._process = git_popen(
+                'log', start_commit, '--follow', '--format=%H', '--', path,
+            )
+
+    def __getitem__(self, index):
+        if index < 0:
+            self._load_all()
+        else:
+            self._ensure(index)
+            self._load_ahead(index)
+
+        return self._commits[index]
+
+    def __iter__(self):
+        index = 0
+        while self.exists(index):
+            yield self[index]
+            index += 1
+
+    def __len__(self):
+        self._load_all()
+        return len(self._commits)
+
+    @property
+    def loaded(self):
+        """
+        The number of commits read so far.
+        """
+        return len(self._commits)
+
+    def exists(self, index):
+        """
+        Returns True if there is a commit at the given (non-negative) index,
+        reading more of the history if needed to find out.
+        """
+        self._ensure(index)
+        return index < len(self._commits)
+
+    def index(self, sha):
+        """
+        Returns the index of the commit with the given (full) sha, reading
+        more of the history if needed to find it, or None if it isn't in
+        the history.
+        """
+        while sha not in self._positions and not self.complete:
+            self._read(self.page_size)
+        return self._positions.get(sha)
+
+    def close(self):
+        """
+        Stops reading the history, leaving the commits read so far.
+        """
+        with self._lock:
+            if not self.complete:
+                self.complete = True
+                self._process.kill()
+                self._process.wait()
+
+    def _ensure(self, index):
+        # Reads commits until the given index is available or the history
+        # runs out.
+        while len(self._commits) <= index and not self.complete:
+            self._read(index + 1 - len(self._commits))
+
+    def _load_all(self):
+        while not self.complete:
+            self._read(self.page_size)
+
+    def _load_ahead(self, index):
+        if self.complete or self._loading or \
+           index < len(self._commits) - self.page_size // 2:
+            return
+
+        self._loading = True
+
+        def load():
+            try:
+                self._read(self.page_size)
+            finally:
+                self._loading = False
+
+        thread = threading.Thread(target=load)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self, count):
+        with self._lock:
+            for _ in range(count):
+                if self.complete:
+                    break
+
+                with profiler.measure('git log') as m:
+                    sha = self._process.stdout.readline()
+                    m.bytes += len(sha)
+                sha = sha.strip()
+                if not sha:
+                    self.complete = True
+                    self._process.wait()
+                    break
+
+                self._add(sha)
+
+    def _add(self, sha):
+        commit = self.known_commits.get(sha)
+        if commit is None:
+            commit = self.known_commits.setdefault(
+                sha, GitCommit(sha, store=self.store),
+            )
+
+        self._positions[sha] = len(self._commits)
+        self._commits.append(commit)
 
 
 class GitBlameLine(object):
     """
     Stores the blame output for a single line of a file.
     """
+    __slots__ = ('sha', 'line', 'current', 'original_line', 'final_line')
+
     def __init__(self, sha, line, current, original_line, final_line):
         self.sha = sha
         self.line = line
@@ -23,6 +232,135 @@ class GitBlameLine(object):
         self.final_line = final_line
 
 
+class GitBlame(object):
+    """
+    Stores the blame output for a whole file at one commit in a compact,
+    columnar form: The commit each line came from is an index into a small
+    table of (interned) shas, line numbers are kept in arrays of ints, and
+    the text of the file is kept in a single string with an array of offsets
+    to the start of each line.
+
+    Indexing a GitBlame (or iterating over it) gives GitBlameLine objects,
+    which are built on demand, so code that only looks at the visible lines
+    doesn't pay for the rest. The sha, line, original_line and current
+    methods read a single field without building a GitBlameLine.
+
+    Lines that haven't been blamed yet (see StreamingBlame) have a sha and
+    original line of None. The final_line of each GitBlameLine is its
+    1-based position in the file.
+    """
+
+    def __init__(self, commit_sha, text):
+        self.commit_sha = commit_sha
+        self._text = text
+
+        # A running total is much quicker than indexing the array for every
+        # line, which matters for files with hundreds of thousands of them.
+        offsets = [0]
+        append = offsets.append
+        total = 0
+        for line in text.split('\n'):
+            total += len(line) + 1
+            append(total)
+        if text.endswith('\n') or not text:
+            offsets.pop()
+        else:
+            offsets[-1] -= 1
+        self._offsets = array('l', offsets)
+
+        count = len(offsets) - 1
+        self._commits = []
+        self._commit_indices = {}
+        self._commit = array('l', [-1]) * count
+        self._original_line = array('l', [-1]) * count
+
+    @classmethod
+    def from_rows(cls, commit_sha, rows):
+        """
+        Builds a GitBlame from a list of (sha, original_line, text) tuples,
+        one for each line of the file.
+        """
+        blame = cls(commit_sha, ''.join(row[2] for row in rows))
+        for i, (sha, original_line, _) in enumerate(rows):
+            blame.set(i, sha, original_line)
+        return blame
+
+    def __len__(self):
+        return len(self._commit)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('blame line out of range')
+
+        return GitBlameLine(
+            sha=self.sha(index),
+            line=self.line(index),
+            current=self.current(index),
+            original_line=self.original_line(index),
+            final_line=index + 1,
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sha(self, index):
+        commit = self._commit[index]
+        return None if commit < 0 else self._commits[commit]
+
+    def line(self, index):
+        return self._text[self._offsets[index]:self._offsets[index + 1]]
+
+    def lines(self):
+        """
+        Returns the text of every line, as a list of strings.
+        """
+        return split_lines(self._text)
+
+    def original_line(self, index):
+        original_line = self._original_line[index]
+        return None if original_line < 0 else original_line
+
+    def current(self, index):
+        return self.sha(index) == self.commit_sha
+
+    def is_blamed(self, index):
+        return self._commit[index] >= 0
+
+    def rows(self):
+        """
+        Returns a list of (sha, original_line, text) tuples, the inverse of
+        from_rows.
+        """
+        return [(self.sha(i), self.original_line(i), self.line(i))
+                for i in range(len(self))]
+
+    def set(self, index, sha, original_line):
+        """
+        Records that the line at index came from original_line of the file
+        at the commit sha.
+        """
+        commit = self._commit_indices.get(sha)
+        if commit is None:
+            commit = len(self._commits)
+            self._commits.append(intern(sha))
+            self._commit_indices[sha] = commit
+
+        self._original_line[index] = original_line
+        self._commit[index] = commit
+
+    def size(self):
+        """
+        Returns an estimate of the memory used by this blame, in bytes.
+        """
+        return len(self._text) + 3 * 8 * len(self) + 100 * len(self._commits)
+
+
 class GitFileHistory(object):
     """
     Responsible for following the history of a single file, moving around
@@ -32,36 +370,79 @@ class GitFileHistory(object):
     Most operations are relative to the current commit, which can be changed
     with the previous and next mthods and accessed through the current_commit
     property.
+
+    Blame results and line mappings are kept in an LRUCache, so moving back
+    to a revision we've already seen is cheap. Pass a cache to share it
+    between several histories or to give it a different budget. If a
+    DiskCache is given, results are also kept on disk for later runs. A
+    DaemonClient (see gitbrowse.daemon) can be given in its place, to keep
+    them, and the list of commits, in a long-running process instead.
+    Several histories can also share their commits (see GitCommitList).
     """
 
-    def __init__(self, path, start_commit):
-        if not verify_revision(start_commit):
+    def __init__(self, path, start_commit, cache=None, disk_cache=None,
+                 known_commits=None):
+        self.path = path
+        self.store = object_store()
+        self.store.start()
+
+        shas = None
+        if disk_cache is not None:
+            shas = disk_cache.get_history(start_commit, path)
+
+        # The log is started straight away (unless the history is already
+        # known), so that git is already looking for the first commit while
+        # we check the revision and path.
+        self.commits = GitCommitList(start_commit, self.path, self.store,
+                                     known_commits=known_commits, shas=shas)
+        self._index = 0
+
+        commit, blob = self.store.info_many([
+            start_commit + '^{commit}',
+            self.blob_name(start_commit),
+        ])
+        # A directory has a tree where the file's blob would be.
+        tracked = blob is not None and blob[1] == 'blob'
+        if commit is None or not tracked:
+            self.commits.close()
+        if commit is None:
             raise ValueError('%s is not a valid commit, branch, tag, etc.' % (
                 start_commit,
             ))
+        if not tracked:
+            raise ValueError('"%s" is not tracked by git at %s' % (
+                path, start_commit,
+            ))
 
-        if not verify_file(path):
-            raise ValueError('"%s" is not tracked by git' % (path, ))
-
-        self.path = path
-
-        p = os.popen('git log %s --follow --pretty="%s" -- %s' % (
-            start_commit,
-            '%H%n%an%n%s%n',
-            self.path,
-        ))
-        output = p.read().split('\n\n')
+        if cache is None:
+            cache = LRUCache(max_bytes=DEFAULT_CACHE_BYTES)
+        self.cache = cache
+        self.disk_cache = disk_cache
 
-        self.commits = [GitCommit(*c.split('\n', 2)) for c in output if c]
-        self._index = 0
-        self._blame = None
+        # Locks for cache keys that are being computed, so that two threads
+        # asking for the same blame don't both run git blame.
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
 
-        self._line_mappings = {}
+    def close(self):
+        """
+        Stops reading the history of the file, for when it is no longer
+        being looked at.
+        """
+        self.commits.close()
 
     @property
     def current_commit(self):
         return self.commits[self._index]
 
+    @property
+    def index(self):
+        """
+        The position of the current commit in the commits list. The newest
+        commit is at index 0.
+        """
+        return self._index
+
     def next(self):
         """
         Moves to the next commit that touched this file, returning False
@@ -71,7 +452,6 @@ class GitFileHistory(object):
             return False
 
         self._index -= 1
-        self._blame = None
         return True
 
     def prev(self):
@@ -79,54 +459,188 @@ class GitFileHistory(object):
         Moves to the previous commit that touched this file, returning False
         if we're already at the first commit that touched the file.
         """
-        if self._index >= len(self.commits) - 1:
+        if not self.commits.exists(self._index + 1):
             return False
 
         self._index += 1
-        self._blame = None
         return True
 
-    def blame(self):
+    def go_to(self, index):
         """
-        Returns blame information for this file at the current commit as
-        a list of GitBlameLine objects.
+        Moves straight to the commit at the given index in the commits list,
+        returning False (and staying put) if there is no such commit.
         """
-        if self._blame:
-            return self._blame
+        if index < 0 or not self.commits.exists(index):
+            return False
 
-        lines = []
+        self._index = index
+        return True
 
-        p = os.popen('git blame -p %s %s' % (
-            self.path,
-            self.current_commit.sha,
-        ))
+    @profiler.timed('blame')
+    def blame(self, sha=None, cancelled=None, copies=False):
+        """
+        Returns blame information for this file at the given commit (by
+        default the current commit) as a GitBlame.
 
-        while True:
-            header = p.readline()
-            if not header:
-                break
+        If a cancelled function is given it is polled while git blame runs,
+        and if it returns True the blame is abandoned and None is returned.
 
-            # Header format:
-            # commit_sha original_line final_line[ lines_in_group]
-            sha, original_line, final_line = header.split(' ')[:3]
+        If copies is True, lines that were moved or copied from elsewhere
+        (in this file or another one changed by the same commit) are traced
+        back to where they came from, with `git blame -M -C`. This can take
+        much longer, and the original line of such a line is its number in
+        the file it came from. Both kinds of blame are cached separately.
+        """
+        if sha is None:
+            sha = self.current_commit.sha
 
-            line = p.readline()
+        return self._cached(
+            _blame_key(self.path, sha, copies),
+            lambda: (self._load_blame(sha, copies) or
+                     self._run_blame(sha, cancelled, copies)),
+            GitBlame.size,
+        )
 
-            # Skip any addition headers describing the commit
-            while not line.startswith('\t'):
-                line = p.readline()
+    def cached_blame(self, sha=None, copies=False):
+        """
+        Returns the blame for the given commit (by default the current
+        commit) if it has already been computed, or None if it hasn't.
+        """
+        if sha is None:
+            sha = self.current_commit.sha
 
-            lines.append(GitBlameLine(
-                sha=sha,
-                line=line[1:],
-                current=(sha == self.current_commit.sha),
-                original_line=original_line,
-                final_line=final_line,
-            ))
+        key = _blame_key(self.path, sha, copies)
+        lines = self.cache.get(key)
+        if lines is None:
+            lines = self._load_blame(sha, copies)
+            if lines is not None:
+                self.cache.put(key, lines, lines.size())
+
+        return lines
+
+    def stream_blame(self, sha=None, chunk_size=None):
+        """
+        Returns a StreamingBlame for the given commit (by default the current
+        commit). Its lines contain the text of the file straight away, and
+        the blame information is filled in once the StreamingBlame has been
+        started.
+        """
+        if sha is None:
+            sha = self.current_commit.sha
+
+        return StreamingBlame(self, sha, chunk_size)
+
+    def line_history(self, line, sha=None):
+        """
+        Returns the shas of the commits that changed the given line (an
+        index into the file at the given commit, by default the current
+        commit), newest first, as found by `git log -L`. The given commit
+        is included if it changed the line.
+        """
+        if sha is None:
+            sha = self.current_commit.sha
+
+        def run():
+            output = git('log', '-L%d,%d:%s' % (line + 1, line + 1, self.path),
+                         '--format=%H', '--no-patch', sha)
+            return [l for l in output.splitlines() if len(l) == 40]
+
+        return self._cached(
+            ('line history', self.path, sha, line),
+            run,
+            lambda shas: 41 * len(shas) + 1,
+        )
+
+    def blob_size(self, sha=None):
+        """
+        Returns the size in bytes of this file at the given commit (by
+        default the current commit), without reading it.
+        """
+        if sha is None:
+            sha = self.current_commit.sha
+
+        info = self.store.info(self.blob_name(sha))
+        return info[2] if info is not None else 0
+
+    def text(self, sha=None):
+        """
+        Returns the lines of this file at the given commit (by default the
+        current commit), including their line endings.
+        """
+        if sha is None:
+            sha = self.current_commit.sha
+
+        return split_lines(self.store.read(self.blob_name(sha)) or '')
+
+    def blob_name(self, rev):
+        """
+        Returns the name git uses for this file at the given revision.
+        """
+        return '%s:%s' % (rev, _relative_path(self.path))
+
+    def _load_blame(self, commit_sha, copies=False):
+        # Reads a blame result from the disk cache, if there is one.
+        if self.disk_cache is None:
+            return None
+
+        rows = self.disk_cache.get_blame(commit_sha, self.path, copies)
+        if rows is None:
+            return None
+
+        return GitBlame.from_rows(commit_sha, rows)
+
+    def _save_blame(self, commit_sha, lines, copies=False):
+        # Writes a blame result to the disk cache, if there is one.
+        if self.disk_cache is None:
+            return
+
+        self.disk_cache.put_blame(commit_sha, self.path, lines.rows(), copies)
 
-        self._blame = lines
-        return self._blame
+    def _run_blame(self, commit_sha, cancelled=None, copies=False):
+        rows = []
+        options = ('-M', '-C') if copies else ()
 
+        with profiler.measure(' '.join(('git blame', ) + options)) as m:
+            p = git_popen('blame', '-p', *(options + (
+                commit_sha, '--', self.path,
+            )))
+            if cancelled is not None:
+                _kill_when_cancelled(p, cancelled)
+
+            while True:
+                header = p.stdout.readline()
+                if not header:
+                    break
+                m.bytes += len(header)
+
+                # Header format:
+                # commit_sha original_line final_line[ lines_in_group]
+                header = header.rstrip('\n').split(' ')
+                if len(header) < 3:
+                    # The output was cut short by a cancellation.
+                    break
+                sha, original_line, final_line = header[:3]
+
+                line = p.stdout.readline()
+                m.bytes += len(line)
+
+                # Skip any addition headers describing the commit
+                while line and not line.startswith('\t'):
+                    line = p.stdout.readline()
+                    m.bytes += len(line)
+
+                rows.append((sha, int(original_line), line[1:]))
+
+            p.wait()
+            if cancelled is not None and cancelled():
+                # git may have been killed part way through.
+                return None
+
+        lines = GitBlame.from_rows(commit_sha, rows)
+        self._save_blame(commit_sha, lines, copies)
+        return lines
+
+    @profiler.timed('line_mapping')
     def line_mapping(self, start, finish):
         """
         Returns a dict that represents how lines have moved between versions
@@ -144,161 +658,739 @@ class GitFileHistory(object):
             {1:None, 2:1}
         """
 
-        key = start + '/' + finish
-        if key in self._line_mappings:
-            return self._line_mappings[key]
+        def build():
+            mappings = self._load_line_mappings(start, finish)
+            if mappings is None:
+                mappings = self._blame_line_mappings(start, finish)
+                if mappings is None:
+                    mappings = self._build_line_mappings(start, finish)
+                self._save_line_mappings(start, finish, mappings)
+
+            self._remember_line_mappings(start, finish, mappings)
+            return mappings[0]
+
+        return self._cached(
+            ('mapping', self.path, start, finish),
+            build,
+            _mapping_size,
+        )
 
-        forward, backward = self._build_line_mappings(start, finish)
-        self._line_mappings[start + '/' + finish] = forward
-        self._line_mappings[finish + '/' + start] = backward
+    def cached_line_mapping(self, start, finish):
+        """
+        Returns the line mapping from start to finish if it has already been
+        worked out (and is cached in memory or on disk), or None if it
+        hasn't.
+        """
+        forward = self.cache.get(('mapping', self.path, start, finish))
+        if forward is None:
+            mappings = self._load_line_mappings(start, finish)
+            if mappings is not None:
+                self._remember_line_mappings(start, finish, mappings)
+                forward = mappings[0]
 
         return forward
 
+    def add_line_mappings(self, start, finish, mappings):
+        """
+        Keeps (forward, backward) line mappings between two commits that
+        were worked out elsewhere (e.g. in another process, see
+        gitbrowse.trace), as if line_mapping had built them.
+        """
+        self._save_line_mappings(start, finish, mappings)
+        self._remember_line_mappings(start, finish, mappings)
+
+    def map_line(self, line, start, finish):
+        """
+        Returns where the given line of the file at the commit with index
+        start has ended up at the commit with index finish, or None if the
+        line was removed somewhere in between.
+
+        If the mappings for every step between the two commits are already
+        cached they are followed one after another, otherwise the two
+        revisions are compared directly, so moving several commits at once
+        costs at most one comparison.
+        """
+        step = 1 if finish > start else -1
+        shas = [self.commits[i].sha for i in range(start, finish + step, step)]
+        pairs = zip(shas, shas[1:])
+
+        if all(('mapping', self.path, a, b) in self.cache for a, b in pairs):
+            for a, b in pairs:
+                line = self.line_mapping(a, b).get(line)
+                if line is None:
+                    return None
+            return line
+
+        return self.line_mapping(shas[0], shas[-1]).get(line)
+
+    def _cached(self, key, compute, sizeof):
+        # Returns the cached value for key, or calls compute to build it
+        # and caches the result (unless it is None).
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        with self._key_locks_lock:
+            lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            # Another thread may have built the value while we waited.
+            if key in self.cache:
+                value = self.cache.get(key)
+                if value is not None:
+                    return value
+
+            value = compute()
+            if value is not None:
+                self.cache.put(key, value, sizeof(value))
+
+        with self._key_locks_lock:
+            self._key_locks.pop(key, None)
+
+        return value
+
+    def _blob(self, sha):
+        # Returns the id of the blob for this file at the given commit.
+        info = self.store.info(self.blob_name(sha))
+        return info[0] if info else None
+
+    def _remember_line_mappings(self, start, finish, mappings):
+        # Caches the mappings in both directions.
+        forward, backward = mappings
+        self.cache.put(('mapping', self.path, start, finish), forward,
+                       _mapping_size(forward))
+        self.cache.put(('mapping', self.path, finish, start), backward,
+                       _mapping_size(backward))
+
+    def _load_line_mappings(self, start, finish):
+        # Reads line mappings from the disk cache, if there is one.
+        if self.disk_cache is None:
+            return None
+
+        blobs = (self._blob(start), self._blob(finish))
+        if None in blobs:
+            return None
+
+        return self.disk_cache.get_mappings(*blobs)
+
+    def _save_line_mappings(self, start, finish, mappings):
+        # Writes line mappings to the disk cache, if there is one.
+        if self.disk_cache is None:
+            return
+
+        blobs = (self._blob(start), self._blob(finish))
+        if None in blobs:
+            return
+
+        self.disk_cache.put_mappings(*(blobs + mappings))
+
+    @profiler.timed('mapping from blames')
+    def _blame_line_mappings(self, start, finish):
+        # If both revisions have already been blamed we can tell which lines
+        # are the same without asking git: They came from the same line of
+        # the same commit. Only the lines that were added, removed or changed
+        # between the two revisions need to be diffed, and we already have
+        # their text.
+        start_blame = self.cache.peek(_blame_key(self.path, start))
+        finish_blame = self.cache.peek(_blame_key(self.path, finish))
+        if start_blame is None or finish_blame is None:
+            return None
+
+        origins = {}
+        for i in range(len(start_blame)):
+            origins[(start_blame.sha(i), start_blame.original_line(i))] = i
+
+        anchors = []
+        for j in range(len(finish_blame)):
+            i = origins.get((finish_blame.sha(j),
+                             finish_blame.original_line(j)))
+            if i is None:
+                continue
+
+            if anchors and i <= anchors[-1][0]:
+                # The lines have been reordered, which a diff can't express.
+                # Let the diff decide which lines stayed put.
+                return None
+
+            anchors.append((i, j))
+
+        start_text = start_blame.lines()
+        finish_text = finish_blame.lines()
+        matches = diff.refine_matches(start_text, finish_text, anchors)
+
+        return diff.mappings_from_matches(
+            matches,
+            len(start_text),
+            len(finish_text),
+        )
+
+    @profiler.timed('mapping from diff')
     def _build_line_mappings(self, start, finish):
-        forward = {}
-        backward = {}
-
-        # Get information about blank lines: The git diff porcelain format
-        # (which we use for everything else) doesn't distinguish between
-        # additions and removals, so this is a very dirty hack to get around
-        # the problem.
-        p = os.popen('git diff %s %s -- %s | grep -E "^[+-]$"' % (
-            start,
-            finish,
-            self.path,
-        ))
-        blank_lines = [l.strip() for l in p.readlines()]
-
-        p = os.popen('git diff --word-diff=porcelain %s %s -- %s' % (
-            start,
-            finish,
-            self.path,
-        ))
-
-        # The diff output is in sections: A header line (indicating the
-        # range of lines this section covers) and then a number of
-        # content lines.
-
-        sections = []
-
-        # Skip initial headers: They don't interest us.
-        line = ''
-        while not line.startswith('@@'):
-            line = p.readline()
-
-        while line:
-            header_line = line
-            content_lines = []
-
-            line = p.readline()
-            while line and not line.startswith('@@'):
-                content_lines.append(line)
-                line = p.readline()
-
-            sections.append((header_line, content_lines, ))
-
-
-        start_ln = finish_ln = 0
-        for header_line, content_lines in sections:
-            # The headers line has the format '@@ +a,b -c,d @@[ e]' where
-            # a is the first line number shown from start and b is the
-            # number of lines shown from start, and c is the first line
-            # number show from finish and d is the number of lines show
-            # from from finish, and e is Git's guess at the name of the
-            # context (and is not always present)
-
-            headers = header_line.strip('@ \n').split(' ')
-            headers = map(lambda x: x.strip('+-').split(','), headers)
-
-            start_range = map(int, headers[0])
-            finish_range = map(int, headers[1])
-
-            while start_ln < start_range[0] - 1 and \
-                  finish_ln < finish_range[0] - 1:
-                forward[start_ln] = finish_ln
-                backward[finish_ln] = start_ln
-                start_ln += 1
-                finish_ln += 1
-
-            # Now we're into the diff itself. Individual lines of input
-            # are separated by a line containing only a '~', this helps
-            # to distinguish between an addition, a removal, and a change.
-
-            line_iter = iter(content_lines)
-            try:
-                while True:
-                    group_size = -1
-                    line_delta = 0
-                    line = ' '
-                    while line != '~':
-                        if line.startswith('+'):
-                            line_delta += 1
-                        elif line.startswith('-'):
-                            line_delta -= 1
-
-                        group_size += 1
-                        line = line_iter.next().rstrip()
-
-                    if group_size == 0:
-                        # Two '~' lines next to each other means a blank
-                        # line has been either added or removed. Git
-                        # doesn't tell us which. This is all crazy.
-                        if blank_lines.pop(0) == '+':
-                            line_delta += 1
-                        else:
-                            line_delta -= 1
-
-                    if line_delta == 1:
-                        backward[finish_ln] = None
-                        finish_ln += 1
-                    elif line_delta == -1:
-                        forward[start_ln] = None
-                        start_ln += 1
-                    else:
-                        forward[start_ln] = finish_ln
-                        backward[finish_ln] = start_ln
-                        start_ln += 1
-                        finish_ln += 1
-            except StopIteration:
-                pass
-
-        # Make sure the mappings stretch the the beginning and end of
-        # the files.
-
-        p = os.popen('git show %s:%s' % (start, self.path))
-        start_len = len(p.readlines())
-
-        p = os.popen('git show %s:%s' % (finish, self.path))
-        finish_len = len(p.readlines())
-
-        while start_ln <= start_len and finish_ln <= finish_len:
-            forward[start_ln] = finish_ln
-            backward[finish_ln] = start_ln
-            start_ln += 1
-            finish_ln += 1
-
-        return forward, backward
-
-
-def verify_revision(rev):
+        return diff.line_mappings(self.text(start), self.text(finish))
+
+
+class StreamingBlame(object):
+    """
+    A blame result that is filled in progressively by a background thread
+    running `git blame --incremental`, so that the file can be shown before
+    git has finished working out where every line came from.
+
+    The lines attribute is a GitBlame with every line of the file in it.
+    Lines that haven't been blamed yet have a sha of None, and the blamed
+    attribute counts the lines that have been. Call updates to find out
+    which lines have been filled in since it was last called.
+
+    Once the whole file has been blamed, the complete flag is set and the
+    result is stored in the file history's cache, just as if blame had been
+    called.
+
+    Blaming a very large file takes a long time, and most of it may never
+    be looked at. If a chunk_size is given the file is blamed in chunks of
+    that many lines, with `git blame -L`, and only the chunks asked for
+    with request are blamed. Each chunk is cached separately, so a
+    StreamingBlame for the same revision later on starts with the chunks
+    that have already been done.
+    """
+
+    def __init__(self, file_history, sha, chunk_size=None):
+        self.file_history = file_history
+        self.sha = sha
+        self.lines = GitBlame(sha, file_history.store.read(
+            file_history.blob_name(sha)) or '')
+        self.chunk_size = chunk_size
+        self.started = False
+        self.complete = False
+        # Set if git blame stopped without blaming every line it was asked
+        # for, e.g. because it failed.
+        self.failed = False
+        self.blamed = 0
+
+        self._updated = set()
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._process = None
+        self._thread = None
+
+        # Chunks that are wanted, most urgent last, and chunks that are done.
+        self._wanted = []
+        self._chunks = set()
+        self._wakeup = threading.Condition(self._lock)
+        if chunk_size:
+            self._load_chunks()
+
+    def start(self, first=None):
+        """
+        Starts blaming the file in the background. If first is a
+        (start, stop) range of line indices those lines are blamed before
+        the rest of the file, which is useful for filling in the visible
+        part of the file first.
+        """
+        self.started = True
+
+        if self.chunk_size:
+            if first is not None:
+                self.request(*first)
+            self._thread = threading.Thread(target=self._run_chunks)
+        else:
+            self._thread = threading.Thread(target=self._run, args=(first, ))
+
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self, start, stop):
+        """
+        When blaming in chunks, asks for the chunks that cover the lines
+        from start to stop, and the chunks either side of them, to be
+        blamed next. Otherwise, does nothing.
+        """
+        stop = min(stop, len(self.lines))
+        if not self.chunk_size or start >= stop:
+            return
+
+        first = max(start // self.chunk_size - 1, 0)
+        last = min((stop - 1) // self.chunk_size + 1, self._chunk_count() - 1)
+        visible = range(start // self.chunk_size,
+                        (stop - 1) // self.chunk_size + 1)
+        margins = [n for n in (first, last) if n not in visible]
+        wanted = [n for n in margins + list(reversed(visible))
+                  if n not in self._chunks]
+        if not wanted:
+            return
+
+        with self._lock:
+            self._wanted = [n for n in self._wanted if n not in wanted]
+            self._wanted.extend(wanted)
+            self._wakeup.notify()
+
+    def cancel(self):
+        """
+        Stops the background blame, if it is running.
+        """
+        self._cancelled = True
+
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                self._process.kill()
+            self._wakeup.notify()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the background blame has finished, or until timeout
+        seconds have passed, if a timeout is given.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self.started and not self.complete and \
+            not self._cancelled and not self.failed
+
+    def updates(self):
+        """
+        Returns a sorted list of the indices of lines that have been filled
+        in since the last time this method was called.
+        """
+        with self._lock:
+            updated = sorted(self._updated)
+            self._updated.clear()
+        return updated
+
+    def _run(self, first):
+        if first is not None:
+            start, stop = first
+            stop = min(stop, len(self.lines))
+            if start < stop:
+                self._blame('-L', '%d,%d' % (start + 1, stop))
+
+        self._blame()
+
+        if not self._cancelled:
+            if self._all_blamed(0, len(self.lines)):
+                self._finish()
+            else:
+                self.failed = True
+
+    def _finish(self):
+        self.complete = True
+        self.file_history.cache.put(
+            _blame_key(self.file_history.path, self.sha),
+            self.lines,
+            self.lines.size(),
+        )
+        self.file_history._save_blame(self.sha, self.lines)
+
+    def _chunk_count(self):
+        return (len(self.lines) + self.chunk_size - 1) // self.chunk_size
+
+    def _chunk_key(self, n):
+        return ('blame chunk', self.file_history.path, self.sha,
+                self.chunk_size, n)
+
+    def _load_chunks(self):
+        # Fills in the chunks that have been cached.
+        for n in range(self._chunk_count()):
+            rows = self.file_history.cache.get(self._chunk_key(n))
+            if rows is None:
+                continue
+
+            start = n * self.chunk_size
+            for i, (sha, original_line) in enumerate(rows):
+                self.lines.set(start + i, sha, original_line)
+            self.blamed += len(rows)
+            self._chunks.add(n)
+
+    def _run_chunks(self):
+        while len(self._chunks) < self._chunk_count():
+            with self._lock:
+                while not self._wanted and not self._cancelled:
+                    self._wakeup.wait()
+                if self._cancelled:
+                    return
+                n = self._wanted.pop()
+
+            if n in self._chunks:
+                continue
+
+            start = n * self.chunk_size
+            stop = min(start + self.chunk_size, len(self.lines))
+            self._blame('-L', '%d,%d' % (start + 1, stop))
+            if self._cancelled:
+                return
+            if not self._all_blamed(start, stop):
+                # Rather than caching a chunk with holes in it, or asking
+                # git again on every redraw, leave the rest unblamed.
+                self.failed = True
+                return
+
+            rows = [(self.lines.sha(i), self.lines.original_line(i))
+                    for i in range(start, stop)]
+            self.file_history.cache.put(self._chunk_key(n), rows,
+                                        100 * len(rows))
+            self._chunks.add(n)
+
+        self._finish()
+
+    def _all_blamed(self, start, stop):
+        return all(self.lines.is_blamed(i) for i in range(start, stop))
+
+    def _blame(self, *args):
+        with self._lock:
+            if self._cancelled:
+                return
+
+            self._process = git_popen(
+                'blame', '--incremental', *(args + (
+                    self.sha, '--', self.file_history.path
+                ))
+            )
+
+        with profiler.measure('git blame --incremental') as m:
+            for header in iter(self._process.stdout.readline, ''):
+                m.bytes += len(header)
+
+                # Each group of lines starts with a header in the format:
+                # commit_sha original_line final_line lines_in_group
+                # followed by extra headers describing the commit, the last
+                # of which is always the filename.
+                parts = header.rstrip('\n').split(' ')
+                if len(parts) != 4 or len(parts[0]) != 40:
+                    continue
+
+                sha = parts[0]
+                original_line, final_line, count = map(int, parts[1:])
+                self._fill(sha, original_line, final_line, count)
+
+            self._process.wait()
+
+    def _fill(self, sha, original_line, final_line, count):
+        with self._lock:
+            for i in range(count):
+                index = final_line - 1 + i
+                if index >= len(self.lines) or \
+                   self.lines.is_blamed(index):
+                    continue
+
+                self.lines.set(index, sha, original_line + i)
+                self._updated.add(index)
+                self.blamed += 1
+
+
+class LineHistory(object):
     """
-    Verifies that a revision is valid in the current working directory,
-    and returns True or False accordingly.
+    The commits that changed one line of a file, found in a background
+    thread with GitFileHistory.line_history. It has the same interface as
+    gitbrowse.search.HistorySearch, so that the two can be shown and moved
+    through in the same way.
+    """
+
+    def __init__(self, file_history, line, sha=None):
+        self.file_history = file_history
+        self.line = line
+        self.sha = sha or file_history.current_commit.sha
+        self.complete = False
+
+        self._entries = []
+        self._updated = False
+        self._cancelled = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def running(self):
+        return self._thread is not None and not self.complete and \
+            not self._cancelled
+
+    def updated(self):
+        """
+        Returns True if the results have arrived since this was last
+        called.
+        """
+        updated = self._updated
+        self._updated = False
+        return updated
+
+    def entries(self):
+        """
+        Returns a list of (index, None) pairs for the commits that changed
+        the line, newest first, where index is the commit's position in
+        the file history's commits.
+        """
+        return self._entries
+
+    def _run(self):
+        shas = self.file_history.line_history(self.line, self.sha)
+        commits = self.file_history.commits
+
+        entries = []
+        for sha in shas:
+            if self._cancelled:
+                return
+            index = commits.index(sha)
+            if index is not None:
+                entries.append((index, None))
+
+        self._entries = sorted(entries)
+        self.complete = True
+        self._updated = True
+
+
+def split_lines(text):
+    """
+    Splits text into lines, keeping the line endings, in the same way that
+    git does. Unlike str.splitlines, only "\\n" ends a line.
+    """
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [l + '\n' for l in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _kill_when_cancelled(p, cancelled):
+    # Kills the git process p as soon as cancelled returns True. git blame
+    # -p doesn't print anything until it has worked out the whole blame, so
+    # checking between lines of output isn't enough.
+    def watch():
+        while p.poll() is None:
+            if cancelled():
+                try:
+                    p.kill()
+                except OSError:
+                    # It has just finished.
+                    pass
+                return
+            time.sleep(CANCEL_POLL_INTERVAL)
+
+    thread = threading.Thread(target=watch)
+    thread.daemon = True
+    thread.start()
+
+
+def _blame_key(path, sha, copies=False):
+    # The cache key for a blame. Blames that follow moved and copied lines
+    # are kept apart from plain ones, which line mappings rely on.
+    if copies:
+        return ('blame', path, sha, 'copies')
+    return ('blame', path, sha)
+
+
+def _mapping_size(mapping):
+    # A rough estimate of the memory used by a line mapping dict.
+    return 100 * len(mapping)
+
+
+def git(*args):
+    """
+    Runs a git command and returns everything it wrote to stdout.
+
+    The arguments are passed straight to git without going through a
+    shell, so they don't need to be quoted. Anything git writes to stderr
+    is passed through to our own stderr.
+    """
+    with profiler.measure('git ' + args[0]) as m:
+        output = git_popen(*args).communicate()[0]
+        m.bytes += len(output)
+    return output
+
+
+def git_popen(*args, **kwargs):
+    """
+    Starts a git command and returns the subprocess.Popen object, so that
+    the caller can read the output as it is produced. Keyword arguments
+    are passed on to subprocess.Popen.
+    """
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    with profiler.measure('starting git ' + args[0]):
+        return subprocess.Popen(('git', ) + args, **kwargs)
+
+
+class GitObjectStore(object):
+    """
+    Reads objects from the repository through long-lived
+    `git cat-file --batch` and `git cat-file --batch-check` processes, so
+    that we don't pay for starting a new git process for every blob or
+    commit we look at.
+
+    Objects can be named by anything git rev-parse understands, for
+    example a commit sha or "<sha>:<path>" for a blob. The store is safe
+    to use from several threads.
 
-    Errors are not supressed, so if the revision is bad or the CWD isn't
-    a Git repository then Git's error message will be output.
+    If a reader (see gitbrowse.objects) is set, objects are read through it
+    wherever it can, and from git otherwise.
     """
-    status = os.system('git rev-parse --verify --no-revs %s' % (
-        rev
-    ))
-    return status == 0
 
+    def __init__(self, reader=None):
+        self.reader = reader
+        self._batch = None
+        self._batch_check = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the cat-file processes now, rather than when they are first
+        needed, so that git's start-up time overlaps with other work.
+        """
+        with self._lock:
+            if self._batch is None:
+                self._batch = self._start('--batch')
+            if self._batch_check is None:
+                self._batch_check = self._start('--batch-check')
+
+    def info(self, name):
+        """
+        Returns a (sha, type, size) tuple describing the named object,
+        or None if there is no such object.
+        """
+        return self.info_many([name])[0]
+
+    def info_many(self, names):
+        """
+        Returns a list of info results for several objects at once. All of
+        the names are sent to git before any of the answers are read, so
+        this only waits for git once.
+        """
+        results = [None] * len(names)
+        if self.reader is not None:
+            results = [self.reader.info(name) for name in names]
+            if None not in results:
+                return results
+
+        asked = [i for i, result in enumerate(results) if result is None]
+        with self._lock, profiler.measure('git cat-file --batch-check'):
+            if self._batch_check is None:
+                self._batch_check = self._start('--batch-check')
+
+            p = self._batch_check
+            try:
+                p.stdin.write(''.join(names[i] + '\n' for i in asked))
+                p.stdin.flush()
+
+                for i in asked:
+                    results[i] = self._response(p)
+            except IOError:
+                # git has exited, e.g. because we're not in a repository.
+                return results
+            except BaseException:
+                self._abandon(p)
+                raise
+
+            return results
+
+    def read(self, name):
+        """
+        Returns the contents of the named object as a string, or None if
+        there is no such object.
+        """
+        if self.reader is not None:
+            data = self.reader.read(name)
+            if data is not None:
+                return data
+
+        with self._lock, profiler.measure('git cat-file --batch') as m:
+            if self._batch is None:
+                self._batch = self._start('--batch')
 
-def verify_file(path):
+            p = self._batch
+            try:
+                header = self._request(p, name)
+                if header is None:
+                    return None
+
+                size = header[2]
+                data = p.stdout.read(size)
+                m.bytes += size
+
+                # Each object is followed by a newline that isn't part of
+                # its contents.
+                p.stdout.read(1)
+            except BaseException:
+                self._abandon(p)
+                raise
+
+            return data
+
+    def close(self):
+        """
+        Shuts down the cat-file processes. They will be started again if
+        the store is used after being closed.
+        """
+        with self._lock:
+            for p in (self._batch, self._batch_check):
+                if p is not None:
+                    p.stdin.close()
+                    p.wait()
+
+            self._batch = None
+            self._batch_check = None
+
+    def _start(self, mode):
+        return git_popen('cat-file', mode, stdin=subprocess.PIPE)
+
+    def _abandon(self, p):
+        # Stops a cat-file process whose answer wasn't read in full (e.g.
+        # because of a KeyboardInterrupt), since what's left of it would be
+        # taken as the answer to the next request. A new one is started
+        # when it's next needed.
+        try:
+            p.kill()
+            p.wait()
+        except OSError:
+            pass
+
+        if p is self._batch:
+            self._batch = None
+        if p is self._batch_check:
+            self._batch_check = None
+
+    def _request(self, p, name):
+        p.stdin.write(name + '\n')
+        p.stdin.flush()
+        return self._response(p)
+
+    def _response(self, p):
+        # The header format is either "<sha> <type> <size>" or
+        # "<name> missing" (or "ambiguous" for short shas). Names can
+        # contain spaces, so a missing one can split into three fields too.
+        header = p.stdout.readline().rstrip('\n').split(' ')
+        if len(header) != 3 or header[-1] in ('missing', 'ambiguous'):
+            return None
+
+        return header[0], header[1], int(header[2])
+
+
+_object_store = None
+
+
+def object_store():
     """
-    Verifies that a given file is tracked by Git and returns true or false
-    accordingly.
+    Returns the object store shared by everything in this process.
     """
-    p = os.popen('git ls-files -- %s' % path)
-    matching_files = p.readlines()
-    return len(matching_files) > 0
+    global _object_store
+    if _object_store is None:
+        _object_store = GitObjectStore()
+        atexit.register(_object_store.close)
+    return _object_store
+
+
+def _relative_path(path):
+    # In "<rev>:<path>" names, git takes paths starting with ./ or ../ to
+    # be relative to the working directory, and any others to be relative
+    # to the top of the repository.
+    if os.path.isabs(path):
+        path = os.path.relpath(path)
+    if path.startswith('./') or path.startswith('../'):
+        return path
+    return './' + path
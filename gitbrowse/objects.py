@@ -0,0 +1,529 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from binascii import hexlify, unhexlify
+
+from gitbrowse.cache import LRUCache
+from gitbrowse.git import git
+from gitbrowse.profiling import profiler
+
+
+# The default memory budget for the delta bases kept by an ObjectReader.
+DEFAULT_BASE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Object types, as numbered in pack files.
+_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+_SHA = re.compile('^[0-9a-f]{40}$')
+
+# What can go wrong reading a corrupt, unusual or disappearing object.
+_ERRORS = (ValueError, IndexError, struct.error, zlib.error,
+           EnvironmentError)
+
+
+def repository_reader():
+    """
+    Returns an ObjectReader for the repository we're in, or None if we're
+    not in one.
+    """
+    output = git('rev-parse', '--git-path', 'objects', '--show-prefix')
+    lines = output.split('\n')
+    if len(lines) < 2 or not lines[0]:
+        return None
+    return ObjectReader(os.path.abspath(lines[0]), prefix=lines[1])
+
+
+class ObjectReader(object):
+    """
+    Reads objects straight from a repository's object directory, rather
+    than asking git for them, so there's no git process to talk to. Loose
+    objects are inflated with zlib. Pack files are memory-mapped and objects
+    are found in them through the fan-out table of their (version 2) index.
+    Deltas are resolved here too, with recently used bases kept in a small
+    cache, since neighbouring revisions of a file tend to share them.
+
+    Objects are named like they are for GitObjectStore, but only full shas
+    and "<sha>:<path>" names are understood. For anything else, and for
+    anything this reader can't deal with (an object that isn't there, an
+    alternate object directory, a pack index in an older format, a corrupt
+    object...) read and info return None, so that the caller can ask git
+    instead.
+
+    Paths starting with ./ or ../ are taken to be relative to prefix (the
+    working directory's path inside the repository, as given by
+    `git rev-parse --show-prefix`), like git does.
+    """
+
+    def __init__(self, objects_dir, prefix='',
+                 base_cache_bytes=DEFAULT_BASE_CACHE_BYTES):
+        self.objects_dir = objects_dir
+        self.prefix = prefix
+        self._bases = LRUCache(max_bytes=base_cache_bytes)
+        self._packs = {}
+        self._packs_lock = threading.Lock()
+        self._load_packs()
+
+    def read(self, name):
+        """
+        Returns the contents of the named object, or None.
+        """
+        with profiler.measure('object reader') as m:
+            found = self._find(name)
+            if found is None:
+                return None
+
+            data = found[2]
+            m.bytes += len(data)
+            return data
+
+    def info(self, name):
+        """
+        Returns a (sha, type, size) tuple describing the named object, or
+        None. Only the headers of the object (and of the bases of a delta)
+        are read, not its contents.
+        """
+        try:
+            sha = self._resolve(name)
+            if sha is None:
+                return None
+
+            found = self._object(sha, self._loose_info, self._packed_info)
+            if found is None:
+                return None
+            return (hexlify(sha), ) + found
+        except _ERRORS:
+            return None
+
+    def close(self):
+        with self._packs_lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs.clear()
+
+    def _find(self, name):
+        # Returns (sha, type, data) for the named object, or None.
+        try:
+            sha = self._resolve(name)
+            if sha is None:
+                return None
+
+            found = self._object(sha)
+            if found is None:
+                return None
+            return (hexlify(sha), ) + found
+        except _ERRORS:
+            # Anything we can't make sense of is left to git.
+            return None
+
+    def _resolve(self, name):
+        # Returns the binary sha of the named object, or None.
+        rev, colon, path = name.partition(':')
+        if not _SHA.match(rev):
+            return None
+
+        sha = unhexlify(rev)
+        if not colon:
+            return sha
+
+        commit = self._object(sha)
+        if commit is None or commit[0] != 'commit' or \
+           not commit[1].startswith('tree '):
+            return None
+
+        sha = unhexlify(commit[1][5:45])
+        for part in self._path_parts(path):
+            tree = self._object(sha)
+            if tree is None or tree[0] != 'tree':
+                return None
+
+            sha = _tree_entry(tree[1], part)
+            if sha is None:
+                return None
+
+        return sha
+
+    def _path_parts(self, path):
+        if path.startswith('./') or path.startswith('../'):
+            path = self.prefix + path
+
+        parts = []
+        for part in path.split('/'):
+            if part == '..':
+                if not parts:
+                    raise ValueError('Path outside the repository')
+                parts.pop()
+            elif part and part != '.':
+                parts.append(part)
+        return parts
+
+    def _object(self, sha, loose=None, packed=None):
+        # Returns (type, data) for the object with the given binary sha, or
+        # None if it can't be found. Other functions can be given to read
+        # something else about loose and packed objects.
+        loose = loose or self._loose
+        packed = packed or self._packed
+        for attempt in range(2):
+            pack, offset = self._locate(sha)
+            if pack is not None:
+                return packed(pack, offset)
+
+            found = loose(sha)
+            if found is not None:
+                return found
+
+            # The object may have been packed (or a pack added, perhaps by
+            # another thread) since we last looked.
+            if attempt == 0:
+                self._load_packs()
+
+        return None
+
+    def _loose(self, sha):
+        hex_sha = hexlify(sha)
+        path = os.path.join(self.objects_dir, hex_sha[:2], hex_sha[2:])
+        try:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+        except IOError:
+            return None
+
+        header, _, body = data.partition('\0')
+        object_type, size = header.split(' ')
+        if len(body) != int(size):
+            raise ValueError('Corrupt object %s' % (hex_sha, ))
+        return object_type, body
+
+    def _loose_info(self, sha):
+        # Returns (type, size) for a loose object, inflating no more of it
+        # than its header.
+        hex_sha = hexlify(sha)
+        path = os.path.join(self.objects_dir, hex_sha[:2], hex_sha[2:])
+        try:
+            with open(path, 'rb') as f:
+                compressed = f.read(1024)
+        except IOError:
+            return None
+
+        header = zlib.decompressobj().decompress(compressed, 64)
+        if '\0' not in header:
+            raise ValueError('Corrupt object %s' % (hex_sha, ))
+        object_type, size = header.split('\0', 1)[0].split(' ')
+        return object_type, int(size)
+
+    def _packed_info(self, pack, offset):
+        # Returns (type, size) for a packed object. The size of a delta's
+        # result is at the start of the delta, and its type is that of the
+        # base at the end of the chain, so nothing is applied.
+        size = None
+        while True:
+            cached = self._bases.peek((pack.path, offset))
+            if cached is not None:
+                object_type, data = cached
+                if size is None:
+                    size = len(data)
+                break
+
+            type_number, object_size, position = pack.header(offset)
+            if type_number in _TYPES:
+                object_type = _TYPES[type_number]
+                if size is None:
+                    size = object_size
+                break
+
+            if type_number == _OFS_DELTA:
+                distance, position = _offset_distance(pack.data, position)
+                base_pack, base_offset = pack, offset - distance
+            elif type_number == _REF_DELTA:
+                base = pack.data[position:position + 20]
+                position += 20
+                base_pack, base_offset = self._locate(base)
+            else:
+                raise ValueError('Unknown object type %d' % (type_number, ))
+
+            if size is None:
+                delta = pack.inflate_start(position)
+                _, start = _delta_size(delta, 0)
+                size, _ = _delta_size(delta, start)
+
+            if base_pack is None:
+                found = self._object(base, self._loose_info,
+                                     self._packed_info)
+                if found is None:
+                    return None
+                object_type = found[0]
+                break
+            pack, offset = base_pack, base_offset
+
+        return object_type, size
+
+    def _packed(self, pack, offset):
+        # Follows a chain of deltas down to a base we have (or can read),
+        # then applies the deltas on the way back up.
+        deltas = []
+        while True:
+            cached = self._bases.get((pack.path, offset))
+            if cached is not None:
+                object_type, data = cached
+                break
+
+            type_number, size, position = pack.header(offset)
+            if type_number in _TYPES:
+                object_type = _TYPES[type_number]
+                data = pack.inflate(position, size)
+                if deltas:
+                    # It's likely to be the base of other deltas too.
+                    self._bases.put((pack.path, offset),
+                                    (object_type, data), len(data))
+                break
+
+            if type_number == _OFS_DELTA:
+                distance, position = _offset_distance(pack.data, position)
+                deltas.append((pack, offset, position, size))
+                offset -= distance
+            elif type_number == _REF_DELTA:
+                base = pack.data[position:position + 20]
+                deltas.append((pack, offset, position + 20, size))
+
+                base_pack, base_offset = self._locate(base)
+                if base_pack is None:
+                    found = self._object(base)
+                    if found is None:
+                        return None
+                    object_type, data = found
+                    break
+                pack, offset = base_pack, base_offset
+            else:
+                raise ValueError('Unknown object type %d' % (type_number, ))
+
+        for pack, offset, position, size in reversed(deltas):
+            data = apply_delta(data, pack.inflate(position, size))
+            self._bases.put((pack.path, offset), (object_type, data),
+                            len(data))
+
+        return object_type, data
+
+    def _locate(self, sha):
+        # Other threads may be adding packs, so look through a snapshot.
+        with self._packs_lock:
+            packs = list(self._packs.values())
+
+        for pack in packs:
+            offset = pack.find(sha)
+            if offset is not None:
+                return pack, offset
+        return None, None
+
+    def _load_packs(self):
+        # Opens any packs we haven't seen before, returning True if there
+        # were any.
+        directory = os.path.join(self.objects_dir, 'pack')
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return False
+
+        added = False
+        with self._packs_lock:
+            for name in names:
+                if not name.endswith('.idx') or name in self._packs:
+                    continue
+
+                try:
+                    self._packs[name] = _Pack(os.path.join(directory, name))
+                    added = True
+                except (ValueError, EnvironmentError, mmap.error):
+                    # An index in a format we don't read, or a pack that
+                    # was removed while we looked. Git can read its objects.
+                    continue
+        return added
+
+
+class _Pack(object):
+    # A pack file and its index, both memory-mapped.
+
+    def __init__(self, index_path):
+        self.path = index_path[:-4] + '.pack'
+        self.index = _map(index_path)
+        self.data = _map(self.path)
+
+        if self.index[:8] != '\377tOc\0\0\0\2':
+            raise ValueError('Unsupported pack index %s' % (index_path, ))
+        if self.data[:4] != 'PACK':
+            raise ValueError('Not a pack file: %s' % (self.path, ))
+
+        self.fanout = struct.unpack_from('>256I', self.index, 8)
+        self.count = self.fanout[255]
+        self._shas = 8 + 256 * 4
+        self._offsets = self._shas + self.count * (20 + 4)
+        self._large_offsets = self._offsets + self.count * 4
+
+    def close(self):
+        self.index.close()
+        self.data.close()
+
+    def find(self, sha):
+        # Returns the offset of the object in the pack, or None. The fan-out
+        # table gives the range of entries starting with the same byte, and
+        # the (sorted) shas in that range are searched by bisection.
+        first = ord(sha[0])
+        low = self.fanout[first - 1] if first else 0
+        high = self.fanout[first]
+
+        index = self.index
+        while low < high:
+            middle = (low + high) // 2
+            start = self._shas + middle * 20
+            candidate = index[start:start + 20]
+            if candidate < sha:
+                low = middle + 1
+            elif candidate > sha:
+                high = middle
+            else:
+                return self._offset(middle)
+
+        return None
+
+    def _offset(self, position):
+        offset, = struct.unpack_from('>I', self.index,
+                                     self._offsets + position * 4)
+        if offset & 0x80000000:
+            offset, = struct.unpack_from(
+                '>Q', self.index,
+                self._large_offsets + (offset & 0x7fffffff) * 8,
+            )
+        return offset
+
+    def header(self, offset):
+        # Returns the type number and (inflated) size of the object at
+        # offset, and where its data starts.
+        data = self.data
+        byte = ord(data[offset])
+        type_number = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        while byte & 0x80:
+            offset += 1
+            byte = ord(data[offset])
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return type_number, size, offset + 1
+
+    def inflate_start(self, position, length=32):
+        # Returns the first length bytes of the data at position, inflating
+        # no more than that.
+        compressed = self.data[position:position + 1024]
+        return zlib.decompressobj().decompress(compressed, length)
+
+    def inflate(self, position, size):
+        # Compressed data is usually smaller than what it inflates to, so
+        # a little more than size is read at a time.
+        inflater = zlib.decompressobj()
+        chunk_size = size + 1024
+        chunks = []
+        inflated = 0
+        while inflated < size:
+            compressed = self.data[position:position + chunk_size]
+            if not compressed:
+                raise ValueError('Truncated object in %s' % (self.path, ))
+            position += len(compressed)
+
+            chunk = inflater.decompress(compressed)
+            chunks.append(chunk)
+            inflated += len(chunk)
+
+        data = ''.join(chunks)
+        if len(data) != size:
+            raise ValueError('Corrupt object in %s' % (self.path, ))
+        return data
+
+
+def apply_delta(base, delta):
+    """
+    Returns the result of applying a git delta (as found in pack files) to
+    base.
+    """
+    base_size, position = _delta_size(delta, 0)
+    result_size, position = _delta_size(delta, position)
+    if base_size != len(base):
+        raise ValueError('Delta does not match its base')
+
+    pieces = []
+    end = len(delta)
+    while position < end:
+        op = ord(delta[position])
+        position += 1
+
+        if op & 0x80:
+            # Copy part of the base. The low bits say which bytes of the
+            # offset and size follow.
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= ord(delta[position]) << (8 * i)
+                    position += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= ord(delta[position]) << (8 * i)
+                    position += 1
+            pieces.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            # Insert the next op bytes of the delta.
+            pieces.append(delta[position:position + op])
+            position += op
+        else:
+            raise ValueError('Invalid delta')
+
+    result = ''.join(pieces)
+    if len(result) != result_size:
+        raise ValueError('Delta produced the wrong size')
+    return result
+
+
+def _delta_size(delta, position):
+    size = shift = 0
+    while True:
+        byte = ord(delta[position])
+        position += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, position
+
+
+def _offset_distance(data, position):
+    # Reads the (big-endian, off by one per byte) distance back to the base
+    # of an offset delta.
+    byte = ord(data[position])
+    distance = byte & 0x7f
+    while byte & 0x80:
+        position += 1
+        byte = ord(data[position])
+        distance = ((distance + 1) << 7) | (byte & 0x7f)
+    return distance, position + 1
+
+
+def _tree_entry(tree, name):
+    # Returns the binary sha of the named entry in a tree object, or None.
+    # Each entry is "<mode> <name>\0" followed by a 20 byte sha.
+    position = 0
+    end = len(tree)
+    while position < end:
+        space = tree.index(' ', position)
+        nul = tree.index('\0', space)
+        if tree[space + 1:nul] == name:
+            if tree[position:space] == '160000':
+                # A submodule, whose commit isn't in this repository.
+                return None
+            return tree[nul + 1:nul + 21]
+        position = nul + 21
+    return None
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,156 @@
+import threading
+from Queue import Queue, Empty
+
+
+class Prefetcher(object):
+    """
+    Computes blame results and line mappings for the revisions either side
+    of the current one in the background, so that they are already in the
+    file history's cache by the time the user moves to them.
+
+    Blaming can be left out (for files too big to blame in full), in which
+    case only the mappings are prepared. The file_history and blames
+    attributes can be changed, e.g. when another file is being looked at,
+    and are used by the next call to schedule.
+
+    Work is done by a small, fixed pool of worker threads. Each call to
+    schedule replaces any work that hasn't been started yet, and asks any
+    blame that is already running to give up unless it is still wanted
+    (it's for the new revision or one of its neighbours), so jumping around
+    in history doesn't leave the workers busy with revisions nobody is
+    looking at, or throw away work that is about to be used.
+    """
+
+    def __init__(self, file_history, radius=2, workers=2, blames=True):
+        self.file_history = file_history
+        self.radius = radius
+        self.workers = workers
+        self.blames = blames
+
+        self._queue = Queue()
+        self._threads = []
+
+        # The (file_history, task) pairs that are still worth doing, and
+        # those being done.
+        self._wanted = frozenset()
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the worker threads. The threads are daemons, so they won't
+        stop the program from exiting.
+        """
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def schedule(self, index=None):
+        """
+        Queues up the neighbours of the commit at the given index (by
+        default the current commit), nearest first, in place of any
+        outstanding work. Work that is already running carries on if it is
+        for that commit or its neighbours, and is cancelled otherwise.
+        """
+        if index is None:
+            index = self.file_history.index
+
+        file_history = self.file_history
+        items = [(file_history, task)
+                 for task in self._tasks(file_history, index)]
+
+        wanted = set(items)
+        if self.blames and file_history.commits.exists(index):
+            # The revision itself is about to be shown.
+            wanted.add((file_history,
+                        ('blame', file_history.commits[index].sha)))
+
+        self._wanted = frozenset(wanted)
+        self._drain()
+
+        with self._lock:
+            items = [item for item in items if item not in self._running]
+        for item in items:
+            self._queue.put(item)
+
+    def cancel(self):
+        """
+        Drops queued work and asks running work to stop.
+        """
+        self._wanted = frozenset()
+        self._drain()
+
+    def blaming(self, file_history, sha):
+        """
+        Returns True if a worker is blaming the file at the given commit, in
+        which case asking file_history for the same blame waits for it
+        rather than running git blame again.
+        """
+        with self._lock:
+            return (file_history, ('blame', sha)) in self._running
+
+    def _drain(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+            self._queue.task_done()
+
+    def wait(self):
+        """
+        Blocks until all of the queued work has been done or dropped.
+        """
+        self._queue.join()
+
+    def _tasks(self, file_history, index):
+        commits = file_history.commits
+
+        def valid(i):
+            return i >= 0 and commits.exists(i)
+
+        for distance in range(1, self.radius + 1):
+            for step in (1, -1):
+                target = index + step * distance
+                if not valid(target):
+                    continue
+
+                if self.blames:
+                    yield ('blame', commits[target].sha)
+
+                # Map from the neighbour that is one step closer to the
+                # current commit, which is the move the user would make.
+                source = target - step
+                yield ('mapping', commits[source].sha, commits[target].sha)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            with self._lock:
+                wanted = item in self._wanted and item not in self._running
+                if wanted:
+                    self._running.add(item)
+
+            try:
+                if wanted:
+                    self._run(*item)
+            except Exception:
+                # Prefetching is only an optimisation: If it fails the same
+                # error will come up again, and be reported, when the user
+                # actually moves to the revision.
+                pass
+            finally:
+                if wanted:
+                    with self._lock:
+                        self._running.discard(item)
+                self._queue.task_done()
+
+    def _run(self, file_history, task):
+        cancelled = lambda: (file_history, task) not in self._wanted
+
+        if task[0] == 'blame':
+            file_history.blame(task[1], cancelled=cancelled)
+        elif task[0] == 'mapping':
+            file_history.line_mapping(task[1], task[2])
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """
+    Keeps running totals for named operations: How many times each one has
+    happened, how long they took altogether and at most, and how many bytes
+    they read.
+
+        with profiler.measure('git blame') as m:
+            data = p.stdout.read()
+            m.bytes += len(data)
+
+    Operations can be measured from any thread.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds=0.0, bytes=0):
+        """
+        Adds one occurrence of the named operation to the totals.
+        """
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'bytes': 0,
+                }
+
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += bytes
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Times the body of a with statement as one occurrence of the named
+        operation. The yielded object's bytes attribute can be increased
+        to count what the operation reads.
+        """
+        measurement = _Measurement()
+        start = time.time()
+        try:
+            yield measurement
+        finally:
+            self.record(name, time.time() - start, measurement.bytes)
+
+    def timed(self, name):
+        """
+        A decorator that measures every call of a function.
+        """
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                with self.measure(name):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def stats(self):
+        """
+        Returns a copy of the totals, as a dict of dicts keyed by operation
+        name.
+        """
+        with self._lock:
+            return dict((name, dict(stats))
+                        for name, stats in self._stats.items())
+
+    def summary(self):
+        """
+        Returns the totals as lines of text, a header followed by one line
+        per operation, those that have taken longest first.
+        """
+        stats = sorted(self.stats().items(),
+                       key=lambda item: -item[1]['seconds'])
+
+        lines = ['%-28s %7s %10s %9s %11s' % (
+            'operation', 'count', 'total ms', 'max ms', 'bytes',
+        )]
+        for name, s in stats:
+            lines.append('%-28s %7d %10.1f %9.1f %11d' % (
+                name[:28], s['count'], s['seconds'] * 1000,
+                s['max_seconds'] * 1000, s['bytes'],
+            ))
+        return lines
+
+    def dump(self, path):
+        """
+        Writes the totals to a file as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class _Measurement(object):
+    __slots__ = ('bytes', )
+
+    def __init__(self):
+        self.bytes = 0
+
+
+# The profiler used throughout git browse.
+profiler = Profiler()
@@ -0,0 +1,208 @@
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from Queue import Queue
+
+from gitbrowse.git import GitObjectStore, split_lines
+from gitbrowse.profiling import profiler
+
+
+def compile_pattern(pattern, regex=False, ignore_case=False):
+    """
+    Compiles a search pattern, which is treated as a plain string unless
+    regex is set.
+    """
+    if not regex:
+        pattern = re.escape(pattern)
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+
+class SearchIndex(object):
+    """
+    Finds every match for a search pattern in a list of lines up front, so
+    that jumping between matches is a binary search and highlighting a line
+    is a dict lookup.
+
+    The pattern is treated as a plain string unless regex is set, in which
+    case it's a Python regular expression. Empty matches are ignored.
+    """
+
+    @profiler.timed('search index')
+    def __init__(self, lines, pattern, regex=False, ignore_case=False):
+        self.pattern = pattern
+        self.regex = regex
+        self.ignore_case = ignore_case
+
+        compiled = compile_pattern(pattern, regex, ignore_case)
+
+        # Sorted indices of lines that match, and the (start, end) spans of
+        # the matches on each of those lines.
+        self.matches = []
+        self._spans = {}
+
+        for index, line in enumerate(lines):
+            spans = [m.span() for m in compiled.finditer(line)
+                     if m.end() > m.start()]
+            if spans:
+                self.matches.append(index)
+                self._spans[index] = spans
+
+    def spans(self, index):
+        """
+        Returns a list of (start, end) character offsets of the matches on
+        the line at the given index.
+        """
+        return self._spans.get(index, [])
+
+    def next_match(self, index, times=1):
+        """
+        Returns the index of the times-th matching line after the given
+        index, or the last match if there aren't that many. Returns None if
+        there are no matches after the given index.
+        """
+        position = bisect_right(self.matches, index)
+        if position >= len(self.matches):
+            return None
+        return self.matches[min(position + times - 1, len(self.matches) - 1)]
+
+    def prev_match(self, index, times=1):
+        """
+        Returns the index of the times-th matching line before the given
+        index, or the first match if there aren't that many. Returns None if
+        there are no matches before the given index.
+        """
+        position = bisect_left(self.matches, index)
+        if position == 0:
+            return None
+        return self.matches[max(position - times, 0)]
+
+
+class HistorySearch(object):
+    """
+    Searches every revision of a file for a pattern in the background, to
+    find the revisions where it appears and where it disappears.
+
+    The blobs are read by a pool of `git cat-file` processes, one for each
+    worker thread, and results are recorded as they come in, so they can
+    be shown before the search has finished. Cancelling the search stops
+    the workers after the revision they are on.
+    """
+
+    def __init__(self, file_history, pattern, regex=False, ignore_case=False,
+                 workers=4):
+        self.file_history = file_history
+        self.pattern = pattern
+        self.workers = workers
+        self.complete = False
+
+        # Maps commit indices to the number of matching lines at that commit.
+        self.results = {}
+
+        self._compiled = compile_pattern(pattern, regex, ignore_case)
+        self._cancelled = False
+        self._updated = False
+        self._queue = Queue(maxsize=workers * 4)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def start(self):
+        feeder = threading.Thread(target=self._feed)
+        feeder.daemon = True
+        feeder.start()
+
+        self._running = self.workers
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def cancel(self):
+        self._cancelled = True
+
+    def wait(self):
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def running(self):
+        return bool(self._threads) and not self.complete and \
+            not self._cancelled
+
+    def updated(self):
+        """
+        Returns True if there are new results since this was last called.
+        """
+        updated = self._updated
+        self._updated = False
+        return updated
+
+    def entries(self):
+        """
+        Returns a list of (index, change) tuples, newest first, for each
+        revision that matches or that is the first revision after the
+        pattern disappeared. The change is '+' if the pattern appeared in
+        that revision (or it is the oldest), '-' if it disappeared and None
+        if it was already there in the previous revision.
+
+        Revisions whose neighbours haven't been searched yet are listed
+        as if the pattern was already there.
+        """
+        with self._lock:
+            results = dict(self.results)
+
+        entries = []
+        for index in sorted(results):
+            found = results[index] > 0
+            older = results.get(index + 1)
+            oldest = self.complete and index + 1 not in results
+
+            if found and (oldest or older == 0):
+                entries.append((index, '+'))
+            elif found:
+                entries.append((index, None))
+            elif older:
+                entries.append((index, '-'))
+
+        return entries
+
+    def _feed(self):
+        commits = self.file_history.commits
+        index = 0
+        while not self._cancelled and commits.exists(index):
+            self._queue.put((index, commits[index].sha))
+            index += 1
+
+        for _ in range(self.workers):
+            self._queue.put(None)
+
+    def _work(self):
+        store = GitObjectStore()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                if self._cancelled:
+                    # Keep taking work off the queue so that the feeder
+                    # isn't left blocked, but don't do it.
+                    continue
+
+                index, sha = item
+                with profiler.measure('history search revision'):
+                    text = store.read(self.file_history.blob_name(sha)) or ''
+                    count = sum(1 for line in split_lines(text)
+                                if self._compiled.search(line))
+
+                with self._lock:
+                    self.results[index] = count
+                self._updated = True
+        finally:
+            store.close()
+
+            with self._lock:
+                self._running -= 1
+                if self._running == 0 and not self._cancelled:
+                    self.complete = True
+                    self._updated = True
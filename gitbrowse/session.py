@@ -0,0 +1,63 @@
+from gitbrowse.cache import LRUCache
+from gitbrowse.git import (GitFileHistory, DEFAULT_CACHE_BYTES, git,
+                           object_store)
+
+
+class Session(object):
+    """
+    The files open in one run of git browse, all starting from the same
+    commit.
+
+    The histories of the files share the git cat-file processes, the cache
+    of blames and line mappings (and the disk cache, if there is one) and
+    their commits, so opening another file doesn't pay for any of those
+    again, and a commit that touched several of the files only has its
+    metadata read once.
+    """
+
+    def __init__(self, start_commit, cache=None, disk_cache=None):
+        self.start_commit = start_commit
+        self.store = object_store()
+        if cache is None:
+            cache = LRUCache(max_bytes=DEFAULT_CACHE_BYTES)
+        self.cache = cache
+        self.disk_cache = disk_cache
+
+        self.histories = []
+        self._known_commits = {}
+        self._tracked_files = None
+
+    def open(self, path):
+        """
+        Returns the GitFileHistory for path, opening it if it isn't open
+        already. Raises ValueError if the file doesn't exist at the start
+        commit.
+        """
+        for history in self.histories:
+            if history.path == path:
+                return history
+
+        history = GitFileHistory(path, self.start_commit, cache=self.cache,
+                                 disk_cache=self.disk_cache,
+                                 known_commits=self._known_commits)
+        self.histories.append(history)
+        return history
+
+    def close(self, history):
+        """
+        Closes a history returned by open. Whatever it has cached is left
+        for the cache to drop when it needs the room.
+        """
+        self.histories.remove(history)
+        history.close()
+
+    def tracked_files(self):
+        """
+        Returns the paths of the files git is tracking (relative to the
+        working directory), as listed by `git ls-files`.
+        """
+        if self._tracked_files is None:
+            self._tracked_files = [
+                path for path in git('ls-files', '-z').split('\0') if path
+            ]
+        return self._tracked_files
@@ -0,0 +1,121 @@
+import threading
+
+
+class Task(object):
+    """
+    A piece of work running in a background thread.
+
+    The work function is called with a single argument: A function that
+    returns True once the task has been cancelled, which long-running work
+    should check regularly (it can be passed straight on to things like
+    GitFileHistory.blame). When the work finishes, its result is handed to
+    the done callback, but only when the TaskRunner is polled, so that the
+    callback runs on the interface's thread.
+    """
+
+    def __init__(self, description, work, done=None):
+        self.description = description
+        self.work = work
+        self.done = done
+
+        self.finished = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def _run(self):
+        try:
+            self.result = self.work(self.is_cancelled)
+        except Exception as e:
+            self.error = e
+        self.finished = True
+
+
+class TaskRunner(object):
+    """
+    Starts Tasks and delivers their results.
+
+    The interface should call poll regularly (e.g. when it is idle). Tasks
+    that have finished since the last poll have their done callbacks called,
+    unless they were cancelled. Errors raised by the work are raised again
+    from poll, so they aren't lost in the background thread.
+    """
+
+    spinner = '|/-\\'
+
+    def __init__(self):
+        self.tasks = []
+        self._ticks = 0
+
+    def run(self, description, work, done=None):
+        """
+        Starts work in the background and returns its Task.
+        """
+        task = Task(description, work, done)
+        thread = threading.Thread(target=task._run)
+        thread.daemon = True
+        thread.start()
+        self.tasks.append(task)
+        return task
+
+    def poll(self):
+        """
+        Calls the done callbacks of finished tasks. Returns True if any
+        tasks finished.
+        """
+        finished = [t for t in self.tasks if t.finished]
+        if not finished:
+            return False
+
+        # Tasks can finish while this runs, so only the ones found above are
+        # removed; the rest are picked up by the next poll.
+        self.tasks = [t for t in self.tasks if t not in finished]
+
+        # Every callback is called before any error is raised, so that one
+        # failed task doesn't lose the results of the others.
+        error = None
+        for task in finished:
+            if task.cancelled:
+                continue
+            if task.error is not None:
+                error = error or task.error
+            elif task.done is not None:
+                task.done(task.result)
+
+        if error is not None:
+            raise error
+        return True
+
+    def cancel(self):
+        """
+        Cancels every running task. Returns True if there were any.
+        """
+        running = [t for t in self.tasks if not t.cancelled]
+        for task in running:
+            task.cancel()
+        return bool(running)
+
+    @property
+    def busy(self):
+        return any(not t.cancelled for t in self.tasks)
+
+    def progress(self):
+        """
+        Returns a short description of the running tasks with a spinner
+        that moves each time it's called, or None if nothing is running.
+        """
+        running = [t for t in self.tasks if not t.cancelled]
+        if not running:
+            return None
+
+        self._ticks += 1
+        return '%s %s' % (
+            self.spinner[self._ticks % len(self.spinner)],
+            ', '.join(t.description for t in running),
+        )
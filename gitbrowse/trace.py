@@ -0,0 +1,149 @@
+import json
+from collections import deque
+from multiprocessing import Pool
+
+from gitbrowse import diff
+from gitbrowse.git import GitObjectStore, split_lines
+from gitbrowse.profiling import profiler
+
+
+# The object store of a worker process (see _compare).
+_worker_store = None
+
+
+def trace_line(file_history, line, workers=4):
+    """
+    Follows a line of the file at the current commit of file_history back
+    through the file's history, yielding a dict for every commit, newest
+    first, with these keys:
+
+        index   The position of the commit in file_history.commits.
+        commit  The commit's sha.
+        line    The line number (counting from 1) the line has at that
+                commit, or None if it didn't exist yet.
+        text    The line's text at that commit (without a line ending),
+                or None.
+        blame   The sha of the commit that gave the line that text, or
+                None.
+
+    The line is given as an index (counting from 0). The history is walked
+    once: Each pair of neighbouring revisions is compared a single time
+    (the mapping in the other direction is cached too) and comparisons that
+    haven't been cached already are worked out ahead of the walk by a pool
+    of worker processes, so that several run at once. Each worker reads
+    the revisions it compares through its own cat-file processes. The blame
+    is taken from the same comparisons, as the oldest commit the line has
+    the same text at without a break, so no git blame runs are needed. A
+    record is yielded as soon as its blame is known.
+    """
+    commits = file_history.commits
+    index = file_history.index
+    lines = file_history.text(commits[index].sha)
+    if not 0 <= line < len(lines):
+        raise ValueError('There is no line %d' % (line + 1, ))
+
+    def step(i):
+        # Returns a function giving the mapping of lines from commit i to
+        # the commit before it, and the text there. Unless the mapping is
+        # cached, it's worked out in the pool.
+        start, finish = commits[i].sha, commits[i + 1].sha
+        mapping = file_history.cached_line_mapping(start, finish)
+        if mapping is not None:
+            return lambda: (mapping, file_history.text(finish))
+
+        if not pools:
+            pools.append(Pool(workers, _start_worker))
+        result = pools[0].apply_async(_compare, (
+            file_history.blob_name(start),
+            file_history.blob_name(finish),
+        ))
+
+        def get():
+            forward, backward, lines = result.get()
+            file_history.add_line_mappings(start, finish,
+                                           (forward, backward))
+            return forward, lines
+        return get
+
+    # The pool is only started if something needs comparing.
+    pools = []
+    pending = deque()
+    scheduled = index
+
+    # Records that share a blame we don't know yet.
+    unblamed = []
+    text = lines[line]
+
+    try:
+        while line is not None:
+            unblamed.append({
+                'index': index,
+                'commit': commits[index].sha,
+                'line': line + 1,
+                'text': text.rstrip('\r\n'),
+            })
+
+            while len(pending) < workers * 2 and commits.exists(scheduled + 1):
+                pending.append(step(scheduled))
+                scheduled += 1
+
+            if pending:
+                mapping, lines = pending.popleft()()
+                line = mapping.get(line)
+            else:
+                line = None
+
+            previous_text = text
+            text = lines[line] if line is not None else None
+            if text != previous_text:
+                for record in unblamed:
+                    record['blame'] = commits[index].sha
+                    yield record
+                unblamed = []
+
+            index += 1
+    finally:
+        for pool in pools:
+            pool.terminate()
+
+    # Older revisions, from before the line was added.
+    while commits.exists(index):
+        yield {
+            'index': index,
+            'commit': commits[index].sha,
+            'line': None,
+            'text': None,
+            'blame': None,
+        }
+        index += 1
+
+
+def _start_worker():
+    # Worker processes don't share the cat-file processes of the process
+    # that started them. Another thread may have held the profiler's lock
+    # when the worker was forked, so it starts afresh (nobody reads the
+    # worker's measurements anyway).
+    global _worker_store
+    profiler.__init__()
+    _worker_store = GitObjectStore()
+
+
+def _compare(start_name, finish_name):
+    # Runs in a worker process: Returns the (forward, backward) mappings
+    # between two versions of a file, named as for GitObjectStore, and the
+    # lines of the second one.
+    start = split_lines(_worker_store.read(start_name) or '')
+    finish = split_lines(_worker_store.read(finish_name) or '')
+    forward, backward = diff.line_mappings(start, finish)
+    return forward, backward, finish
+
+
+def write_trace(file_history, line, output, workers=4):
+    """
+    Writes the records from trace_line to a file as JSON, one per line.
+    """
+    for record in trace_line(file_history, line, workers):
+        if record['text'] is not None:
+            record['text'] = record['text'].decode('utf-8', 'replace')
+        output.write(json.dumps(record, sort_keys=True) + '\n')
+        output.flush()
@@ -1,8 +1,12 @@
 import sys
+import time
 import curses
 from curses.textpad import Textbox
 from curses import ascii
 
+from gitbrowse.profiling import profiler
+from gitbrowse.tasks import TaskRunner
+
 
 class KeyBindings(dict):
     """
@@ -30,6 +34,10 @@ class KeyBindings(dict):
         return decorator
 
 
+# Marks a row whose contents are unknown, so it must be drawn again.
+_DIRTY = object()
+
+
 class ModalScrollingInterface(object):
     """
     An abstract superclass for curses-based Less-like interfaces that have
@@ -49,6 +57,11 @@ class ModalScrollingInterface(object):
         # If the user enters '123' then presses 'a', do_something(123) will be
         # called.
 
+    Slow work can be run in the background with run_task, so that the
+    interface stays responsive. While tasks are running a progress indicator
+    is shown in the status line, and pressing Ctrl-C cancels them rather than
+    exiting.
+
     You can define input modes, in which the user can enter text after pressing
     a certain trigger key, like this:
 
@@ -68,9 +81,39 @@ class ModalScrollingInterface(object):
     key_bindings = KeyBindings()
     exit_keys = (ord('q'), ord('Q'))
 
+    # How often (in milliseconds) the idle method is called while the
+    # interface is waiting for input.
+    idle_interval = 50
+
+    # Keys that move by some number of steps, mapped to a (method name,
+    # steps per press) pair. Presses of keys for the same method that come
+    # in a burst (e.g. while a key is held down) are merged, and the method
+    # is called once with the total, so the steps in between are never
+    # worked out. A burst ends when no such key arrives for
+    # coalesce_interval milliseconds.
+    coalesced_keys = {}
+    coalesce_interval = 40
+
     def __init__(self):
         self.scroll_line = 0
         self._highlight_line = 0
+        self._overlay_top = None
+        self.tasks = TaskRunner()
+
+        # What is currently on screen: The state (see row_state) of each
+        # row of the content window, the scroll line it was drawn at, and
+        # the text of the status line. Only rows whose state has changed
+        # are drawn again.
+        self._rows = []
+        self._drawn_scroll_line = 0
+        self._drawn_status = None
+        self._previous_row_state = None
+
+        # When the screen was first drawn (as returned by time.time), for
+        # measuring how long the interface takes to start, and when the
+        # first key that hasn't been reflected on screen yet was pressed.
+        self.first_paint_time = None
+        self._key_time = None
 
     @property
     def highlight_line(self):
@@ -82,7 +125,7 @@ class ModalScrollingInterface(object):
     @highlight_line.setter
     def highlight_line(self, value):
         # Ensure highlighted line in sane
-        max_highlight = len(self.file_history.blame()) - 1
+        max_highlight = self.content_length() - 1
         if value < 0:
             value = 0
         elif value > max_highlight:
@@ -99,10 +142,15 @@ class ModalScrollingInterface(object):
             self.scroll_line = self.highlight_line
 
     def textbox_command(self, textbox, c, prefix):
+        self._key_pressed()
+
         if c in self.get_exit_keys():
             self._teardown_curses()
             self.finalise(c)
             sys.exit(0)
+        elif c in self.coalesced_keys:
+            self._run_coalesced(c, prefix)
+            self._draw()
         elif c in self.key_bindings:
             method = getattr(self, self.key_bindings[c])
             method(prefix)
@@ -110,10 +158,44 @@ class ModalScrollingInterface(object):
         else:
             curses.beep()
 
+    def _run_coalesced(self, key, prefix):
+        name, step = self.coalesced_keys[key]
+        total = step * prefix
+
+        self.command_win.timeout(self.coalesce_interval)
+        try:
+            while True:
+                key = self.command_win.getch()
+                if key == -1:
+                    break
+                if key not in self.coalesced_keys or \
+                   self.coalesced_keys[key][0] != name:
+                    curses.ungetch(key)
+                    break
+                total += self.coalesced_keys[key][1]
+        finally:
+            self.command_win.timeout(self.idle_interval)
+
+        if total:
+            getattr(self, name)(total)
+
     def textbox_mode_changed(self, textbox, mode):
         self._draw()
 
+    def textbox_idle(self, textbox):
+        if self.tasks.poll():
+            self._draw()
+        elif self.tasks.busy:
+            # Keep the progress indicator moving.
+            self._draw_status()
+            self.command_win.noutrefresh()
+            curses.doupdate()
+
+        self.idle()
+
     def textbox_input(self, textbox, mode, data):
+        self._key_pressed()
+
         if mode == textbox.DEFAULT_MODE:
             if not data:
                 self.down()
@@ -134,19 +216,24 @@ class ModalScrollingInterface(object):
 
     def run(self):
         """
-        Starts the curses interface. This method won't return. The app will
-        run in a loop until the user presses one of the exit_keys. If you
-        want to do something else, override the finalise method.
+        Starts the curses interface. The app will run in a loop until the
+        user presses one of the exit_keys (in which case this method won't
+        return, override the finalise method if you want to do something
+        else) or presses Ctrl-C when there is nothing to interrupt.
         """
 
         self._setup_curses()
         self._draw()
 
         try:
-            self.command_input.edit(recurse=True)
-        except KeyboardInterrupt:
-            self._teardown_curses()
-            return
+            while True:
+                try:
+                    self.command_input.edit(recurse=False)
+                except KeyboardInterrupt:
+                    if not self.interrupt():
+                        self._teardown_curses()
+                        return
+                    self._draw()
         except:
             self._teardown_curses()
             raise
@@ -177,6 +264,13 @@ class ModalScrollingInterface(object):
         self.mode_win    = self.screen.subwin(1, 2,   h-1, 0)
         self.command_win = self.screen.subwin(1, w-1, h-1, 1)
 
+        self.command_win.timeout(self.idle_interval)
+
+        # Let curses use the terminal's own line insertion and deletion when
+        # the content scrolls, rather than sending every row again.
+        self.content_win.idlok(True)
+        self._rows = [_DIRTY] * (h - 2)
+
         self.command_input = ModalTextbox(self.command_win, delegate=self)
         for trigger, name in self.get_modes().items():
             self.command_input.add_mode(name, trigger)
@@ -187,16 +281,35 @@ class ModalScrollingInterface(object):
         curses.echo()
         curses.endwin()
 
-    def _draw(self):
-        self.content_win.clear()
-        start = self.scroll_line
-        stop = self.scroll_line + curses.LINES - 2
-        for row, line in enumerate(self.content()[start:stop]):
-            highlight = (row + start == self.highlight_line)
-            self.draw_content_line(line, row, self.content_win, highlight)
+    def _key_pressed(self):
+        if self._key_time is None:
+            self._key_time = time.time()
 
-        self.status_win.clear()
-        self.status_win.addstr(0, 0, self.get_status()[:curses.COLS-1])
+    @profiler.timed('draw')
+    def _draw(self):
+        height = curses.LINES - 2
+        start, stop = self.visible_range()
+        self._scroll_screen(start)
+
+        overlay = self.get_overlay(height // 2) or []
+        overlay_top = height - len(overlay)
+
+        content = self.content()[start:start + overlay_top]
+        for row in range(overlay_top):
+            line = content[row] if row < len(content) else None
+            self._draw_row(row, start + row, line)
+
+        for offset, text in enumerate(overlay):
+            row = overlay_top + offset
+            state = ('overlay', text)
+            if self._rows[row] != state:
+                self.content_win.addstr(row, 0,
+                                        text[:curses.COLS].ljust(curses.COLS),
+                                        self.INV_WHITE)
+                self._rows[row] = state
+        self._overlay_top = overlay_top if overlay else None
+
+        self._draw_status()
 
         mode_char = ':'
         for trigger, name in self.get_modes().items():
@@ -210,6 +323,131 @@ class ModalScrollingInterface(object):
         self.command_win.noutrefresh()
         curses.doupdate()
 
+        if self.first_paint_time is None:
+            self.first_paint_time = time.time()
+
+        # A key's effect is only on screen once any work it started (e.g.
+        # moving to another revision) has finished.
+        if self._key_time is not None and not self.tasks.busy:
+            profiler.record('keystroke to paint', time.time() - self._key_time)
+            self._key_time = None
+
+    def _draw_status(self):
+        status = self.get_status() or ''
+        progress = self.tasks.progress()
+        if progress:
+            status = '[%s] %s' % (progress, status)
+
+        status = status[:curses.COLS-1]
+        if status != self._drawn_status:
+            self.status_win.erase()
+            self.status_win.addstr(0, 0, status)
+            self._drawn_status = status
+            self.status_win.noutrefresh()
+
+    @profiler.timed('draw lines')
+    def _draw_lines(self, indices):
+        # Redraws only the given lines of content, if they are visible and
+        # have changed.
+        start, stop = self.visible_range()
+        if self._overlay_top is not None:
+            stop = min(stop, start + self._overlay_top)
+
+        content = self.content()
+        for index in indices:
+            if start <= index < stop and index < len(content):
+                self._draw_row(index - start, index, content[index])
+
+        self.content_win.noutrefresh()
+        self.command_win.noutrefresh()
+        curses.doupdate()
+
+    def _draw_row(self, row, index, line):
+        # Draws a line of content (or a blank row if line is None) unless
+        # the row already shows the same thing.
+        if line is None:
+            if self._rows[row] is not None:
+                self.content_win.move(row, 0)
+                self.content_win.clrtoeol()
+                self._rows[row] = None
+            return
+
+        highlight = (index == self.highlight_line)
+        state = self.row_state(line, highlight)
+        if state == self._rows[row]:
+            return
+
+        self._previous_row_state = self._rows[row]
+        self.draw_content_line(line, row, self.content_win, highlight)
+        self._rows[row] = state
+        self._previous_row_state = None
+
+    def _scroll_screen(self, scroll_line):
+        # Moves what is already on screen to match the new scroll position,
+        # so that only the rows that have scrolled into view need drawing.
+        delta = scroll_line - self._drawn_scroll_line
+        self._drawn_scroll_line = scroll_line
+        height = len(self._rows)
+        if not delta:
+            return
+
+        if abs(delta) >= height or self._overlay_top is not None:
+            self._rows = [_DIRTY] * height
+            return
+
+        # Scrolling (and the scrolling region, which leaves out the status
+        # line) is only set up while we scroll, since otherwise writing to
+        # the end of the last row would scroll the window or fail.
+        self.content_win.setscrreg(0, height - 1)
+        self.content_win.scrollok(True)
+        self.content_win.scroll(delta)
+        self.content_win.scrollok(False)
+        self.content_win.setscrreg(0, height)
+
+        if delta > 0:
+            self._rows = self._rows[delta:] + [None] * delta
+        else:
+            self._rows = [None] * -delta + self._rows[:delta]
+
+    def previous_row_state(self):
+        """
+        While draw_content_line is running, returns the row_state of what
+        was on that row before (or None if it was blank), so that parts of
+        the row that haven't changed can be skipped.
+        """
+        if self._previous_row_state is _DIRTY:
+            return None
+        return self._previous_row_state
+
+    def row_state(self, line, highlight):
+        """
+        Returns a value describing how the given line of content will look
+        on screen. A row is only drawn again when this value changes, so it
+        must take everything that draw_content_line uses into account.
+        """
+        return (line, highlight)
+
+    def run_task(self, description, work, done=None):
+        """
+        Runs work in the background (see gitbrowse.tasks.Task) and returns
+        the Task. The done callback is called with the result when the work
+        has finished, from the interface's own thread, so it can safely
+        update and redraw the interface.
+        """
+        task = self.tasks.run(description, work, done)
+        self._draw_status()
+        self.command_win.noutrefresh()
+        curses.doupdate()
+        return task
+
+    def visible_range(self):
+        """
+        Returns a (start, stop) tuple of the indices of the lines of content
+        that fit on the screen at the current scroll position.
+        """
+        start = self.scroll_line
+        return start, start + curses.LINES - 2
+
     def content(self):
         """
         Override this method to provide content. It should return a list of
@@ -232,6 +470,13 @@ class ModalScrollingInterface(object):
         color = self.INV_WHITE if highlight else 0
         window.addstr(row, 0, line, color)
 
+    def get_overlay(self, max_lines):
+        """
+        Returns a list of at most max_lines strings to show in a box over
+        the bottom of the content, or None if there's nothing to show.
+        """
+        return None
+
     def get_exit_keys(self):
         """
         Returns a tuple of key codes that should cause the interface to
@@ -254,6 +499,29 @@ class ModalScrollingInterface(object):
         except AttributeError:
             return {}
 
+    def idle(self):
+        """
+        Called regularly while the interface is waiting for input. Override
+        this if you need to update the screen as background work completes.
+        """
+        pass
+
+    def interrupt(self):
+        """
+        Called when the user presses Ctrl-C. Cancels any running tasks and
+        returns True if there was anything to cancel, or False if the
+        interface should exit instead. Override this (and call the
+        superclass) if you have other background work that can be stopped.
+        """
+        interrupted = self.tasks.cancel()
+
+        if self.command_input.mode != ModalTextbox.DEFAULT_MODE:
+            # Abandon the input, as escape would.
+            self.command_input.set_mode(ModalTextbox.DEFAULT_MODE)
+            interrupted = True
+
+        return interrupted
+
     def finalise(self, exit_key):
         """
         Called when the user presses one of the exit keys and the curses
@@ -353,6 +621,10 @@ class ModalTextbox(Textbox, object):
                                                 is the number the user may have
                                                 entered before pressing the
                                                 key.
+
+        textbox_idle(textbox)                   Called regularly when no key
+                                                has been pressed, if the
+                                                window has an input timeout.
     """
 
     DEFAULT_MODE = '__command__'
@@ -400,20 +672,23 @@ class ModalTextbox(Textbox, object):
         The collected text is passed to the delegate's textbox_input method
         along with the current mode.
 
-        If recurse is set, then the edit method will infinitely recurse. If
-        you use this option then you should make sure that there is some way
-        to exit your program (e.g. the delegate's textbox_input or
-        textbox_command method calls sys.exit in some circumstances)
+        If recurse is set, then the edit method will start another editing
+        session after each one, forever (it loops rather than actually
+        recursing, so the stack doesn't grow). If you use this option then
+        you should make sure that there is some way to exit your program
+        (e.g. the delegate's textbox_input or textbox_command method calls
+        sys.exit in some circumstances)
         """
-        data = super(ModalTextbox, self).edit(validate=self._process_key)
-        data_mode = self.mode
+        while True:
+            data = super(ModalTextbox, self).edit(validate=self._process_key)
+            data_mode = self.mode
 
-        self.win.erase()
-        self.mode = self.DEFAULT_MODE
-        self.delegate.textbox_input(self, data_mode, data.strip())
+            self.win.erase()
+            self.mode = self.DEFAULT_MODE
+            self.delegate.textbox_input(self, data_mode, data.strip())
 
-        if recurse:
-            self.edit(recurse)
+            if not recurse:
+                return
 
     def clear(self):
         """
@@ -431,6 +706,11 @@ class ModalTextbox(Textbox, object):
             return key
 
     def _process_key(self, key):
+        if key == -1:
+            # getch timed out without a key being pressed
+            self.delegate.textbox_idle(self)
+            return None
+
         if self.mode == self.DEFAULT_MODE:
             if ord('0') <= key <= ord('9') or key in self.EDIT_KEYS:
                 return self._transform_input_key(key)
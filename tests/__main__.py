@@ -3,10 +3,38 @@ import sys
 import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from git import GitTestCase
+from git import (GitTestCase, GitCommitListTestCase, GitObjectStoreTestCase,
+                 GitBlameTestCase, StreamingBlameTestCase)
+from cache import LRUCacheTestCase
+from diff import DiffTestCase
+from diskcache import DiskCacheTestCase
+from prefetch import PrefetcherTestCase
+from search import SearchIndexTestCase, HistorySearchTestCase
+from tasks import TaskRunnerTestCase
+from profiling import ProfilerTestCase
+from trace import TraceTestCase
+from session import SessionTestCase
+from daemon import DaemonTestCase
+from objects import ObjectsTestCase
 
 suite = unittest.TestSuite()
 suite.addTest(unittest.makeSuite(GitTestCase))
+suite.addTest(unittest.makeSuite(GitCommitListTestCase))
+suite.addTest(unittest.makeSuite(GitObjectStoreTestCase))
+suite.addTest(unittest.makeSuite(GitBlameTestCase))
+suite.addTest(unittest.makeSuite(StreamingBlameTestCase))
+suite.addTest(unittest.makeSuite(LRUCacheTestCase))
+suite.addTest(unittest.makeSuite(DiffTestCase))
+suite.addTest(unittest.makeSuite(DiskCacheTestCase))
+suite.addTest(unittest.makeSuite(PrefetcherTestCase))
+suite.addTest(unittest.makeSuite(SearchIndexTestCase))
+suite.addTest(unittest.makeSuite(HistorySearchTestCase))
+suite.addTest(unittest.makeSuite(TaskRunnerTestCase))
+suite.addTest(unittest.makeSuite(ProfilerTestCase))
+suite.addTest(unittest.makeSuite(TraceTestCase))
+suite.addTest(unittest.makeSuite(SessionTestCase))
+suite.addTest(unittest.makeSuite(DaemonTestCase))
+suite.addTest(unittest.makeSuite(ObjectsTestCase))
 
 os.popen(os.path.join(os.path.dirname(__file__), "createrepo.sh"))
 os.chdir(os.path.join(os.path.dirname(__file__), "repo"))
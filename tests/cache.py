@@ -0,0 +1,60 @@
+from unittest import TestCase
+from gitbrowse.cache import LRUCache
+
+class LRUCacheTestCase(TestCase):
+    def test_get_and_put(self):
+        cache = LRUCache()
+        cache.put('a', 1)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('b', 2), 2)
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+    def test_peek(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.peek('a'), 1)
+        self.assertEquals(cache.peek('c'), None)
+        self.assertEquals((cache.hits, cache.misses), (0, 0))
+
+        cache.put('c', 3)
+        self.assertFalse('a' in cache, 'Peeking should not count as a use')
+
+    def test_entry_budget(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache, 'The least recently used entry '
+                         'should be evicted')
+        self.assertTrue('c' in cache)
+
+    def test_byte_budget(self):
+        cache = LRUCache(max_bytes=100)
+        cache.put('a', 1, size=60)
+        cache.put('b', 2, size=30)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.size, 90)
+
+        cache.put('c', 3, size=30)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.size, 60)
+        self.assertFalse('a' in cache)
+
+    def test_oversized_entry_is_kept(self):
+        cache = LRUCache(max_bytes=10)
+        cache.put('a', 1, size=5)
+        cache.put('b', 2, size=50)
+        self.assertEquals(cache.get('b'), 2)
+        self.assertFalse('a' in cache)
+
+    def test_replace(self):
+        cache = LRUCache(max_bytes=100)
+        cache.put('a', 1, size=60)
+        cache.put('a', 2, size=20)
+        self.assertEquals(cache.get('a'), 2)
+        self.assertEquals(cache.size, 20)
@@ -56,4 +56,9 @@ fourth
 fifth
 EOF
 
+cat > other.txt << EOF
+other
+EOF
+
+git add other.txt
 git commit -am 'Fifth commit' > /dev/null
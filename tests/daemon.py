@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from gitbrowse.daemon import Daemon, DaemonClient
+from gitbrowse.git import GitFileHistory, git
+
+class DaemonTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.sock')
+
+        self.daemon = Daemon(self.path,
+                             git('rev-parse', '--absolute-git-dir').strip(),
+                             idle_timeout=0.2)
+        self.daemon.poll_interval = 0.05
+        self.assertTrue(self.daemon.listen())
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.client = DaemonClient.connect(self.path, os.getcwd())
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.join(5)
+        shutil.rmtree(self.directory)
+
+    def wait_for_history(self, rev, path):
+        for _ in range(100):
+            shas = self.client.get_history(rev, path)
+            if shas is not None:
+                return shas
+            time.sleep(0.02)
+
+    def test_only_one_daemon_listens(self):
+        other = Daemon(self.path, self.daemon.git_dir)
+        self.assertFalse(other.listen())
+
+    def test_round_trip(self):
+        lines = [('a' * 40, 1, 'first\n'), ('b' * 40, 7, 'last')]
+        self.client.put_blame('c' * 40, 'example.txt', lines)
+        self.assertEquals(self.client.get_blame('c' * 40, 'example.txt'),
+                          lines)
+        self.assertEquals(self.client.get_blame('c' * 40, 'other.txt'),
+                          None)
+
+        forward, backward = {0: 0, 1: None}, {0: 0}
+        self.client.put_mappings('a' * 40, 'b' * 40, forward, backward)
+        self.assertEquals(self.client.get_mappings('b' * 40, 'a' * 40),
+                          (backward, forward))
+
+    def test_file_history_uses_daemon(self):
+        first = GitFileHistory('example.txt', 'HEAD', disk_cache=self.client)
+        shas = [c.sha for c in first.commits]
+        blame = first.blame().rows()
+        self.assertEquals(self.wait_for_history('HEAD', 'example.txt'), shas)
+
+        second = GitFileHistory('example.txt', 'HEAD',
+                                disk_cache=self.client)
+        def no_git(*args, **kwargs):
+            self.fail('Cached results should come from the daemon')
+        second._run_blame = no_git
+
+        self.assertTrue(second.commits.complete)
+        self.assertEquals([c.sha for c in second.commits], shas)
+        self.assertEquals(second.blame().rows(), blame)
+
+    def test_histories_are_dropped_when_refs_move(self):
+        self.wait_for_history('HEAD', 'example.txt')
+
+        git('update-ref', 'refs/heads/daemon-test', 'HEAD')
+        try:
+            self.assertEquals(
+                self.client.get_history('HEAD', 'example.txt'),
+                None,
+            )
+        finally:
+            git('update-ref', '-d', 'refs/heads/daemon-test')
+
+    def test_idle_shutdown(self):
+        self.client.close()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.path))
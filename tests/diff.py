@@ -0,0 +1,82 @@
+import random
+import time
+from unittest import TestCase
+from gitbrowse.diff import matching_lines, line_mappings, _myers
+
+class DiffTestCase(TestCase):
+    def test_matching_lines(self):
+        a = ['a\n', 'b\n', 'c\n', 'd\n']
+        b = ['a\n', 'c\n', 'x\n', 'd\n']
+        self.assertEquals(matching_lines(a, b), [(0, 0), (2, 1), (3, 3)])
+
+    def test_matches_are_valid(self):
+        rand = random.Random(42)
+        for _ in range(50):
+            a = [rand.choice('abcde\n') for _ in range(rand.randint(0, 30))]
+            b = [rand.choice('abcde\n') for _ in range(rand.randint(0, 30))]
+            matches = matching_lines(a, b)
+
+            for i, j in matches:
+                self.assertEquals(a[i], b[j])
+            for (i1, j1), (i2, j2) in zip(matches, matches[1:]):
+                self.assertTrue(i1 < i2 and j1 < j2)
+
+    def test_blank_line_added(self):
+        forward, backward = line_mappings(
+            ['a\n', 'b\n'],
+            ['a\n', '\n', 'b\n'],
+        )
+        self.assertEquals(forward, {0: 0, 1: 2, 2: 3})
+        self.assertEquals(backward, {0: 0, 1: None, 2: 1, 3: 2})
+
+    def test_changed_lines_are_paired(self):
+        forward, backward = line_mappings(
+            ['a\n', 'b\n', 'c\n', 'd\n'],
+            ['a\n', 'B\n', 'd\n'],
+        )
+        self.assertEquals(forward, {0: 0, 1: 1, 2: None, 3: 2, 4: 3})
+        self.assertEquals(backward, {0: 0, 1: 1, 2: 3, 3: 4})
+
+    def test_empty_files(self):
+        self.assertEquals(line_mappings([], []), ({0: 0}, {0: 0}))
+        self.assertEquals(
+            line_mappings([], ['a\n']),
+            ({0: 1}, {0: None, 1: 0}),
+        )
+
+    def test_myers_finds_shortest_edit_script(self):
+        def longest_common_subsequence(a, b):
+            previous = [0] * (len(b) + 1)
+            for line in a:
+                row = [0]
+                for j, other in enumerate(b):
+                    row.append(previous[j] + 1 if line == other
+                               else max(previous[j + 1], row[j]))
+                previous = row
+            return previous[-1]
+
+        rand = random.Random(42)
+        for _ in range(200):
+            a = [rand.choice('abc') for _ in range(rand.randint(0, 30))]
+            b = [rand.choice('abc') for _ in range(rand.randint(0, 30))]
+            matches = _myers(a, 0, len(a), b, 0, len(b))
+
+            self.assertEquals(len(matches), longest_common_subsequence(a, b))
+            for i, j in matches:
+                self.assertEquals(a[i], b[j])
+
+    def test_rewritten_file(self):
+        # Diffing two completely different files mustn't take time (or
+        # memory) in proportion to the square of their size. The whole file
+        # is one replaced block, so the lines are paired up in order.
+        a = ['old line %d\n' % i for i in range(20000)]
+        b = ['new line %d\n' % i for i in range(20000)]
+
+        start = time.time()
+        forward, backward = line_mappings(a, b)
+        self.assertTrue(time.time() - start < 5,
+                        'Diffing a rewritten file took too long')
+
+        expected = dict((i, i) for i in range(20001))
+        self.assertEquals(forward, expected)
+        self.assertEquals(backward, expected)
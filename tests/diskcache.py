@@ -0,0 +1,172 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import TestCase
+import gitbrowse.git
+from gitbrowse.diskcache import DiskCache
+from gitbrowse.git import GitFileHistory, GitObjectStore, git, git_popen
+
+class DiskCacheTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.disk_cache = DiskCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_blame_round_trip(self):
+        lines = [
+            ('a' * 40, 1, 'first\n'),
+            ('b' * 40, 7, '\n'),
+            ('a' * 40, 2, 'last'),
+        ]
+        self.disk_cache.put_blame('c' * 40, 'example.txt', lines)
+        self.assertEquals(
+            self.disk_cache.get_blame('c' * 40, 'example.txt'),
+            lines,
+        )
+        self.assertEquals(self.disk_cache.get_blame('c' * 40, 'other.txt'),
+                          None)
+        self.assertEquals(
+            self.disk_cache.get_blame('c' * 40, 'example.txt', copies=True),
+            None,
+        )
+
+    def test_mappings_round_trip(self):
+        forward = {0: 0, 1: None, 2: 1}
+        backward = {0: 0, 1: 2}
+        self.disk_cache.put_mappings('a' * 40, 'b' * 40, forward, backward)
+
+        self.assertEquals(self.disk_cache.get_mappings('a' * 40, 'b' * 40),
+                          (forward, backward))
+        self.assertEquals(self.disk_cache.get_mappings('b' * 40, 'a' * 40),
+                          (backward, forward))
+        self.assertEquals(self.disk_cache.get_mappings('a' * 40, 'c' * 40),
+                          None)
+
+    def test_eviction(self):
+        for i in range(10):
+            self.disk_cache.put_blame(str(i), 'example.txt',
+                                      [('a' * 40, 1, 'x' * 1000)])
+            # Make sure each entry has a different, increasing mtime.
+            path = self.disk_cache._entry_path('blame', str(i), 'example.txt')
+            os.utime(path, (i, i))
+
+        self.disk_cache.max_bytes = 3 * os.path.getsize(path)
+        self.disk_cache.evict()
+
+        self.assertEquals(self.disk_cache.get_blame('0', 'example.txt'), None)
+        self.assertNotEquals(self.disk_cache.get_blame('9', 'example.txt'),
+                             None)
+
+    def test_read_when_entry_cannot_be_touched(self):
+        lines = [('a' * 40, 1, 'text\n')]
+        self.disk_cache.put_blame('c' * 40, 'example.txt', lines)
+
+        def utime(path, times):
+            raise OSError('Read-only file system')
+        real_utime = os.utime
+        os.utime = utime
+        try:
+            self.assertEquals(
+                self.disk_cache.get_blame('c' * 40, 'example.txt'),
+                lines,
+            )
+        finally:
+            os.utime = real_utime
+
+    def test_failed_write_leaves_no_files(self):
+        def rename(source, destination):
+            raise OSError('No space left on device')
+        real_rename = os.rename
+        os.rename = rename
+        try:
+            self.disk_cache.put_blame('c' * 40, 'example.txt',
+                                      [('a' * 40, 1, 'text\n')])
+        finally:
+            os.rename = real_rename
+
+        self.assertEquals(
+            [files for _, _, files in os.walk(self.path) if files],
+            [],
+        )
+
+    def test_file_history_uses_disk_cache(self):
+        first = GitFileHistory('example.txt', 'HEAD',
+                               disk_cache=self.disk_cache)
+        commits = first.commits
+        expected_blame = [(l.sha, l.line, l.current, l.original_line,
+                           l.final_line) for l in first.blame()]
+        expected_mapping = first.line_mapping(commits[1].sha, commits[0].sha)
+
+        second = GitFileHistory('example.txt', 'HEAD',
+                                disk_cache=self.disk_cache)
+        def no_git(*args, **kwargs):
+            self.fail('Cached results should be read from disk')
+        second._run_blame = no_git
+        second._build_line_mappings = no_git
+
+        self.assertEquals(
+            [(l.sha, l.line, l.current, l.original_line, l.final_line)
+             for l in second.blame()],
+            expected_blame,
+        )
+        self.assertEquals(
+            second.line_mapping(commits[0].sha, commits[1].sha),
+            first.line_mapping(commits[0].sha, commits[1].sha),
+        )
+        self.assertEquals(
+            second.line_mapping(commits[1].sha, commits[0].sha),
+            expected_mapping,
+        )
+
+    def test_paths_are_relative_to_the_work_tree(self):
+        # A commit, outside of any branch, with a different x.txt in each of
+        # two directories.
+        trees = {}
+        for directory in ('a', 'b'):
+            blob = self.hash_object('%s\n' % directory)
+            trees[directory] = self.make_tree('100644 blob %s\tx.txt' % blob)
+        root = self.make_tree('\n'.join('040000 tree %s\t%s' % (t, d)
+                                        for d, t in sorted(trees.items())))
+        commit = git('commit-tree', root, '-m', 'Two x.txts').strip()
+
+        work_tree = os.getcwd()
+        self.disk_cache.work_tree = work_tree
+        os.mkdir('a')
+        os.mkdir('b')
+        self.addCleanup(os.rmdir, 'a')
+        self.addCleanup(os.rmdir, 'b')
+
+        # Opening x.txt from b mustn't find the blame of a/x.txt, but
+        # opening it from a again should.
+        blames = {}
+        for directory in ('a', 'b', 'a'):
+            os.chdir(directory)
+            store = gitbrowse.git._object_store
+            gitbrowse.git._object_store = GitObjectStore()
+            try:
+                history = GitFileHistory('x.txt', commit,
+                                         disk_cache=self.disk_cache)
+                cached = history.cached_blame()
+                blame = history.blame().rows()
+            finally:
+                gitbrowse.git._object_store.close()
+                gitbrowse.git._object_store = store
+                os.chdir(work_tree)
+
+            self.assertEquals(blame, [(commit, 1, directory + '\n')])
+            if directory in blames:
+                self.assertEquals(cached.rows(), blame)
+            else:
+                self.assertEquals(cached, None)
+            blames[directory] = blame
+
+    def hash_object(self, text):
+        p = git_popen('hash-object', '-w', '--stdin', stdin=subprocess.PIPE)
+        return p.communicate(text)[0].strip()
+
+    def make_tree(self, entries):
+        p = git_popen('mktree', stdin=subprocess.PIPE)
+        return p.communicate(entries + '\n')[0].strip()
@@ -1,5 +1,10 @@
+import subprocess
+import time
 from unittest import TestCase
-from gitbrowse.git import GitFileHistory
+import gitbrowse.git
+from gitbrowse.git import (GitFileHistory, GitObjectStore, GitCommitList,
+                           GitBlame, LineHistory, git, git_popen,
+                           object_store)
 
 class GitTestCase(TestCase):
     def setUp(self):
@@ -24,6 +29,49 @@ class GitTestCase(TestCase):
         self.file_history.next()
         self.assertEquals(self.file_history.current_commit, commits[1])
 
+    def test_invalid_revision(self):
+        try:
+            GitFileHistory('example.txt', 'no-such-branch')
+        except ValueError as err:
+            self.assertEquals(
+                str(err),
+                'no-such-branch is not a valid commit, branch, tag, etc.',
+            )
+        else:
+            self.fail('An invalid revision should raise a ValueError')
+
+    def test_untracked_path(self):
+        try:
+            GitFileHistory('missing.txt', 'HEAD')
+        except ValueError as err:
+            self.assertEquals(str(err),
+                              '"missing.txt" is not tracked by git at HEAD')
+        else:
+            self.fail('An untracked path should raise a ValueError')
+
+        # A path with a space in it, which git's reply repeats.
+        self.assertRaises(ValueError, GitFileHistory, 'x y', 'HEAD')
+        self.assertRaises(ValueError, GitFileHistory, 'example.txt',
+                          'HEAD no-such-branch')
+
+        # A file that exists, but not yet at the given commit.
+        first = self.file_history.commits[4].sha
+        self.assertRaises(ValueError, GitFileHistory, 'other.txt', first)
+
+        # A directory, in a commit (outside of any branch) that puts the
+        # current tree in one.
+        tree = git('rev-parse', 'HEAD^{tree}').strip()
+        p = git_popen('mktree', stdin=subprocess.PIPE)
+        root = p.communicate('040000 tree %s\tdirectory\n' % tree)[0]
+        commit = git('commit-tree', root.strip(), '-m', 'Directory').strip()
+        try:
+            GitFileHistory('directory', commit)
+        except ValueError as err:
+            self.assertEquals(str(err), '"directory" is not tracked by git '
+                              'at %s' % commit)
+        else:
+            self.fail('A directory should raise a ValueError')
+
     def test_navigation_beyond_end(self):
         commits = self.file_history.commits
 
@@ -41,6 +89,35 @@ class GitTestCase(TestCase):
         self.file_history.prev()
         self.assertEquals(self.file_history.current_commit, commits[4])
 
+    def test_go_to(self):
+        commits = self.file_history.commits
+
+        self.assertTrue(self.file_history.go_to(3))
+        self.assertEquals(self.file_history.current_commit, commits[3])
+        self.assertFalse(self.file_history.go_to(5))
+        self.assertFalse(self.file_history.go_to(-1))
+        self.assertEquals(self.file_history.current_commit, commits[3])
+
+    def test_map_line_directly(self):
+        misses = self.file_history.cache.misses
+        self.assertEquals(self.file_history.map_line(0, 4, 0), 3)
+        self.assertEquals(self.file_history.map_line(1, 4, 0), None)
+        self.assertEquals(self.file_history.map_line(3, 0, 4), 0)
+
+        # One mapping (and its reverse) for the whole jump
+        self.assertEquals(self.file_history.cache.misses, misses + 1)
+
+    def test_map_line_through_cached_steps(self):
+        commits = self.file_history.commits
+        for i in range(4):
+            self.file_history.line_mapping(commits[i + 1].sha,
+                                           commits[i].sha)
+
+        misses = self.file_history.cache.misses
+        self.assertEquals(self.file_history.map_line(0, 4, 0), 3)
+        self.assertEquals(self.file_history.map_line(1, 4, 0), None)
+        self.assertEquals(self.file_history.cache.misses, misses)
+
     def test_blame(self):
         commits = self.file_history.commits
         for _ in range(5):
@@ -84,6 +161,48 @@ class GitTestCase(TestCase):
             [2, 1, 2, 4, 4, 4],
         )
 
+    def test_blame_is_cached(self):
+        first_blame = self.file_history.blame()
+        self.file_history.prev()
+        self.file_history.blame()
+        self.file_history.next()
+
+        misses = self.file_history.cache.misses
+        self.assertTrue(self.file_history.blame() is first_blame)
+        self.assertEquals(self.file_history.cache.misses, misses)
+
+    def test_line_mappings_are_cached_in_both_directions(self):
+        commits = self.file_history.commits
+        forward = self.file_history.line_mapping(commits[1].sha,
+                                                 commits[0].sha)
+        misses = self.file_history.cache.misses
+
+        self.assertTrue(forward is self.file_history.line_mapping(
+            commits[1].sha, commits[0].sha))
+        self.file_history.line_mapping(commits[0].sha, commits[1].sha)
+        self.assertEquals(self.file_history.cache.misses, misses)
+
+    def test_line_mappings_from_blame(self):
+        commits = self.file_history.commits
+        expected = GitFileHistory('example.txt', 'HEAD')
+
+        for commit in commits:
+            self.file_history.blame(commit.sha)
+
+        def no_git(*args):
+            self.fail('Mappings between blamed revisions should not need '
+                      'the file contents from git')
+        self.file_history.text = no_git
+
+        for i in range(4):
+            for start, finish in ((i + 1, i), (i, i + 1)):
+                self.assertEquals(
+                    self.file_history.line_mapping(commits[start].sha,
+                                                   commits[finish].sha),
+                    expected.line_mapping(commits[start].sha,
+                                          commits[finish].sha),
+                )
+
     def test_forward_line_mappings(self):
         commits = self.file_history.commits
 
@@ -129,3 +248,306 @@ class GitTestCase(TestCase):
             {0:0, 1:3, 2:4, 3:5},
             self.file_history.line_mapping(commits[3].sha, commits[4].sha),
         )
+
+    def test_line_history(self):
+        shas = [c.sha for c in self.file_history.commits]
+
+        # "fifth" hasn't changed since the first commit, and "another" was
+        # added by the third.
+        self.assertEquals(self.file_history.line_history(5), [shas[4]])
+        self.assertEquals(self.file_history.line_history(0), [shas[2]])
+        self.assertTrue(('line history', 'example.txt', shas[0], 0)
+                        in self.file_history.cache)
+
+        history = LineHistory(self.file_history, 0)
+        history.start()
+        history.wait()
+        self.assertTrue(history.complete)
+        self.assertTrue(history.updated())
+        self.assertEquals(history.entries(), [(2, None)])
+
+    def test_blame_following_copies(self):
+        # Two commits, outside of any branch, the second of which moves two
+        # lines (long enough for git to notice) to the end of the file.
+        lines = ['the first line that will be moved down\n',
+                 'the second line that will be moved down\n',
+                 'a line that stays where it is\n',
+                 'another line that stays put\n']
+        first = self.commit(''.join(lines))
+        second = self.commit(''.join(lines[2:] + lines[:2]), first)
+
+        file_history = GitFileHistory('example.txt', second)
+        plain = file_history.blame()
+        self.assertEquals(file_history.cached_blame(copies=True), None)
+
+        copies = file_history.blame(copies=True)
+        self.assertEquals([plain.sha(i) for i in range(4)],
+                          [first, first, second, second])
+        self.assertEquals([copies.sha(i) for i in range(4)], [first] * 4)
+        self.assertEquals(copies.original_line(2), 1)
+
+        self.assertTrue(file_history.cached_blame() is plain)
+        self.assertTrue(file_history.cached_blame(copies=True) is copies)
+
+    def commit(self, text, parent=None):
+        p = git_popen('hash-object', '-w', '--stdin', stdin=subprocess.PIPE)
+        blob = p.communicate(text)[0].strip()
+
+        p = git_popen('mktree', stdin=subprocess.PIPE)
+        tree = p.communicate('100644 blob %s\texample.txt\n' % blob)[0]
+
+        parents = ('-p', parent) if parent else ()
+        return git('commit-tree', tree.strip(), '-m', 'Moving lines',
+                   *parents).strip()
+
+
+class GitCommitListTestCase(TestCase):
+    def setUp(self):
+        self.commits = GitCommitList('HEAD', 'example.txt', object_store(),
+                                     page_size=2)
+
+    def test_commits_are_read_on_demand(self):
+        self.assertEquals(self.commits.loaded, 0)
+        self.commits[0]
+        self.assertTrue(self.commits.loaded < 5)
+        self.assertFalse(self.commits.complete)
+
+        self.assertTrue(self.commits.exists(4))
+        self.assertFalse(self.commits.exists(5))
+        self.assertTrue(self.commits.complete)
+        self.assertEquals(len(self.commits), 5)
+
+    def test_indexing(self):
+        shas = [c.sha for c in self.commits]
+        self.assertEquals(len(shas), 5)
+        self.assertEquals(self.commits[-1].sha, shas[-1])
+        self.assertRaises(IndexError, lambda: self.commits[5])
+
+    def test_index_of_sha(self):
+        last = git('rev-list', '--max-parents=0', 'HEAD').strip()
+        self.assertEquals(self.commits.index(last), 4)
+        self.assertEquals(self.commits.index('0' * 40), None)
+
+    def test_metadata(self):
+        commit = self.commits[2]
+        self.assertEquals(commit._message, None)
+        self.assertEquals(commit.message, 'Third commit')
+        self.assertEquals(
+            commit.author,
+            git('log', '-1', '--format=%an', commit.sha).strip(),
+        )
+
+
+class GitObjectStoreTestCase(TestCase):
+    def setUp(self):
+        self.store = GitObjectStore()
+        self.commits = GitFileHistory('example.txt', 'HEAD').commits
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_read(self):
+        self.assertEquals(
+            self.store.read(self.commits[3].sha + ':example.txt'),
+            'first\nfourth\nfifth\n',
+        )
+
+    def test_info(self):
+        sha, obj_type, size = self.store.info(self.commits[0].sha)
+        self.assertEquals(sha, self.commits[0].sha)
+        self.assertEquals(obj_type, 'commit')
+
+        sha, obj_type, size = self.store.info('HEAD:example.txt')
+        self.assertEquals(obj_type, 'blob')
+        self.assertEquals(size, 40)
+
+    def test_missing_objects(self):
+        self.assertEquals(self.store.info('HEAD:missing.txt'), None)
+        self.assertEquals(self.store.info('HEAD:missing file'), None)
+        self.assertEquals(self.store.read('HEAD:missing file'), None)
+        self.assertEquals(self.store.read('HEAD:missing.txt'), None)
+        self.assertEquals(
+            self.store.read('HEAD:example.txt').split('\n')[0],
+            'another',
+            'The store should still work after a missing object',
+        )
+
+    def test_interrupted_requests(self):
+        class Interrupted(object):
+            # Stands in for git's output, with a KeyboardInterrupt arriving
+            # before the first answer has been read.
+            def __init__(self, stdout):
+                self.stdout = stdout
+                self.interrupted = False
+            def readline(self):
+                line = self.stdout.readline()
+                if not self.interrupted:
+                    self.interrupted = True
+                    raise KeyboardInterrupt()
+                return line
+            def read(self, size):
+                return self.stdout.read(size)
+
+        self.store.start()
+        for p in (self.store._batch, self.store._batch_check):
+            p.stdout = Interrupted(p.stdout)
+
+        self.assertRaises(KeyboardInterrupt, self.store.read,
+                          self.commits[0].sha + ':example.txt')
+        self.assertRaises(KeyboardInterrupt, self.store.info,
+                          self.commits[0].sha)
+
+        # The answers that weren't read mustn't be taken for the answers to
+        # later requests.
+        self.assertEquals(
+            self.store.read(self.commits[3].sha + ':example.txt'),
+            'first\nfourth\nfifth\n',
+        )
+        self.assertEquals(self.store.info('HEAD:example.txt')[2], 40)
+
+
+class StreamingBlameTestCase(TestCase):
+    def setUp(self):
+        self.file_history = GitFileHistory('example.txt', 'HEAD')
+
+    def test_text_is_available_before_blaming(self):
+        stream = self.file_history.stream_blame()
+        self.assertEquals(
+            [l.line for l in stream.lines],
+            ['another\n', '\n', 'yet another\n', 'first\n', 'fourth\n',
+             'fifth\n'],
+        )
+        self.assertEquals([l.sha for l in stream.lines], [None] * 6)
+
+    def test_streamed_blame_matches_blame(self):
+        stream = self.file_history.stream_blame()
+        stream.start(first=(3, 5))
+        stream.wait()
+
+        self.assertTrue(stream.complete)
+        self.assertEquals(stream.updates(), range(6))
+        self.assertEquals(stream.updates(), [])
+
+        cached = self.file_history.cached_blame()
+        self.assertTrue(cached is stream.lines)
+
+        self.file_history.cache.clear()
+        expected = self.file_history.blame()
+        for streamed, blamed in zip(stream.lines, expected):
+            self.assertEquals(streamed.sha, blamed.sha)
+            self.assertEquals(streamed.current, blamed.current)
+            self.assertEquals(streamed.original_line, blamed.original_line)
+            self.assertEquals(streamed.final_line, blamed.final_line)
+
+    def test_cancelled_stream_is_not_cached(self):
+        stream = self.file_history.stream_blame()
+        stream.cancel()
+        stream.start()
+        stream.wait()
+
+        self.assertFalse(stream.complete)
+        self.assertEquals(self.file_history.cached_blame(), None)
+
+    def test_chunked_blame(self):
+        expected = [(l.sha, l.original_line)
+                    for l in self.file_history.blame()]
+        self.file_history.cache.clear()
+
+        stream = self.file_history.stream_blame(chunk_size=2)
+        stream.start(first=(0, 1))
+        deadline = time.time() + 5
+        while stream.blamed < 4:
+            if time.time() > deadline:
+                stream.cancel()
+                self.fail('The first two chunks were not blamed within 5 '
+                          'seconds (%d lines blamed)' % stream.blamed)
+            time.sleep(0.01)
+
+        # The visible chunk and the one after it.
+        self.assertEquals(sorted(stream.updates()), range(4))
+        self.assertEquals(stream.blamed, 4)
+        self.assertFalse(stream.complete)
+
+        # A new stream starts with the chunks that have been blamed.
+        again = self.file_history.stream_blame(chunk_size=2)
+        self.assertEquals([l.sha is not None for l in again.lines],
+                          [True] * 4 + [False] * 2)
+
+        stream.request(5, 6)
+        stream.wait(5)
+        if not stream.complete:
+            stream.cancel()
+            self.fail('The last chunk was not blamed within 5 seconds')
+        self.assertEquals([(l.sha, l.original_line) for l in stream.lines],
+                          expected)
+        self.assertTrue(self.file_history.cached_blame() is stream.lines)
+
+
+    def test_failed_chunk_is_not_cached(self):
+        real_popen = gitbrowse.git.git_popen
+        gitbrowse.git.git_popen = lambda *args, **kwargs: subprocess.Popen(
+            ['false'], stdout=subprocess.PIPE,
+        )
+        try:
+            stream = self.file_history.stream_blame(chunk_size=2)
+            stream.start(first=(0, 1))
+            stream.wait(5)
+        finally:
+            gitbrowse.git.git_popen = real_popen
+
+        self.assertTrue(stream.failed)
+        self.assertFalse(stream.running)
+        self.assertFalse(stream.complete)
+
+        # A later stream blames the chunk properly.
+        again = self.file_history.stream_blame(chunk_size=2)
+        self.assertEquals([l.sha for l in again.lines],
+                          [None] * len(again.lines))
+        again.start(first=(0, 1))
+        again.request(0, len(again.lines))
+        again.wait(5)
+        self.assertTrue(again.complete)
+
+
+class GitBlameTestCase(TestCase):
+    def setUp(self):
+        self.blame = GitBlame.from_rows('c' * 40, [
+            ('a' * 40, 1, 'first\n'),
+            ('c' * 40, 1, 'form\x0cfeed\r\n'),
+            ('a' * 40, 3, 'last'),
+        ])
+
+    def test_accessors(self):
+        self.assertEquals(len(self.blame), 3)
+        self.assertEquals(self.blame.sha(0), 'a' * 40)
+        self.assertEquals(self.blame.line(1), 'form\x0cfeed\r\n')
+        self.assertEquals(self.blame.original_line(2), 3)
+        self.assertFalse(self.blame.current(0))
+        self.assertTrue(self.blame.current(1))
+        self.assertEquals(self.blame.lines(),
+                          ['first\n', 'form\x0cfeed\r\n', 'last'])
+
+    def test_lines(self):
+        line = self.blame[-1]
+        self.assertEquals(
+            (line.sha, line.line, line.current, line.original_line,
+             line.final_line),
+            ('a' * 40, 'last', False, 3, 3),
+        )
+        self.assertEquals([l.line for l in self.blame[1:]],
+                          ['form\x0cfeed\r\n', 'last'])
+        self.assertRaises(IndexError, lambda: self.blame[3])
+
+    def test_rows(self):
+        rows = self.blame.rows()
+        self.assertEquals(GitBlame.from_rows('c' * 40, rows).rows(), rows)
+
+    def test_unblamed_lines(self):
+        blame = GitBlame('c' * 40, 'one\ntwo\n')
+        self.assertEquals(len(blame), 2)
+        self.assertEquals(blame[0].sha, None)
+        self.assertFalse(blame.is_blamed(1))
+
+        blame.set(1, 'a' * 40, 5)
+        self.assertTrue(blame.is_blamed(1))
+        self.assertEquals(blame[1].original_line, 5)
@@ -0,0 +1,138 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from unittest import TestCase
+from gitbrowse.git import GitObjectStore, git, git_popen
+from gitbrowse.objects import ObjectReader, apply_delta, repository_reader
+
+class ObjectsTestCase(TestCase):
+    def setUp(self):
+        self.reader = repository_reader()
+        self.store = GitObjectStore()
+
+    def tearDown(self):
+        self.reader.close()
+        self.store.close()
+
+    def assertSameObjects(self, reader, store, names):
+        for name in names:
+            self.assertEquals(reader.read(name), store.read(name))
+            self.assertEquals(reader.info(name), store.info(name))
+
+    def test_loose_objects(self):
+        commits = git('rev-list', 'HEAD').split()
+        names = commits + [c + ':example.txt' for c in commits]
+        self.assertSameObjects(self.reader, self.store, names)
+
+    def test_relative_paths(self):
+        sha = git('rev-parse', 'HEAD').strip()
+        self.assertEquals(self.reader.read(sha + ':./example.txt'),
+                          self.store.read(sha + ':example.txt'))
+
+    def test_unknown_names(self):
+        sha = git('rev-parse', 'HEAD').strip()
+        self.assertEquals(self.reader.read('HEAD:example.txt'), None)
+        self.assertEquals(self.reader.read(sha + ':missing.txt'), None)
+        self.assertEquals(self.reader.info('0' * 40), None)
+
+    def packed_copy(self):
+        # Returns the directory of a bare copy of the repository with all of
+        # its objects in a pack, and the names of those objects.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        git('clone', '-q', '--bare', '--no-local', '.', directory)
+        git('-C', directory, 'repack', '-q', '-a', '-d', '-f',
+            '--depth=50', '--window=50')
+
+        objects = git('-C', directory, 'rev-list', '--objects', '--all')
+        names = [line.split(' ')[0] for line in objects.split('\n') if line]
+        return directory, names
+
+    def test_packed_objects(self):
+        directory, names = self.packed_copy()
+        reader = ObjectReader(os.path.join(directory, 'objects'))
+        store = GitObjectStore()
+        store._start = lambda mode: git_popen(
+            '-C', directory, 'cat-file', mode, stdin=subprocess.PIPE,
+        )
+
+        self.assertSameObjects(reader, store, names)
+
+        reader.close()
+        store.close()
+
+    def test_info_reads_only_headers(self):
+        # A repository with versions of a file big enough to be deltified.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        git('init', '-q', directory)
+        lines = ['line %d\n' % (i, ) for i in range(500)]
+        for version in range(5):
+            lines[version * 100] = 'version %d\n' % (version, )
+            with open(os.path.join(directory, 'file.txt'), 'w') as f:
+                f.write(''.join(lines))
+            git('-C', directory, 'add', 'file.txt')
+            git('-C', directory, 'commit', '-q', '-m', str(version))
+        git('-C', directory, 'repack', '-q', '-a', '-d', '-f')
+
+        objects = git('-C', directory, 'rev-list', '--objects', '--all')
+        names = [line.split(' ')[0] for line in objects.split('\n') if line]
+        reader = ObjectReader(os.path.join(directory, '.git', 'objects'))
+        store = GitObjectStore()
+        store._start = lambda mode: git_popen(
+            '-C', directory, 'cat-file', mode, stdin=subprocess.PIPE,
+        )
+
+        def inflate(position, size):
+            raise AssertionError('Inflated a whole object')
+        reader._load_packs()
+        for pack in reader._packs.values():
+            pack.inflate = inflate
+
+        for name in names:
+            self.assertEquals(reader.info(name), store.info(name))
+
+        reader.close()
+        store.close()
+
+    def test_packs_can_be_added_while_reading(self):
+        directory, names = self.packed_copy()
+        reader = ObjectReader(os.path.join(directory, 'objects'))
+        failures = []
+
+        def read():
+            try:
+                for _ in range(20):
+                    for name in names:
+                        if reader.read(name) is None:
+                            failures.append(name)
+            except Exception as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # Forget the pack and find it again, as if it had just been added.
+        while any(thread.is_alive() for thread in threads):
+            with reader._packs_lock:
+                reader._packs.clear()
+            reader._load_packs()
+
+        for thread in threads:
+            thread.join()
+        reader.close()
+        self.assertEquals(failures, [])
+
+    def test_apply_delta(self):
+        base = 'hello world'
+        delta = ''.join([
+            '\x0b',              # base size
+            '\x10',              # result size
+            '\x90\x06',          # copy 6 bytes from offset 0
+            '\x04dear',          # insert "dear"
+            '\x91\x05\x06',      # copy 6 bytes from offset 5
+        ])
+        self.assertEquals(apply_delta(base, delta), 'hello dear world')
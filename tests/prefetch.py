@@ -0,0 +1,130 @@
+import subprocess
+import threading
+import time
+from unittest import TestCase
+import gitbrowse.git
+from gitbrowse.git import GitFileHistory
+from gitbrowse.prefetch import Prefetcher
+
+class PrefetcherTestCase(TestCase):
+    def setUp(self):
+        self.file_history = GitFileHistory('example.txt', 'HEAD')
+        self.prefetcher = Prefetcher(self.file_history, radius=2)
+        self.prefetcher.start()
+
+    def tearDown(self):
+        self.prefetcher.cancel()
+
+    def test_neighbours_are_prefetched(self):
+        commits = self.file_history.commits
+        self.file_history.prev()
+        self.prefetcher.schedule()
+        self.prefetcher.wait()
+
+        cache = self.file_history.cache
+        for i in (0, 2, 3):
+            self.assertTrue(('blame', 'example.txt', commits[i].sha) in cache)
+        self.assertFalse(('blame', 'example.txt', commits[4].sha) in cache)
+
+        mapping_key = ('mapping', 'example.txt', commits[2].sha,
+                       commits[3].sha)
+        self.assertTrue(mapping_key in cache)
+
+        misses = cache.misses
+        self.file_history.prev()
+        self.file_history.blame()
+        self.file_history.line_mapping(commits[1].sha, commits[2].sha)
+        self.assertEquals(cache.misses, misses)
+
+    def test_cancelled_blame_is_not_cached(self):
+        sha = self.file_history.commits[0].sha
+        self.assertEquals(
+            self.file_history.blame(sha, cancelled=lambda: True),
+            None,
+        )
+        self.assertFalse(('blame', 'example.txt', sha) in
+                         self.file_history.cache)
+
+    def test_silent_blame_is_killed_when_cancelled(self):
+        # git blame -p prints nothing until it's done, which a process that
+        # just sleeps stands in for here.
+        git_popen = gitbrowse.git.git_popen
+        processes = []
+        def sleep(*args, **kwargs):
+            processes.append(subprocess.Popen(['sleep', '30'],
+                                              stdout=subprocess.PIPE))
+            return processes[-1]
+        gitbrowse.git.git_popen = sleep
+
+        try:
+            deadline = time.time() + 0.1
+            blame = self.file_history.blame(
+                self.file_history.commits[0].sha,
+                cancelled=lambda: time.time() > deadline,
+            )
+        finally:
+            gitbrowse.git.git_popen = git_popen
+
+        self.assertEquals(blame, None)
+        self.assertTrue(time.time() - deadline < 5,
+                        'The blame should stop soon after being cancelled')
+        self.assertNotEquals(processes[0].poll(), None)
+
+    def test_work_near_the_new_revision_is_kept(self):
+        commits = self.file_history.commits
+        started = threading.Event()
+        release = threading.Event()
+        results = {}
+
+        def blame(sha, cancelled=None):
+            if sha == commits[1].sha:
+                started.set()
+                release.wait(5)
+                results[sha] = cancelled()
+
+        self.prefetcher.cancel()
+        self.file_history.blame = blame
+        self.prefetcher.schedule(0)
+        self.assertTrue(started.wait(5), 'The neighbour should be blamed')
+
+        # Moving to the revision being blamed keeps its blame going.
+        self.prefetcher.schedule(1)
+        release.set()
+        self.prefetcher.wait()
+        self.assertEquals(results, {commits[1].sha: False})
+
+        # Moving well away from it cancels it.
+        started.clear()
+        release.clear()
+        results.clear()
+        self.prefetcher.schedule(0)
+        self.assertTrue(started.wait(5), 'The neighbour should be blamed')
+        self.prefetcher.schedule(4)
+        release.set()
+        self.prefetcher.wait()
+        self.assertEquals(results, {commits[1].sha: True})
+
+    def test_running_blames_are_reported(self):
+        commits = self.file_history.commits
+        started = threading.Event()
+        release = threading.Event()
+
+        def blame(sha, cancelled=None):
+            if sha == commits[1].sha:
+                started.set()
+                release.wait(5)
+
+        self.prefetcher.cancel()
+        self.file_history.blame = blame
+        self.prefetcher.schedule(0)
+        self.assertTrue(started.wait(5), 'The neighbour should be blamed')
+
+        self.assertTrue(self.prefetcher.blaming(self.file_history,
+                                                commits[1].sha))
+        self.assertFalse(self.prefetcher.blaming(self.file_history,
+                                                 commits[2].sha))
+
+        release.set()
+        self.prefetcher.wait()
+        self.assertFalse(self.prefetcher.blaming(self.file_history,
+                                                 commits[1].sha))
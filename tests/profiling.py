@@ -0,0 +1,56 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+from gitbrowse.profiling import Profiler
+
+class ProfilerTestCase(TestCase):
+    def test_measure(self):
+        profiler = Profiler()
+        with profiler.measure('reading') as m:
+            m.bytes += 10
+        with profiler.measure('reading') as m:
+            m.bytes += 5
+
+        stats = profiler.stats()['reading']
+        self.assertEquals((stats['count'], stats['bytes']), (2, 15))
+        self.assertTrue(stats['seconds'] >= stats['max_seconds'] >= 0)
+
+    def test_measure_records_failures(self):
+        profiler = Profiler()
+        try:
+            with profiler.measure('failing'):
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertEquals(profiler.stats()['failing']['count'], 1)
+
+    def test_timed(self):
+        profiler = Profiler()
+
+        @profiler.timed('adding')
+        def add(a, b):
+            return a + b
+
+        self.assertEquals(add(1, 2), 3)
+        self.assertEquals(add.__name__, 'add')
+        self.assertEquals(profiler.stats()['adding']['count'], 1)
+
+    def test_summary_and_dump(self):
+        profiler = Profiler()
+        profiler.record('quick', 0.001)
+        profiler.record('slow', 0.5, bytes=100)
+
+        summary = profiler.summary()
+        self.assertEquals(len(summary), 3)
+        self.assertTrue(summary[1].startswith('slow'),
+                        'The slowest operation should come first')
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            profiler.dump(path)
+            with open(path) as f:
+                self.assertEquals(json.load(f)['slow']['bytes'], 100)
+        finally:
+            os.unlink(path)
@@ -0,0 +1,85 @@
+from unittest import TestCase
+from gitbrowse.git import GitFileHistory
+from gitbrowse.search import SearchIndex, HistorySearch
+
+LINES = ['foo bar\n', 'nothing\n', 'Foo foo\n', 'bar\n', 'food\n']
+
+class SearchIndexTestCase(TestCase):
+    def test_plain_search(self):
+        index = SearchIndex(LINES, 'foo')
+        self.assertEquals(index.matches, [0, 2, 4])
+        self.assertEquals(index.spans(2), [(4, 7)])
+        self.assertEquals(index.spans(1), [])
+
+    def test_plain_search_escapes_pattern(self):
+        index = SearchIndex(['a.b\n', 'axb\n'], 'a.b')
+        self.assertEquals(index.matches, [0])
+
+    def test_regex_search(self):
+        index = SearchIndex(LINES, r'fo+d?$', regex=True)
+        self.assertEquals(index.matches, [2, 4])
+        self.assertEquals(index.spans(4), [(0, 4)])
+
+    def test_empty_matches_are_ignored(self):
+        index = SearchIndex(LINES, r'x*', regex=True)
+        self.assertEquals(index.matches, [])
+
+    def test_ignore_case(self):
+        index = SearchIndex(LINES, 'FOO', ignore_case=True)
+        self.assertEquals(index.matches, [0, 2, 4])
+        self.assertEquals(index.spans(2), [(0, 3), (4, 7)])
+
+    def test_next_match(self):
+        index = SearchIndex(LINES, 'foo')
+        self.assertEquals(index.next_match(0), 2)
+        self.assertEquals(index.next_match(1), 2)
+        self.assertEquals(index.next_match(0, times=2), 4)
+        self.assertEquals(index.next_match(0, times=5), 4)
+        self.assertEquals(index.next_match(4), None)
+
+    def test_prev_match(self):
+        index = SearchIndex(LINES, 'foo')
+        self.assertEquals(index.prev_match(4), 2)
+        self.assertEquals(index.prev_match(3), 2)
+        self.assertEquals(index.prev_match(4, times=2), 0)
+        self.assertEquals(index.prev_match(4, times=5), 0)
+        self.assertEquals(index.prev_match(0), None)
+
+
+class HistorySearchTestCase(TestCase):
+    def setUp(self):
+        self.file_history = GitFileHistory('example.txt', 'HEAD')
+
+    def search(self, pattern, **kwargs):
+        search = HistorySearch(self.file_history, pattern, workers=2,
+                               **kwargs)
+        search.start()
+        search.wait()
+        return search
+
+    def test_results(self):
+        search = self.search('another')
+        self.assertTrue(search.complete)
+        self.assertEquals(search.results, {0: 2, 1: 2, 2: 2, 3: 0, 4: 0})
+
+    def test_entries(self):
+        self.assertEquals(
+            self.search('another').entries(),
+            [(0, None), (1, None), (2, '+')],
+        )
+        self.assertEquals(
+            self.search('second').entries(),
+            [(3, '-'), (4, '+')],
+        )
+        self.assertEquals(
+            self.search('^$', regex=True).entries(),
+            [(0, None), (1, '+')],
+        )
+
+    def test_cancel(self):
+        search = HistorySearch(self.file_history, 'another')
+        search.cancel()
+        search.start()
+        search.wait()
+        self.assertFalse(search.complete)
+        self.assertEquals(search.results, {})
@@ -0,0 +1,32 @@
+from unittest import TestCase
+from gitbrowse.session import Session
+
+class SessionTestCase(TestCase):
+    def setUp(self):
+        self.session = Session('HEAD')
+
+    def test_tracked_files(self):
+        self.assertEquals(self.session.tracked_files(),
+                          ['example.txt', 'other.txt'])
+
+    def test_open_and_close(self):
+        example = self.session.open('example.txt')
+        other = self.session.open('other.txt')
+        self.assertEquals(self.session.histories, [example, other])
+        self.assertTrue(self.session.open('example.txt') is example)
+
+        self.session.close(example)
+        self.assertEquals(self.session.histories, [other])
+
+    def test_missing_file(self):
+        self.assertRaises(ValueError, self.session.open, 'missing.txt')
+        self.assertEquals(self.session.histories, [])
+
+    def test_histories_share_caches_and_commits(self):
+        example = self.session.open('example.txt')
+        other = self.session.open('other.txt')
+
+        self.assertTrue(example.cache is other.cache)
+        self.assertTrue(example.store is other.store)
+        self.assertTrue(example.commits[0] is other.commits[0])
+        self.assertEquals(other.commits[0].message, 'Fifth commit')
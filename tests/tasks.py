@@ -0,0 +1,91 @@
+import threading
+import time
+from unittest import TestCase
+from gitbrowse.tasks import TaskRunner
+
+class TaskRunnerTestCase(TestCase):
+    def _wait(self, runner):
+        deadline = time.time() + 5
+        while not all(t.finished for t in runner.tasks):
+            if time.time() > deadline:
+                self.fail('Tasks did not finish within 5 seconds')
+            time.sleep(0.01)
+
+    def test_done_called_on_poll(self):
+        runner = TaskRunner()
+        results = []
+        runner.run('adding', lambda cancelled: 1 + 1, results.append)
+        self._wait(runner)
+
+        self.assertEquals(results, [], 'Callbacks should wait for poll')
+        self.assertTrue(runner.poll())
+        self.assertEquals(results, [2])
+        self.assertFalse(runner.busy)
+        self.assertFalse(runner.poll())
+
+    def test_cancel(self):
+        runner = TaskRunner()
+        release = threading.Event()
+        results = []
+
+        def work(cancelled):
+            release.wait()
+            return cancelled()
+
+        runner.run('waiting', work, results.append)
+        self.assertTrue(runner.busy)
+        self.assertTrue('waiting' in runner.progress())
+
+        self.assertTrue(runner.cancel())
+        self.assertFalse(runner.busy)
+        self.assertEquals(runner.progress(), None)
+        self.assertFalse(runner.cancel(), 'Nothing should be left to cancel')
+
+        release.set()
+        self._wait(runner)
+        runner.poll()
+        self.assertEquals(results, [], 'Cancelled tasks should not finish')
+
+    def test_errors_raised_from_poll(self):
+        runner = TaskRunner()
+        runner.run('failing', lambda cancelled: 1 / 0)
+        self._wait(runner)
+        self.assertRaises(ZeroDivisionError, runner.poll)
+
+    def test_errors_dont_lose_other_results(self):
+        runner = TaskRunner()
+        results = []
+        runner.run('failing', lambda cancelled: 1 / 0, results.append)
+        runner.run('adding', lambda cancelled: 1 + 1, results.append)
+        self._wait(runner)
+
+        self.assertRaises(ZeroDivisionError, runner.poll)
+        self.assertEquals(results, [2])
+        self.assertFalse(runner.poll())
+
+    def test_tasks_finishing_during_poll_are_kept(self):
+        class Finishing(object):
+            # A task that finishes just after poll first looks at it.
+            cancelled = False
+            error = None
+            result = 3
+
+            def __init__(self):
+                self.checks = 0
+                self.done = results.append
+
+            @property
+            def finished(self):
+                self.checks += 1
+                return self.checks > 1
+
+        runner = TaskRunner()
+        results = []
+        runner.run('adding', lambda cancelled: 1 + 1, results.append)
+        self._wait(runner)
+        runner.tasks.append(Finishing())
+
+        self.assertTrue(runner.poll())
+        self.assertEquals(results, [2])
+        self.assertTrue(runner.poll())
+        self.assertEquals(results, [2, 3])
@@ -0,0 +1,26 @@
+from unittest import TestCase
+from gitbrowse.git import GitFileHistory
+from gitbrowse.trace import trace_line
+
+class TraceTestCase(TestCase):
+    def setUp(self):
+        self.file_history = GitFileHistory('example.txt', 'HEAD')
+        self.shas = [c.sha for c in self.file_history.commits]
+
+    def test_unchanged_line(self):
+        records = list(trace_line(self.file_history, 3))
+        self.assertEquals([r['commit'] for r in records], self.shas)
+        self.assertEquals([r['line'] for r in records], [4, 4, 3, 1, 1])
+        self.assertEquals(set(r['text'] for r in records), set(['first']))
+        self.assertEquals(set(r['blame'] for r in records),
+                          set([self.shas[4]]))
+
+    def test_added_line(self):
+        records = list(trace_line(self.file_history, 0))
+        self.assertEquals([r['line'] for r in records],
+                          [1, 1, 1, None, None])
+        self.assertEquals([r['blame'] for r in records],
+                          [self.shas[2]] * 3 + [None] * 2)
+
+    def test_missing_line(self):
+        self.assertRaises(ValueError, list, trace_line(self.file_history, 6))